@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from django.core.management import BaseCommand
+from django.urls import get_resolver
+
+from base.utils.cache import CacheStat, reset_cache_stats
+from base.utils.rest.mixins import CacheModelMixin, _generate_cache_view_name
+
+
+def _get_cache_view_classes():
+    # 加载路由, 保证所有视图都已导入
+    get_resolver().url_patterns
+
+    classes = []
+    pending = list(CacheModelMixin.__subclasses__())
+    while pending:
+        view_class = pending.pop()
+        if view_class not in classes:
+            classes.append(view_class)
+            pending.extend(view_class.__subclasses__())
+    return sorted(classes, key=_generate_cache_view_name)
+
+
+# 各缓存视图的命中、旧数据、未命中、失效次数
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='include views without any request')
+        parser.add_argument('--reset', action='store_true', help='reset counters after printing')
+
+    def handle(self, *args, **options):
+        self.stdout.write('%-70s %8s %8s %8s %10s %8s' % ('view', 'hit', 'stale', 'miss', 'invalidate', 'hit%'))
+        for view_class in _get_cache_view_classes():
+            counts = view_class.get_cache_stats()
+            requests = counts[CacheStat.HIT] + counts[CacheStat.STALE] + counts[CacheStat.MISS]
+            if not requests and not options['all']:
+                continue
+
+            hit_rate = (counts[CacheStat.HIT] + counts[CacheStat.STALE]) * 100.0 / requests if requests else 0
+            self.stdout.write('%-70s %8d %8d %8d %10d %7.1f%%' % (
+                _generate_cache_view_name(view_class),
+                counts[CacheStat.HIT],
+                counts[CacheStat.STALE],
+                counts[CacheStat.MISS],
+                counts[CacheStat.INVALIDATE],
+                hit_rate,
+            ))
+            if options['reset']:
+                reset_cache_stats(_generate_cache_view_name(view_class))
@@ -1,8 +1,9 @@
-
+# -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
 import cPickle as pickle
 
+from channels.delay.models import DelayedMessage
 from django.db import models
 from django.utils import timezone
 
@@ -40,3 +41,10 @@ class Executor(models.Model):
         params = executor['params']
         params.update(kwargs)
         return func(*args, **params)
+
+
+# channels延时消息的索引, 按任务/场景取消时不用扫描全表
+class DelayedMessageKey(models.Model):
+    message = models.ForeignKey(DelayedMessage, on_delete=models.CASCADE, related_name='+')
+    mission_id = models.PositiveIntegerField(null=True, default=None, db_index=True)
+    scene_id = models.PositiveIntegerField(null=True, default=None, db_index=True)
@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+import socket
+import threading
+
+from django.test import SimpleTestCase
+from thriftpy.rpc import make_server
+
+from base.utils.rpc.client import AgentClient, AgentConnection, AgentConnectionPool, get_agent_thrift
+
+
+class AgentHandler(object):
+
+    def version(self):
+        return '1.0'
+
+    def run_command(self, command, sync):
+        return '{"status": "ok", "command": "%s"}' % command
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class AgentConnectionTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(AgentConnectionTest, cls).setUpClass()
+        cls.port = _free_port()
+        server = make_server(get_agent_thrift().AgentService, AgentHandler(), '127.0.0.1', cls.port)
+        thread = threading.Thread(target=server.serve)
+        thread.daemon = True
+        thread.start()
+        # 等待服务端开始监听
+        for i in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), 0.1).close()
+                break
+            except socket.error:
+                threading.Event().wait(0.1)
+
+    def test_connection(self):
+        connection = AgentConnection('127.0.0.1', self.port)
+        try:
+            self.assertEqual(connection.call('version'), '1.0')
+            self.assertTrue(connection.alive())
+            self.assertEqual(connection.pipeline([('version', {}), ('version', {})]), ['1.0', '1.0'])
+        finally:
+            connection.close()
+
+    def test_pool_reuse(self):
+        pool = AgentConnectionPool()
+        for i in range(2):
+            result = pool.execute('127.0.0.1', self.port, lambda connection: connection.call('version'))
+            self.assertEqual(result, '1.0')
+        metrics = pool.metrics()
+        self.assertEqual(metrics['created'], 1)
+        self.assertEqual(metrics['reused'], 1)
+        pool.clear()
+
+    def test_client_execute(self):
+        client = AgentClient('127.0.0.1', self.port)
+        self.assertEqual(client.execute_command('ls'), {'status': 'ok', 'command': 'ls'})
+        with client.batch() as batch:
+            batch.version()
+            batch.execute_command('pwd')
+        self.assertEqual(batch.results, [1.0, {'status': 'ok', 'command': 'pwd'}])
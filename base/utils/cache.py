@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
+import collections
 import uuid
 
 from django.core.cache import cache, _create_cache
 
+from base.utils.enum import Enum
 from base.utils.text import md5
 
 
@@ -40,3 +42,74 @@ def delete_cache(cache_instance):
     new_version = CacheProduct.get_unique_version()
     cache.set(cache_instance.version_key, new_version, None)
     cache_instance.version = new_version
+
+
+# 缓存条目: 数据, 依赖标签的版本, 生成时间
+CacheEntry = collections.namedtuple('CacheEntry', ('data', 'tags', 'time'))
+
+CacheStat = Enum(
+    HIT='hit',
+    STALE='stale',
+    MISS='miss',
+    INVALIDATE='invalidate',
+)
+
+
+# 依赖标签: 模型标签对应查询结果集(增删改变分页和总数), 行标签对应单条数据
+def model_tag(model):
+    return 'model:%s' % model._meta.label_lower
+
+
+def row_tag(model, pk):
+    return 'row:%s:%s' % (model._meta.label_lower, pk)
+
+
+def _tag_version_key(tag):
+    return md5('%s:tag_version' % tag)
+
+
+# 获取标签当前版本, 没有版本的标签生成一个
+def get_tag_versions(tags):
+    key_tags = {_tag_version_key(tag): tag for tag in set(tags)}
+    versions = cache.get_many(key_tags.keys())
+    missing_keys = [key for key in key_tags if key not in versions]
+    if missing_keys:
+        for key in missing_keys:
+            cache.add(key, CacheProduct.get_unique_version(), None)
+        versions.update(cache.get_many(missing_keys))
+    return {key_tags[key]: version for key, version in versions.items()}
+
+
+# 更新标签版本等于删除依赖该标签的缓存条目
+def invalidate_tags(tags):
+    cache.set_many({_tag_version_key(tag): CacheProduct.get_unique_version() for tag in set(tags)}, None)
+
+
+def is_entry_valid(entry):
+    return get_tag_versions(entry.tags.keys()) == entry.tags
+
+
+def _stat_key(name, stat):
+    return md5('%s:stat:%s' % (name, stat))
+
+
+def incr_cache_stat(name, stat):
+    key = _stat_key(name, stat)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            try:
+                cache.incr(key)
+            except ValueError:
+                pass
+
+
+def get_cache_stats(name):
+    key_stats = {_stat_key(name, stat): stat for stat in CacheStat.values()}
+    counts = cache.get_many(key_stats.keys())
+    return {stat: counts.get(key, 0) for key, stat in key_stats.items()}
+
+
+def reset_cache_stats(name):
+    cache.delete_many([_stat_key(name, stat) for stat in CacheStat.values()])
@@ -1,12 +1,5 @@
-import sched
-import threading
-import time
+from base.utils.thread import async_exe
 
 
 def new_task(function, delay_time, args):
-    scheduler = sched.scheduler(time.time, time.sleep)
-    scheduler.enter(delay_time, 10, function, args)
-    thread = threading.Thread(target=scheduler.run)
-    thread.start()
-
-    return thread
+    return async_exe(function, args, delay=delay_time)
@@ -2,11 +2,48 @@
 import json
 
 from channels.delay import models as delay_models
+from django.db import transaction
 import ast
 
+from base.models import DelayedMessageKey
 
-def delete_channel_delay(content):
-    delay_tasks = delay_models.DelayedMessage.objects.all()
+
+# 发送带索引的延时消息, 等同于向asgi.delay发送, 但可以按任务/场景直接取消
+def send_channel_delay(channel, content, delay=0, mission_id=None, scene_id=None):
+    with transaction.atomic():
+        delayed_message = delay_models.DelayedMessage.objects.create(
+            channel_name=channel,
+            content=json.dumps(content),
+            delay=delay,
+        )
+        if mission_id is not None or scene_id is not None:
+            DelayedMessageKey.objects.create(message=delayed_message, mission_id=mission_id, scene_id=scene_id)
+    return delayed_message
+
+
+# 按任务/场景批量取消延时消息
+def cancel_channel_delay(mission_ids=None, scene_ids=None):
+    keys = DelayedMessageKey.objects.all()
+    if mission_ids is not None:
+        keys = keys.filter(mission_id__in=mission_ids)
+    if scene_ids is not None:
+        keys = keys.filter(scene_id__in=scene_ids)
+    if mission_ids is None and scene_ids is None:
+        return 0
+
+    message_ids = list(keys.values_list('message_id', flat=True))
+    if not message_ids:
+        return 0
+    deleted, _ = delay_models.DelayedMessage.objects.filter(pk__in=message_ids).delete()
+    return deleted
+
+
+def delete_channel_delay(content, channel_name=None):
+    # 只扫描没有索引的旧消息
+    indexed_message_ids = DelayedMessageKey.objects.values('message_id')
+    delay_tasks = delay_models.DelayedMessage.objects.exclude(pk__in=indexed_message_ids)
+    if channel_name:
+        delay_tasks = delay_tasks.filter(channel_name=channel_name)
     for delay_task in delay_tasks:
         if len(content) == 0 or type(content) != dict:
             return False
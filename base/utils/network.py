@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import errno
 import logging
+import os
+import select
 import socket
+import struct
 import subprocess
+import threading
 import time
 
+from base.utils.thread import async_exe
+
 
 logger = logging.getLogger(__name__)
 
@@ -82,3 +89,303 @@ def probe(ip, port=None, timeout=2, step_time=2, limit_time=300, stop_check_len=
                 if stop_check():
                     break
                 stop_check_time = 0
+
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def _icmp_checksum(data):
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%sH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _icmp_packet(ident, seq):
+    data = struct.pack('!d', time.time())
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _icmp_checksum(header + data)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + data
+
+
+class ProbeWatch(object):
+
+    def __init__(self, key, ip, port=None, timeout=2, step_time=2, limit_time=300, stop_check_len=5,
+                 stop_check=None, callback=None, timeout_callback=None, log_prefix='probe'):
+        self.key = key
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.step_time = step_time
+        self.limit_time = limit_time
+        self.stop_check_len = stop_check_len
+        self.stop_check = stop_check
+        self.callback = callback
+        self.timeout_callback = timeout_callback
+        self.log_prefix = log_prefix
+        self.dst_info = '%s:%s' % (ip, port) if port else ip
+        self.checker = 'cport' if port else 'ping'
+
+        self.start_time = time.time()
+        self.next_time = self.start_time
+        self.deadline = None
+        self.attempts = 0
+        self.sock = None
+        self.process = None
+        self.icmp_seq = None
+        self.stop_checking = False
+
+    @property
+    def pending(self):
+        return self.deadline is not None
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if self.process:
+            if self.process.poll() is None:
+                try:
+                    self.process.kill()
+                except OSError:
+                    pass
+                self.process.wait()
+            self.process = None
+        self.icmp_seq = None
+        self.deadline = None
+
+
+# 共享的探测监视器: 一个线程用select复用所有端口/ICMP探测, 替代每台机器一个probe线程
+class ProbeMonitor(object):
+
+    def __init__(self, max_wait=1):
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._thread = None
+        self._wake_r, self._wake_w = os.pipe()
+        self._icmp_sock = None
+        self._icmp_checked = False
+        self._icmp_ident = os.getpid() & 0xffff
+        self._icmp_seq = 0
+
+    def watch(self, ip, port=None, key=None, timeout=2, step_time=2, limit_time=300, stop_check_len=5,
+              stop_check=None, callback=None, timeout_callback=None, log_prefix='probe'):
+        if not ip:
+            logger.error('[%s] %s check %s: no ip' % (log_prefix, 'cport' if port else 'ping',
+                                                      '%s:%s' % (ip, port) if port else ip))
+            return None
+
+        key = key or (ip, port)
+        watch = ProbeWatch(key, ip, port=port, timeout=timeout, step_time=step_time, limit_time=limit_time,
+                           stop_check_len=stop_check_len, stop_check=stop_check, callback=callback,
+                           timeout_callback=timeout_callback, log_prefix=log_prefix)
+        with self._lock:
+            old_watch = self._watches.pop(key, None)
+            if old_watch:
+                old_watch.close()
+            self._watches[key] = watch
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='probe-monitor')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake()
+        return key
+
+    # 外部确认已就绪(如虚拟机主动上报), 提前结束探测并触发回调
+    def cancel(self, key):
+        return self._pop(key) is not None
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._watches)
+
+    def _pop(self, key):
+        with self._lock:
+            watch = self._watches.pop(key, None)
+        if watch:
+            watch.close()
+            self._wake()
+        return watch
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def _fire(self, callback):
+        if callback:
+            async_exe(callback)
+
+    def _get_icmp_sock(self):
+        if not self._icmp_checked:
+            self._icmp_checked = True
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname('icmp'))
+                sock.setblocking(False)
+            except (socket.error, OSError) as e:
+                # 没有raw socket权限时退回ping进程
+                logger.info('probe monitor icmp socket unavailable, fallback to ping: %s', e)
+            else:
+                self._icmp_sock = sock
+        return self._icmp_sock
+
+    def _start(self, watch, now):
+        watch.attempts += 1
+        watch.deadline = now + watch.timeout
+        logger.info('[%s] %s check %s: %ss' % (watch.log_prefix, watch.checker, watch.dst_info,
+                                               int(now - watch.start_time)))
+        if watch.port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex((watch.ip, int(watch.port)))
+            watch.sock = sock
+            if err == 0:
+                return True
+            elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                return False
+        else:
+            icmp_sock = self._get_icmp_sock()
+            if icmp_sock:
+                self._icmp_seq = (self._icmp_seq + 1) & 0xffff
+                try:
+                    icmp_sock.sendto(_icmp_packet(self._icmp_ident, self._icmp_seq), (watch.ip, 0))
+                except (socket.error, OSError):
+                    return False
+                watch.icmp_seq = self._icmp_seq
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    watch.process = subprocess.Popen(['ping', '-c', '1', '-w', str(watch.timeout), watch.ip],
+                                                     stdout=devnull, stderr=devnull)
+        return None
+
+    def _finish(self, watch, success):
+        with self._lock:
+            if self._watches.get(watch.key) is not watch:
+                return
+            self._watches.pop(watch.key)
+        watch.close()
+        if success:
+            logger.info('[%s] %s check %s ok' % (watch.log_prefix, watch.checker, watch.dst_info))
+            self._fire(watch.callback)
+        else:
+            logger.info('[%s] %s check %s timeout' % (watch.log_prefix, watch.checker, watch.dst_info))
+            self._fire(watch.timeout_callback)
+
+    def _failed(self, watch, now):
+        watch.close()
+        if now - watch.start_time > watch.limit_time:
+            self._finish(watch, False)
+            return
+
+        # stop_check可能查询数据库, 放到任务线程执行, 不阻塞其它探测
+        if watch.stop_check and watch.attempts % watch.stop_check_len == 0 and not watch.stop_checking:
+            watch.stop_checking = True
+            async_exe(self._stop_check, (watch,))
+        # 限制检查频率
+        watch.next_time = max(now, watch.next_time + watch.step_time)
+
+    def _stop_check(self, watch):
+        try:
+            stopped = watch.stop_check()
+        except Exception as e:
+            logger.error('[%s] stop check error: %s' % (watch.log_prefix, e))
+            stopped = False
+        finally:
+            watch.stop_checking = False
+        if stopped:
+            with self._lock:
+                if self._watches.get(watch.key) is not watch:
+                    return
+            self._pop(watch.key)
+
+    def _handle_icmp(self):
+        while True:
+            try:
+                packet, addr = self._icmp_sock.recvfrom(1024)
+            except (socket.error, OSError):
+                return
+            header_len = (ord(packet[0]) & 0x0f) * 4
+            icmp_type, code, checksum, ident, seq = struct.unpack('!BBHHH', packet[header_len:header_len + 8])
+            if icmp_type != ICMP_ECHO_REPLY or ident != self._icmp_ident:
+                continue
+            with self._lock:
+                watches = [watch for watch in self._watches.values()
+                           if watch.ip == addr[0] and watch.icmp_seq is not None]
+            for watch in watches:
+                self._finish(watch, True)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._watches:
+                    self._thread = None
+                    return
+                watches = self._watches.values()
+
+            now = time.time()
+            rlist = [self._wake_r]
+            wlist = []
+            sock_watches = {}
+            wake_time = now + self.max_wait
+            for watch in watches:
+                if not watch.pending:
+                    if now < watch.next_time:
+                        wake_time = min(wake_time, watch.next_time)
+                        continue
+                    try:
+                        result = self._start(watch, now)
+                    except Exception as e:
+                        logger.error('[%s] %s check %s error: %s' % (watch.log_prefix, watch.checker,
+                                                                     watch.dst_info, e))
+                        result = False
+                    if result is True:
+                        self._finish(watch, True)
+                        continue
+                    elif result is False:
+                        self._failed(watch, now)
+                        continue
+                elif watch.process and watch.process.poll() is not None:
+                    if watch.process.returncode == 0:
+                        self._finish(watch, True)
+                    else:
+                        self._failed(watch, now)
+                    continue
+                elif now >= watch.deadline:
+                    self._failed(watch, now)
+                    continue
+
+                wake_time = min(wake_time, watch.deadline)
+                if watch.sock:
+                    wlist.append(watch.sock)
+                    sock_watches[watch.sock] = watch
+            if self._icmp_sock:
+                rlist.append(self._icmp_sock)
+
+            try:
+                readable, writable, _ = select.select(rlist, wlist, [], max(0, wake_time - time.time()))
+            except (select.error, socket.error, ValueError) as e:
+                logger.error('probe monitor select error: %s', e)
+                time.sleep(self.max_wait)
+                continue
+
+            if self._wake_r in readable:
+                os.read(self._wake_r, 1024)
+            if self._icmp_sock and self._icmp_sock in readable:
+                self._handle_icmp()
+            now = time.time()
+            for sock in writable:
+                watch = sock_watches[sock]
+                if watch.sock is not sock:
+                    continue
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    self._finish(watch, True)
+                else:
+                    self._failed(watch, now)
+
+
+probe_monitor = ProbeMonitor()
@@ -1,4 +1,6 @@
+# -*- coding: utf-8 -*-
 import json
+import time
 
 from django.conf import settings
 from django.db.models.sql.datastructures import EmptyResultSet
@@ -9,7 +11,8 @@ from rest_framework import exceptions, mixins, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from base.utils.cache import CacheProduct, delete_cache
+from base.utils.cache import (CacheEntry, CacheProduct, CacheStat, delete_cache, get_cache_stats, get_tag_versions,
+                              incr_cache_stat, invalidate_tags, is_entry_valid, model_tag, row_tag)
 from base.utils.text import md5
 from base.utils.rest.pagination import VueTablePagination, CacheVueTablePagination
 from base.utils.rest.request import RequestData
@@ -59,6 +62,8 @@ def _generate_cache_view_name(view_cls):
 class CacheModelMixin(object):
     pagination_class = CacheVueTablePagination
     page_cache = True
+    # 更新时哪些字段变化会影响列表的筛选和排序, None表示任意字段
+    cache_membership_fields = None
 
     def __new__(cls, *args, **kwargs):
         obj = super(CacheModelMixin, cls).__new__(cls)
@@ -87,8 +92,65 @@ class CacheModelMixin(object):
     def get_cache_age(self):
         return getattr(self, 'page_cache_age', settings.DEFAULT_CACHE_AGE)
 
+    def get_cache_stale_age(self):
+        return getattr(self, 'page_cache_stale_age', settings.API_CACHE_STALE_AGE)
+
+    @classmethod
+    def get_cache_model(cls):
+        return cls.queryset.model
+
+    # 列表页依赖模型(增删影响分页)和页内每一行, 子类可追加其它依赖
+    def get_list_cache_tags(self, page):
+        model = self.get_cache_model()
+        tags = [model_tag(model)]
+        tags.extend(row_tag(model, obj.pk) for obj in page if getattr(obj, 'pk', None) is not None)
+        return tags
+
+    def get_count_cache_tags(self):
+        return [model_tag(self.get_cache_model())]
+
+    def get_object_cache_tags(self, pk):
+        return [row_tag(self.get_cache_model(), pk)]
+
+    def get_cached_data(self, key):
+        view_name = _generate_cache_view_name(self.__class__)
+        entry = self.cache.get(key)
+        if not isinstance(entry, CacheEntry):
+            incr_cache_stat(view_name, CacheStat.MISS)
+            return None
+
+        expired = time.time() - entry.time > self.get_cache_age()
+        if not expired and is_entry_valid(entry):
+            incr_cache_stat(view_name, CacheStat.HIT)
+            return entry.data
+
+        # 过期或依赖已失效: 只让一个请求重新计算, 计算期间其它请求先返回旧数据
+        if self.cache.add(self._refresh_key(key), 1, self.get_cache_stale_age()):
+            incr_cache_stat(view_name, CacheStat.MISS)
+            return None
+        incr_cache_stat(view_name, CacheStat.STALE)
+        return entry.data
+
+    # 标签版本要在计算数据之前获取, 计算期间的失效才不会丢失
+    def set_cached_data(self, key, data, tag_versions):
+        entry = CacheEntry(data, tag_versions, time.time())
+        self.cache.set(key, entry, self.get_cache_age() + self.get_cache_stale_age())
+        self.cache.delete(self._refresh_key(key))
+
+    def _refresh_key(self, key):
+        return '%s:refresh' % key
+
+    def get_or_set_cached_data(self, key, func, tags):
+        data = self.get_cached_data(key)
+        if data is None:
+            tag_versions = get_tag_versions(tags)
+            data = func()
+            self.set_cached_data(key, data, tag_versions)
+        return data
+
     def clear_cache(self):
         delete_cache(self.cache)
+        incr_cache_stat(_generate_cache_view_name(self.__class__), CacheStat.INVALIDATE)
         if hasattr(self, 'related_cache_classes'):
             self.clear_cls_cache(self.related_cache_classes)
 
@@ -100,17 +162,33 @@ class CacheModelMixin(object):
 
     @staticmethod
     def clear_cls_cache(cls):
-        if not isinstance(cls, (list, tuple)):
-            cls = [cls]
-        for c in cls:
-            if isinstance(c, (six.string_types, six.text_type)):
-                try:
-                    c = import_string(c)
-                except Exception:
-                    continue
+        for c in _load_cache_classes(cls):
             cache_view_name = _generate_cache_view_name(c)
             cache = CacheProduct(cache_view_name)
             delete_cache(cache)
+            incr_cache_stat(cache_view_name, CacheStat.INVALIDATE)
+
+    # 只失效依赖这些行的缓存页和对象, membership为True时同时失效该模型的列表页和总数
+    @classmethod
+    def invalidate_cache_rows(cls, pks, membership=False):
+        model = cls.get_cache_model()
+        tags = [row_tag(model, pk) for pk in pks]
+        if membership:
+            tags.append(model_tag(model))
+        if tags:
+            invalidate_tags(tags)
+            incr_cache_stat(_generate_cache_view_name(cls), CacheStat.INVALIDATE)
+
+    # 同模型的关联视图已通过标签失效, 其它模型的关联视图仍整体清除
+    def clear_related_cache(self):
+        if hasattr(self, 'related_cache_classes'):
+            model = self.get_cache_model()
+            self.clear_cls_cache([c for c in _load_cache_classes(self.related_cache_classes)
+                                  if not (issubclass(c, CacheModelMixin) and c.get_cache_model() is model)])
+
+    @classmethod
+    def get_cache_stats(cls):
+        return get_cache_stats(_generate_cache_view_name(cls))
 
     def paginate_queryset_flag(self, queryset):
         return self.paginator.paginate_queryset_flag(queryset, self.request, view=self)
@@ -120,20 +198,20 @@ class CacheModelMixin(object):
         paginate_queryset_flag = self.paginate_queryset_flag(queryset)
         if paginate_queryset_flag:
             if self.get_cache_flag():
-                cache_value = self.cache.get(self.cache_key)
-                if cache_value:
-                    data = cache_value
-                else:
-                    data = self._get_list_data(queryset)
-                    self.cache.set(self.cache_key, data, self.get_cache_age())
+                data = self.get_cached_data(self.cache_key)
+                if data is None:
+                    # 分页时已算好总数和页查询, 不再重复计数
+                    page = list(self.paginator.page_queryset)
+                    tag_versions = get_tag_versions(self.get_list_cache_tags(page))
+                    data = self._get_list_data(page)
+                    self.set_cached_data(self.cache_key, data, tag_versions)
             else:
-                data = self._get_list_data(queryset)
+                data = self._get_list_data(self.paginate_queryset(queryset))
         else:
             data = []
         return self.get_paginated_response(data)
 
-    def _get_list_data(self, queryset):
-        page = self.paginate_queryset(queryset)
+    def _get_list_data(self, page):
         data = self.get_serializer(page, many=True).data
         data = self.extra_handle_list_data(data)
         return data
@@ -141,17 +219,28 @@ class CacheModelMixin(object):
     def extra_handle_list_data(self, data):
         return data
 
+    def is_cache_membership_changed(self, fields):
+        if self.cache_membership_fields is None:
+            return True
+        return bool(set(fields) & set(self.cache_membership_fields))
+
+    # 写操作后失效受影响的行和关联视图
+    def invalidate_cache(self, pks, membership=True):
+        self.invalidate_cache_rows(pks, membership=membership)
+        self.clear_related_cache()
+
     def perform_create(self, serializer):
         if self.sub_perform_create(serializer):
-            self.clear_cache()
+            self.invalidate_cache([serializer.instance.pk])
 
     def perform_update(self, serializer):
         if self.sub_perform_update(serializer):
-            self.clear_cache()
+            self.invalidate_cache([serializer.instance.pk],
+                                  membership=self.is_cache_membership_changed(serializer.validated_data))
 
     def perform_destroy(self, instance):
         if self.sub_perform_destroy(instance):
-            self.clear_cache()
+            self.invalidate_cache([instance.pk])
 
     def sub_perform_create(self, serializer):
         super(CacheModelMixin, self).perform_create(serializer)
@@ -166,11 +255,25 @@ class CacheModelMixin(object):
         return True
 
 
+def _load_cache_classes(cls):
+    if not isinstance(cls, (list, tuple)):
+        cls = [cls]
+    classes = []
+    for c in cls:
+        if isinstance(c, (six.string_types, six.text_type)):
+            try:
+                c = import_string(c)
+            except Exception:
+                continue
+        classes.append(c)
+    return classes
+
+
 class DestroyModelMixin(mixins.DestroyModelMixin):
 
     def perform_destroy(self, instance):
-        if self.sub_perform_destroy(instance) and hasattr(self, 'clear_cache'):
-            self.clear_cache()
+        if self.sub_perform_destroy(instance) and hasattr(self, 'invalidate_cache'):
+            self.invalidate_cache([instance.pk])
 
     def sub_perform_destroy(self, instance):
         instance.status = instance.Status.DELETE
@@ -184,8 +287,8 @@ class DestroyModelMixin(mixins.DestroyModelMixin):
             return Response(status=status.HTTP_204_NO_CONTENT)
 
         queryset = self.queryset.filter(id__in=ids)
-        if self.perform_batch_destroy(queryset) and hasattr(self, 'clear_cache'):
-            self.clear_cache()
+        if self.perform_batch_destroy(queryset) and hasattr(self, 'invalidate_cache'):
+            self.invalidate_cache(ids)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -221,8 +324,8 @@ class BatchSetModelMixin(object):
             raise exceptions.PermissionDenied()
 
         queryset = self.queryset.filter(id__in=ids)
-        if self.perform_batch_set(queryset, field, value) and hasattr(self, 'clear_cache'):
-            self.clear_cache()
+        if self.perform_batch_set(queryset, field, value) and hasattr(self, 'invalidate_cache'):
+            self.invalidate_cache(ids, membership=self.is_cache_membership_changed([field]))
 
         return Response(status=status.HTTP_200_OK)
 
@@ -242,8 +345,8 @@ class PublicModelMixin(object):
         public = self.shift_data.get('public', int) or 0
 
         queryset = self.queryset.filter(id__in=ids)
-        if hasattr(self, 'clear_cache') and self.perform_batch_public(queryset, public):
-            self.clear_cache()
+        if hasattr(self, 'invalidate_cache') and self.perform_batch_public(queryset, public):
+            self.invalidate_cache(ids, membership=self.is_cache_membership_changed(['public']))
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -12,11 +12,9 @@ class CacheLimitOffsetPaginationMixin(object):
 
     def get_count(self, queryset, view=None):
         if view and getattr(view, 'page_cache', False):
-            cache_key = view._default_generate_count_cache_key()
-            count = view.cache.get(cache_key)
-            if count is None:
-                count = self._get_count(queryset, view=view)
-                view.cache.set(cache_key, count, view.get_cache_age())
+            count = view.get_or_set_cached_data(view._default_generate_count_cache_key(),
+                                                lambda: self._get_count(queryset, view=view),
+                                                view.get_count_cache_tags())
         else:
             count = self._get_count(queryset, view=view)
         return count
@@ -5,5 +5,9 @@ service AgentService {
     string run_script(1:string name, 2:string content, 3:string checksum, 4:string main_func, 5:string json_args, 6:bool sync),
     oneway void run_script_async(1:string name, 2:string content, 3:string checksum, 4:string main_func, 5:string json_args),
     oneway void scheduler_run_script(1:string cr_event, 2:string machine_id, 3:string name, 4:string content, 5:string checksum, 6:string main_func, 7:string script_args, 8:string trigger_args, 9:string report_url),
-    string scheduler_job_action(1:string cr_event, 2:string machine_id, 3:string action)
+    string scheduler_job_action(1:string cr_event, 2:string machine_id, 3:string action),
+    // 按校验和执行已缓存的脚本, agent没有该脚本时返回{"status": "miss"}, 客户端再上传内容
+    string run_script_by_checksum(1:string name, 2:string checksum, 3:string main_func, 4:string json_args, 5:bool sync),
+    string run_script_async_by_checksum(1:string name, 2:string checksum, 3:string main_func, 4:string json_args),
+    string scheduler_run_script_by_checksum(1:string cr_event, 2:string machine_id, 3:string name, 4:string checksum, 5:string main_func, 6:string script_args, 7:string trigger_args, 8:string report_url)
 }
\ No newline at end of file
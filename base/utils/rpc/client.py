@@ -1,23 +1,274 @@
 # -*- coding:utf-8 -*-
+import collections
+import contextlib
+import errno
 import json
+import logging
 import os
 import hashlib
+import socket
+import threading
+import time
 import urlparse
 
 import thriftpy
-from thriftpy.rpc import client_context
+from thriftpy.protocol import TBinaryProtocolFactory
+from thriftpy.thrift import TApplicationException, TClient
+from thriftpy.transport import TBufferedTransportFactory, TSocket, TTransportException
 
 from django.conf import settings
 
-from cr.settings import RPC_DEFAULT_HOST, RPC_DEFAULT_PORT, SOCKET_TIMEOUT, CONNECT_TIMEOUT
+from cr.settings import RPC_DEFAULT_HOST, RPC_DEFAULT_PORT, SOCKET_TIMEOUT, CONNECT_TIMEOUT, \
+    RPC_POOL_SIZE, RPC_POOL_IDLE_SECONDS, RPC_POOL_CHECK_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+
+# agent不支持按校验和执行时, 隔多久(秒)再尝试
+CHECKSUM_RETRY_SECONDS = 600
+
+
+_agent_thrift = None
+_agent_thrift_lock = threading.Lock()
+
+
+# idl每个进程只解析一次
+def get_agent_thrift():
+    global _agent_thrift
+    if _agent_thrift is None:
+        with _agent_thrift_lock:
+            if _agent_thrift is None:
+                _agent_thrift = thriftpy.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent.thrift'),
+                                              module_name="agent_thrift")
+    return _agent_thrift
+
+
+# 对端已关闭的连接, 请求没有被处理, 可以安全重试
+def _is_stale_error(e):
+    if isinstance(e, TTransportException):
+        return e.type == TTransportException.END_OF_FILE
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, socket.error):
+        return e.errno in (errno.EPIPE, errno.ECONNRESET)
+    return False
+
+
+class AgentConnection(object):
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.client = self._make_client(host, port)
+        self.last_used = time.time()
+        self.reused = False
+
+    # 与client_context相同的构造方式, make_client不支持分开设置连接和读写超时
+    @staticmethod
+    def _make_client(host, port):
+        sock = TSocket(host, port, socket_timeout=SOCKET_TIMEOUT, connect_timeout=CONNECT_TIMEOUT)
+        transport = TBufferedTransportFactory().get_transport(sock)
+        protocol = TBinaryProtocolFactory().get_protocol(transport)
+        transport.open()
+        return TClient(get_agent_thrift().AgentService, protocol)
+
+    def call(self, func_name, **params):
+        return getattr(self.client, func_name)(**params)
+
+    # 流水线: 先依次发出全部请求, 再按顺序读取非oneway请求的结果
+    def pipeline(self, calls):
+        service = get_agent_thrift().AgentService
+        for func_name, params in calls:
+            self.client._send(func_name, **params)
+        results = []
+        for func_name, params in calls:
+            if getattr(service, func_name + '_result').oneway:
+                results.append(None)
+                continue
+            # 应用异常已完整读出, 不影响后续结果
+            try:
+                results.append(self.client._recv(func_name))
+            except TApplicationException as e:
+                results.append(e)
+        return results
+
+    def alive(self):
+        try:
+            self.client.version()
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+# 按(host, port)保存的agent长连接池
+class AgentConnectionPool(object):
+
+    def __init__(self, size=RPC_POOL_SIZE, idle_seconds=RPC_POOL_IDLE_SECONDS, check_seconds=RPC_POOL_CHECK_SECONDS):
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._stats = collections.Counter()
+
+    def acquire(self, host, port):
+        key = (host, port)
+        while True:
+            with self._lock:
+                connections = self._idle.get(key)
+                connection = connections.pop() if connections else None
+            if connection is None:
+                break
+
+            idle = time.time() - connection.last_used
+            if idle > self.idle_seconds:
+                self._stats['evicted'] += 1
+                connection.close()
+                continue
+            # 空闲较久的连接先检查是否可用
+            if idle > self.check_seconds and not connection.alive():
+                self._stats['broken'] += 1
+                connection.close()
+                continue
+            connection.reused = True
+            self._stats['reused'] += 1
+            return connection
+
+        self._stats['created'] += 1
+        return AgentConnection(host, port)
+
+    def release(self, connection, broken=False):
+        if broken:
+            self._stats['broken'] += 1
+            connection.close()
+            return
+
+        connection.last_used = time.time()
+        key = (connection.host, connection.port)
+        with self._lock:
+            connections = self._idle.setdefault(key, collections.deque())
+            connections.append(connection)
+            # 超出的连接关闭最早放回的
+            overflow = [connections.popleft() for i in range(len(connections) - self.size)]
+        for old_connection in overflow:
+            self._stats['evicted'] += 1
+            old_connection.close()
+
+    @contextlib.contextmanager
+    def connection(self, host, port):
+        connection = self.acquire(host, port)
+        try:
+            yield connection
+        except Exception:
+            self.release(connection, broken=True)
+            raise
+        else:
+            self.release(connection)
+
+    # 复用的连接可能已被对端关闭, 失败后用新连接重试一次
+    def execute(self, host, port, func, *args):
+        connection = self.acquire(host, port)
+        try:
+            result = func(connection, *args)
+        except Exception as e:
+            self.release(connection, broken=True)
+            if not (connection.reused and _is_stale_error(e)):
+                raise
+        else:
+            self.release(connection)
+            return result
+
+        self._stats['reconnect'] += 1
+        with self.connection(host, port) as connection:
+            return func(connection, *args)
+
+    def clear(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def metrics(self):
+        with self._lock:
+            metrics = {
+                'idle': sum(len(connections) for connections in self._idle.values()),
+                'agents': len(self._idle),
+            }
+        metrics.update(self._stats)
+        return metrics
+
+
+agent_pool = AgentConnectionPool()
+
+
+# 脚本内容和校验和缓存, 文件修改时间或大小变化后重新读取
+class ScriptCache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scripts = {}
+
+    def get(self, path):
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            cached = self._scripts.get(path)
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        md5 = hashlib.md5()
+        md5.update(content)
+        checksum = md5.hexdigest()
+        with self._lock:
+            self._scripts[path] = (version, content, checksum)
+        return content, checksum
+
+    def clear(self):
+        with self._lock:
+            self._scripts.clear()
+
+
+script_cache = ScriptCache()
+
+
+_checksum_unsupported = {}
+
+
+def checksum_supported(host, port):
+    unsupported_time = _checksum_unsupported.get((host, port))
+    return unsupported_time is None or time.time() - unsupported_time > CHECKSUM_RETRY_SECONDS
+
+
+def _is_unknown_method(result):
+    error = result.get('message') if isinstance(result, dict) else result
+    return isinstance(error, TApplicationException) and error.type == TApplicationException.UNKNOWN_METHOD
+
+
+def _load_result(result):
+    if isinstance(result, TApplicationException):
+        return {'status': "down", "message": result}
+    try:
+        return json.loads(result)
+    except Exception as e:
+        return result
 
 
 class AgentClient(object):
     def __init__(self, host=RPC_DEFAULT_HOST, port=RPC_DEFAULT_PORT):
         self.host = host
         self.port = port
-        self.agent_thrift = thriftpy.load("base/utils/rpc/agent.thrift",
-                                          module_name="agent_thrift")
+        self.agent_thrift = get_agent_thrift()
 
     def check_func(self, func_name):
         """ check function registered in *.thrift
@@ -38,17 +289,19 @@ class AgentClient(object):
         """
         if self.check_func(func_name):
             try:
-                with client_context(self.agent_thrift.AgentService, self.host, self.port,
-                                    socket_timeout=SOCKET_TIMEOUT, connect_timeout=CONNECT_TIMEOUT) as c:
-                    result = getattr(c, func_name)(**params)
-
-                    try:
-                        return json.loads(result)
-                    except Exception as e:
-                        return result
+                result = agent_pool.execute(self.host, self.port,
+                                            lambda connection: connection.call(func_name, **params))
+                return _load_result(result)
             except Exception as e:
                 return {'status': "down", "message": e}
 
+    def batch(self):
+        """ collect calls and send them to the agent over one connection
+
+        :return: AgentBatch
+        """
+        return AgentBatch(self.host, self.port)
+
     def version(self):
         """ display agent server version
 
@@ -72,40 +325,55 @@ class AgentClient(object):
         """
         self.remote_execute("run_command_async", command=command)
 
-    def execute_script(self, file_path, main_func="", json_args="", sync=True):
-        """ execute script file on remote server
+    def _script_file(self, file_path, url_root=None):
+        """ script name, content and checksum to send
 
-        :param file_path: local script path
-        :param main_func: main function, only work for python script
-        :param json_args: args string for scirpt file or main_func
-        :return:
+        :param file_path: local script path or download url
+        :param url_root: local directory of downloaded scripts, default BASE_DIR/media
+        :return: (file_name, content, checksum, cacheable), or None when script does not exist
         """
         if file_path.startswith("http://"):
             urlp = urlparse.urlparse(file_path)
-            content = file_path
-            file_name = urlp.path.split("/")[-1]
-            with open(os.path.join("/tmp", file_name), 'rb') as f:
-                file_content = f.read()
-            md5 = hashlib.md5()
-            md5.update(file_content)
-            checksum = md5.hexdigest()
+            if url_root:
+                file_name = urlp.path.split("/")[-1]
+            else:
+                file_name = urlp.path.split("/media/")[-1]
+            local_path = os.path.join(url_root or settings.BASE_DIR, file_name)
+            checksum = script_cache.get(local_path)[1]
+            # agent自行下载, 只发送地址
+            return file_name, file_path, checksum, False
         else:
             if not os.path.isfile(file_path):
                 return None
             file_name = os.path.split(file_path)[1]
+            content, checksum = script_cache.get(file_path)
+            return file_name, content, checksum, True
 
-            with open(file_path, 'rb') as f:
-                content = f.read()
+    def _run_script(self, func_name, script, **params):
+        """ send checksum first, upload content only when agent does not have the script
 
-            md5 = hashlib.md5()
-            md5.update(content)
-            checksum = md5.hexdigest()
+        :param func_name: remote function name which uploads content
+        :param script: (file_name, content, checksum, cacheable)
+        :param params: other params
+        :return: executed result
+        """
+        file_name, content, checksum, cacheable = script
+        if cacheable and checksum_supported(self.host, self.port):
+            result = self.remote_execute(func_name + "_by_checksum", name=file_name, checksum=checksum, **params)
+            if not self._script_missed(result):
+                return result
 
-        return self.remote_execute("run_script", name=file_name,
-                                   content=content, checksum=checksum,
-                                   main_func=main_func, json_args=json_args, sync=sync)
+        return self.remote_execute(func_name, name=file_name, content=content, checksum=checksum, **params)
 
-    def execute_script_async(self, file_path, main_func="", json_args=""):
+    def _script_missed(self, result):
+        if _is_unknown_method(result):
+            _checksum_unsupported[(self.host, self.port)] = time.time()
+            return True
+        if isinstance(result, dict) and result.get('status') == 'miss':
+            return True
+        return False
+
+    def execute_script(self, file_path, main_func="", json_args="", sync=True):
         """ execute script file on remote server
 
         :param file_path: local script path
@@ -113,30 +381,25 @@ class AgentClient(object):
         :param json_args: args string for scirpt file or main_func
         :return:
         """
-        if file_path.startswith("http://"):
-            urlp = urlparse.urlparse(file_path)
-            content = file_path
-            file_name = urlp.path.split("/media/")[-1]
-            with open(os.path.join(settings.BASE_DIR, file_name), 'rb') as f:
-                file_content = f.read()
-            md5 = hashlib.md5()
-            md5.update(file_content)
-            checksum = md5.hexdigest()
-        else:
-            if not os.path.isfile(file_path):
-                return None
-            file_name = os.path.split(file_path)[1]
+        script = self._script_file(file_path, url_root="/tmp")
+        if script is None:
+            return None
+
+        return self._run_script("run_script", script, main_func=main_func, json_args=json_args, sync=sync)
 
-            with open(file_path, 'rb') as f:
-                content = f.read()
+    def execute_script_async(self, file_path, main_func="", json_args=""):
+        """ execute script file on remote server
 
-            md5 = hashlib.md5()
-            md5.update(content)
-            checksum = md5.hexdigest()
+        :param file_path: local script path
+        :param main_func: main function, only work for python script
+        :param json_args: args string for scirpt file or main_func
+        :return:
+        """
+        script = self._script_file(file_path)
+        if script is None:
+            return None
 
-        return self.remote_execute("run_script_async", name=file_name,
-                                   content=content, checksum=checksum,
-                                   main_func=main_func, json_args=json_args)
+        return self._run_script("run_script_async", script, main_func=main_func, json_args=json_args)
 
     def scheduler_execute_script(self, file_path, scene_id="", parameter_id="", main_func="", script_args="",
                                  trigger_args="", report_url=""):
@@ -159,31 +422,13 @@ class AgentClient(object):
 
         cr_event = scene_id
         machine_id = parameter_id
-        if file_path.startswith("http://"):
-            urlp = urlparse.urlparse(file_path)
-            content = file_path
-            file_name = urlp.path.split("/media/")[-1]
-            with open(os.path.join(settings.BASE_DIR, file_name), 'rb') as f:
-                file_content = f.read()
-            md5 = hashlib.md5()
-            md5.update(file_content)
-            checksum = md5.hexdigest()
-        else:
-            if not os.path.isfile(file_path):
-                return None
-            file_name = os.path.split(file_path)[1]
+        script = self._script_file(file_path)
+        if script is None:
+            return None
 
-            with open(file_path, 'rb') as f:
-                content = f.read()
-
-            md5 = hashlib.md5()
-            md5.update(content)
-            checksum = md5.hexdigest()
-
-        return self.remote_execute("scheduler_run_script", cr_event=cr_event,
-                                   machine_id=machine_id, name=file_name, content=content,
-                                   checksum=checksum, main_func=main_func, script_args=script_args,
-                                   trigger_args=trigger_args, report_url=report_url)
+        return self._run_script("scheduler_run_script", script, cr_event=cr_event,
+                                machine_id=machine_id, main_func=main_func, script_args=script_args,
+                                trigger_args=trigger_args, report_url=report_url)
 
     def scheduler_job_action(self, cr_event, machine_id, action):
         """
@@ -195,3 +440,58 @@ class AgentClient(object):
         """
         return self.remote_execute("scheduler_job_action", cr_event=cr_event,
                                    machine_id=machine_id, action=action)
+
+
+class AgentBatch(AgentClient):
+    """ pipelined calls on one connection
+
+        with client.batch() as batch:
+            batch.version()
+            batch.scheduler_execute_script(...)
+        batch.results
+    """
+
+    def __init__(self, host=RPC_DEFAULT_HOST, port=RPC_DEFAULT_PORT):
+        super(AgentBatch, self).__init__(host, port)
+        self.calls = []
+        self.results = []
+
+    def remote_execute(self, func_name, **params):
+        if self.check_func(func_name):
+            self.calls.append((func_name, params, None))
+
+    # 按校验和执行的调用记录上传内容的备用调用, 未命中时在同一连接补发
+    def _run_script(self, func_name, script, **params):
+        file_name, content, checksum, cacheable = script
+        fallback = (func_name, dict(params, name=file_name, content=content, checksum=checksum))
+        if cacheable and checksum_supported(self.host, self.port):
+            self.calls.append((func_name + "_by_checksum", dict(params, name=file_name, checksum=checksum), fallback))
+        else:
+            self.calls.append(fallback + (None,))
+
+    def _pipeline(self, calls):
+        try:
+            results = agent_pool.execute(self.host, self.port,
+                                         lambda connection: connection.pipeline([call[:2] for call in calls]))
+            return [_load_result(result) for result in results]
+        except Exception as e:
+            return [{'status': "down", "message": e} for call in calls]
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        self.results = self._pipeline(calls) if calls else []
+
+        missed = [index for index, call in enumerate(calls)
+                  if call[2] and self._script_missed(self.results[index])]
+        if missed:
+            fallback_results = self._pipeline([calls[index][2] + (None,) for index in missed])
+            for index, result in zip(missed, fallback_results):
+                self.results[index] = result
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
@@ -1,24 +1,287 @@
+# -*- coding: utf-8 -*-
+import atexit
+import collections
 import cPickle as pickle
-import sched
+import heapq
+import itertools
+import logging
 import threading
 import time
 
+from django.conf import settings
 from django.core.cache import cache
+from django.db import connection, close_old_connections
 from base.utils.text import md5
 
 
-def async_exe(func, args=None, kwargs=None, delay=0):
-    args = args or ()
-    kwargs = kwargs or {}
+logger = logging.getLogger(__name__)
 
-    def tmp():
-        func(*args, **kwargs)
-    scheduler = sched.scheduler(time.time, time.sleep)
-    scheduler.enter(delay, 10, tmp, ())
-    thread = threading.Thread(target=scheduler.run)
-    thread.start()
 
-    return thread
+# 默认任务队列的并发数, 可在settings.TASK_QUEUES中按队列名覆盖
+DEFAULT_QUEUE_WORKERS = 32
+
+# 长时间轮询外部状态(镜像、快照等)的任务单独一个队列, 不占默认队列的线程
+POLL_QUEUE = 'poll'
+POLL_QUEUE_WORKERS = 64
+
+# 各进程定时输出任务运行时统计的间隔(秒), 可在settings.TASK_METRICS_LOG_SECONDS中覆盖, 0不输出
+METRICS_LOG_SECONDS = 300
+
+# 工作线程空闲退出时间
+WORKER_IDLE_SECONDS = 60
+
+# 统计耗时分位数的样本数
+LATENCY_SAMPLES = 1000
+
+
+class TaskHandle(object):
+
+    def __init__(self, func, args, kwargs, queue, run_at):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.queue = queue
+        self.run_at = run_at
+        self.cancelled = False
+        self.enqueue_time = None
+        self.start_time = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        # 已开始执行的任务无法取消
+        if self.start_time is not None or self.done:
+            return False
+        self.cancelled = True
+        get_task_runtime().discard(self)
+        return True
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.done
+
+
+class TaskQueue(object):
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.condition = threading.Condition()
+        self.tasks = collections.deque()
+        self.workers = 0
+        self.running = 0
+        self.stats = collections.Counter()
+        self.wait_times = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.run_times = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def put(self, task):
+        with self.condition:
+            if task.cancelled:
+                self.stats['cancelled'] += 1
+                task._done.set()
+                return
+            task.enqueue_time = time.time()
+            self.tasks.append(task)
+            self.stats['submitted'] += 1
+            idle = self.workers - self.running
+            if idle < len(self.tasks) and self.workers < self.max_workers:
+                self.workers += 1
+                thread = threading.Thread(target=self._work, name='task-%s-%s' % (self.name, self.workers))
+                thread.daemon = True
+                thread.start()
+            self.condition.notify()
+
+    def remove(self, task):
+        with self.condition:
+            try:
+                self.tasks.remove(task)
+            except ValueError:
+                return False
+            self.stats['cancelled'] += 1
+            task._done.set()
+            return True
+
+    def _work(self):
+        while True:
+            with self.condition:
+                if not self.tasks:
+                    self.condition.wait(WORKER_IDLE_SECONDS)
+                    if not self.tasks:
+                        self.workers -= 1
+                        return
+                task = self.tasks.popleft()
+                if task.cancelled:
+                    self.stats['cancelled'] += 1
+                    task._done.set()
+                    continue
+                task.start_time = time.time()
+                self.running += 1
+                self.wait_times.append(task.start_time - task.enqueue_time)
+
+            failed = False
+            try:
+                task.func(*task.args, **task.kwargs)
+            except Exception as e:
+                failed = True
+                logger.exception('task %s error: %s', getattr(task.func, '__name__', task.func), e)
+            finally:
+                close_old_connections()
+
+            with self.condition:
+                self.running -= 1
+                self.stats['failed' if failed else 'completed'] += 1
+                self.run_times.append(time.time() - task.start_time)
+            task._done.set()
+
+    def metrics(self):
+        with self.condition:
+            metrics = {
+                'workers': self.workers,
+                'max_workers': self.max_workers,
+                'queued': len(self.tasks),
+                'running': self.running,
+                'wait_seconds': _percentiles(self.wait_times),
+                'run_seconds': _percentiles(self.run_times),
+            }
+            metrics.update(self.stats)
+        return metrics
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {
+        'p%s' % percent: round(samples[min(len(samples) - 1, len(samples) * percent // 100)], 3)
+        for percent in (50, 90, 99)
+    }
+
+
+# 进程内统一的任务运行时: 延时任务放在一个定时堆里
+# 到期后进入命名队列, 由各队列有限的工作线程执行
+class TaskRuntime(object):
+
+    def __init__(self, queue_workers=None):
+        self.queue_workers = dict({POLL_QUEUE: POLL_QUEUE_WORKERS}, **(queue_workers or {}))
+        self._queues = {}
+        self._queues_lock = threading.Lock()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._timer_condition = threading.Condition()
+        self._timer_thread = None
+
+    def get_queue(self, name):
+        queue = self._queues.get(name)
+        if queue is None:
+            with self._queues_lock:
+                queue = self._queues.get(name)
+                if queue is None:
+                    queue = TaskQueue(name, self.queue_workers.get(name, DEFAULT_QUEUE_WORKERS))
+                    self._queues[name] = queue
+        return queue
+
+    # 各应用按自己的配置设置队列并发数, settings.TASK_QUEUES中的配置优先
+    def configure_queue(self, name, max_workers):
+        with self._queues_lock:
+            self.queue_workers.setdefault(name, max_workers)
+            queue = self._queues.get(name)
+            if queue is not None:
+                queue.max_workers = max(1, self.queue_workers[name])
+
+    def submit(self, func, args=None, kwargs=None, delay=0, queue='default'):
+        task = TaskHandle(func, args or (), kwargs or {}, queue, time.time() + max(delay, 0))
+        if delay > 0:
+            with self._timer_condition:
+                heapq.heappush(self._timers, (task.run_at, next(self._timer_seq), task))
+                if self._timer_thread is None:
+                    self._timer_thread = threading.Thread(target=self._run_timers, name='task-timer')
+                    self._timer_thread.daemon = True
+                    self._timer_thread.start()
+                self._timer_condition.notify()
+        else:
+            self.get_queue(queue).put(task)
+        return task
+
+    def discard(self, task):
+        if self.get_queue(task.queue).remove(task):
+            return
+        # 还在定时堆里的任务到期时跳过
+        with self._timer_condition:
+            self._timer_condition.notify()
+
+    def _run_timers(self):
+        while True:
+            with self._timer_condition:
+                while True:
+                    while self._timers and self._timers[0][2].cancelled:
+                        task = heapq.heappop(self._timers)[2]
+                        task._done.set()
+                        self.get_queue(task.queue).stats['cancelled'] += 1
+                    if not self._timers:
+                        self._timer_condition.wait()
+                        continue
+                    timeout = self._timers[0][0] - time.time()
+                    if timeout <= 0:
+                        break
+                    self._timer_condition.wait(timeout)
+                task = heapq.heappop(self._timers)[2]
+            self.get_queue(task.queue).put(task)
+
+    # 进程退出时等待全部任务(含未到期的延时任务)执行完, 与原来非守护线程的行为一致
+    def join(self, poll_interval=0.1):
+        while True:
+            with self._timer_condition:
+                timers = any(not timer[2].cancelled for timer in self._timers)
+            busy = any(queue.tasks or queue.running for queue in self._queues.values())
+            if not timers and not busy:
+                return
+            time.sleep(poll_interval)
+
+    def metrics(self):
+        with self._timer_condition:
+            timers = len(self._timers)
+        return {
+            'timers': timers,
+            'queues': {name: queue.metrics() for name, queue in self._queues.items()},
+        }
+
+    # 守护线程定时记录统计, 不经过定时堆, 不影响退出时的join
+    def start_metrics_log(self, interval):
+        def log_metrics():
+            while True:
+                time.sleep(interval)
+                try:
+                    logger.info('task runtime metrics: %s', self.metrics())
+                except Exception as e:
+                    logger.error('task runtime metrics error: %s', e)
+
+        thread = threading.Thread(target=log_metrics, name='task-metrics')
+        thread.daemon = True
+        thread.start()
+
+
+_task_runtime = None
+_task_runtime_lock = threading.Lock()
+
+
+def get_task_runtime():
+    global _task_runtime
+    if _task_runtime is None:
+        with _task_runtime_lock:
+            if _task_runtime is None:
+                _task_runtime = TaskRuntime(getattr(settings, 'TASK_QUEUES', None))
+                atexit.register(_task_runtime.join)
+                metrics_log_seconds = getattr(settings, 'TASK_METRICS_LOG_SECONDS', METRICS_LOG_SECONDS)
+                if metrics_log_seconds:
+                    _task_runtime.start_metrics_log(metrics_log_seconds)
+    return _task_runtime
+
+
+def async_exe(func, args=None, kwargs=None, delay=0, queue='default'):
+    return get_task_runtime().submit(func, args, kwargs, delay=delay, queue=queue)
 
 
 def async_exe_once(func, args=None, kwargs=None, delay=0, timeout=3):
@@ -38,3 +301,98 @@ def _exe_key(func, args, kwargs):
     ))
 
     return exe_key
+
+
+# 有依赖关系的任务图, 用有限的线程并发执行互不依赖的任务
+class TaskGraph(object):
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max(1, max_workers)
+        self._tasks = {}
+        self._order = []
+
+    def add(self, key, func, args=None, kwargs=None, deps=None):
+        if key in self._tasks:
+            raise ValueError('duplicate task: %s' % (key,))
+        self._tasks[key] = {
+            'func': func,
+            'args': args or (),
+            'kwargs': kwargs or {},
+            'deps': set(deps or ()),
+        }
+        self._order.append(key)
+        return key
+
+    def run(self):
+        tasks = self._tasks
+        for key in self._order:
+            missing = tasks[key]['deps'] - set(tasks.keys())
+            if missing:
+                raise ValueError('task %s depends on unknown tasks: %s' % (key, list(missing)))
+
+        pending = {key: len(tasks[key]['deps']) for key in self._order}
+        dependents = {}
+        for key in self._order:
+            for dep in tasks[key]['deps']:
+                dependents.setdefault(dep, []).append(key)
+
+        ready = [key for key in self._order if not pending[key]]
+        if self._order and not ready:
+            raise ValueError('task graph has a cycle')
+
+        state = {
+            'running': 0,
+            'done': 0,
+            'error': None,
+        }
+        results = {}
+        condition = threading.Condition()
+
+        def worker():
+            try:
+                while True:
+                    with condition:
+                        while not ready and state['error'] is None and state['running']:
+                            condition.wait()
+                        if state['error'] is not None or not ready:
+                            return
+                        key = ready.pop(0)
+                        state['running'] += 1
+
+                    task = tasks[key]
+                    try:
+                        result = task['func'](*task['args'], **task['kwargs'])
+                    except Exception as e:
+                        logger.exception('task %s error: %s', key, e)
+                        with condition:
+                            state['running'] -= 1
+                            if state['error'] is None:
+                                state['error'] = e
+                            condition.notify_all()
+                        return
+
+                    with condition:
+                        results[key] = result
+                        state['running'] -= 1
+                        state['done'] += 1
+                        for dependent in dependents.get(key, []):
+                            pending[dependent] -= 1
+                            if not pending[dependent]:
+                                ready.append(dependent)
+                        condition.notify_all()
+            finally:
+                connection.close()
+
+        threads = []
+        for i in range(min(self.max_workers, len(tasks))):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if state['error'] is not None:
+            raise state['error']
+        if state['done'] < len(tasks):
+            raise ValueError('task graph has a cycle')
+        return results
@@ -1,13 +1,33 @@
+# -*- coding: utf-8 -*-
 
+from django.core.cache import cache
+
+from base.utils.text import md5
 from base.utils.websocket.base import Websocket
 
 from base_auth.models import User
 
 
+# 用户记录的连接数上限
+MAX_USER_CHANNELS = 20
+# 广播组成员和用户订阅记录的有效期(秒), 与channel layer的group_expiry一致
+GROUP_TIMEOUT = 86400
+
+
 class UserWebsocket(Websocket):
 
     def get_connection_groups(self, message, **kwargs):
-        return [self.user_group_name(message.user)]
+        return [self.user_group_name(message.user)] + self.get_user_subscriptions(message.user)
+
+    def connect(self, message, **kwargs):
+        super(UserWebsocket, self).connect(message, **kwargs)
+        if message.user.is_authenticated:
+            self._update_user_channels(message.user, add=message.reply_channel.name)
+
+    def disconnect(self, message, **kwargs):
+        super(UserWebsocket, self).disconnect(message, **kwargs)
+        if message.user.is_authenticated:
+            self._update_user_channels(message.user, discard=message.reply_channel.name)
 
     @classmethod
     def user_group_name(cls, user):
@@ -27,3 +47,61 @@ class UserWebsocket(Websocket):
 
         for usr in users:
             cls.group_send(cls.user_group_name(usr), content, close=close, code=code)
+
+    @classmethod
+    def _cache_key(cls, kind, name):
+        return md5('%s:%s:%s' % (cls.group_prefix(), kind, name))
+
+    @classmethod
+    def _user_id(cls, user):
+        return user.id if isinstance(user, User) else user
+
+    @classmethod
+    def get_user_subscriptions(cls, user):
+        return list(cache.get(cls._cache_key('subscriptions', cls._user_id(user))) or [])
+
+    @classmethod
+    def get_user_channels(cls, user):
+        return list(cache.get(cls._cache_key('channels', cls._user_id(user))) or [])
+
+    @classmethod
+    def _update_user_channels(cls, user, add=None, discard=None):
+        key = cls._cache_key('channels', cls._user_id(user))
+        channels = [channel for channel in cache.get(key) or [] if channel not in (add, discard)]
+        if add:
+            channels.append(add)
+        cache.set(key, channels[-MAX_USER_CHANNELS:], None)
+
+    # 设置广播组成员, 组内用户的连接(含之后新建的连接)都会加入该组
+    # 组成员在channel layer中会过期(asgi_redis默认group_expiry一天), 每次设置都重新加入当前连接
+    @classmethod
+    def set_group_users(cls, name, users, timeout=GROUP_TIMEOUT):
+        members_key = cls._cache_key('members', name)
+        old_users = set(cache.get(members_key) or [])
+        users = set(cls._user_id(user) for user in users)
+
+        group = cls.get_group(name)
+        for user_id in users:
+            cls._update_user_subscriptions(user_id, add=name, timeout=timeout)
+            for channel in cls.get_user_channels(user_id):
+                group.add(channel)
+
+        for user_id in old_users - users:
+            cls._update_user_subscriptions(user_id, discard=name, timeout=timeout)
+            for channel in cls.get_user_channels(user_id):
+                group.discard(channel)
+
+        if users:
+            cache.set(members_key, list(users), timeout)
+        else:
+            cache.delete(members_key)
+
+    @classmethod
+    def _update_user_subscriptions(cls, user_id, add=None, discard=None, timeout=GROUP_TIMEOUT):
+        subscriptions_key = cls._cache_key('subscriptions', user_id)
+        subscriptions = set(cache.get(subscriptions_key) or [])
+        if add:
+            subscriptions.add(add)
+        if discard:
+            subscriptions.discard(discard)
+        cache.set(subscriptions_key, list(subscriptions), timeout)
@@ -2,7 +2,7 @@
 import json
 import logging
 
-from base.utils.thread import async_exe
+from base.utils.thread import async_exe, POLL_QUEUE
 from base_cloud.complex.views import BaseScene
 
 logger = logging.getLogger(__name__)
@@ -54,7 +54,7 @@ class Image(object):
             raise Exception('param error: no resource for creating image')
 
         if created or failed:
-            async_exe(self.operator.check_image_status, (image.id, check_type, created, failed))
+            async_exe(self.operator.check_image_status, (image.id, check_type, created, failed), queue=POLL_QUEUE)
 
         return image
 
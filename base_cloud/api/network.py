@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import random
 
+from base_cloud.complex import fip_pool
 from base_cloud.complex.views import BaseScene
 
 from .utils import str_filter
@@ -108,9 +109,17 @@ class Network(object):
 
     def clean_used_fips(self, pre_fips):
         self.operator.clean_used_fips(pre_fips)
+        self.operator.fip_pool.release(pre_fips.values())
+
+    def register_fips_in_use(self, func):
+        return fip_pool.register_in_use(func)
+
+    def fip_pool_metrics(self):
+        return self.operator.fip_pool.metrics()
 
     def delete_fip(self, fip_id):
         self.operator.delete_fip(fip_id)
+        self.operator.fip_pool.release([fip_id])
 
     def delete_port(self, port_id):
         self.operator.delete_port(port_id)
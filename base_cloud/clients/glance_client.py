@@ -10,14 +10,13 @@ from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.files.uploadedfile import TemporaryUploadedFile
 
-from keystoneauth1.identity import v3
-from keystoneauth1 import session
 import glanceclient
 
 try:
     from base_cloud import app_settings
 except Exception:
     pass
+from base_cloud.clients.session import get_session
 from base_cloud.utils import get_ip_by_hostname, \
     is_uuid_like, get_local_hostname
 from base.utils.ssh import ssh
@@ -29,15 +28,7 @@ VERSIONS = '2'
 
 class Client(object):
     def __init__(self, **kwargs):
-        auth = v3.Password(
-                auth_url=kwargs.get("auth_url") or app_settings.OS_AUTH.get("auth_url"),
-                username=kwargs.get("username") or app_settings.OS_AUTH.get("username"),
-                password=kwargs.get("password") or app_settings.OS_AUTH.get("password"),
-                project_name=kwargs.get("project_name") or app_settings.OS_AUTH.get("project_name"),
-                user_domain_id=kwargs.get("user_domain_id") or app_settings.OS_AUTH.get("user_domain_id"),
-                project_domain_id=kwargs.get("project_domain_id") or app_settings.OS_AUTH.get("project_domain_id")
-        )
-        sess = session.Session(auth=auth)
+        sess = get_session(**kwargs)
         self.glance_client = glanceclient.Client(version=VERSIONS,
                                                  session=sess)
 
@@ -5,14 +5,13 @@ import functools
 import logging
 import uuid
 
-from keystoneauth1.identity import v3
-from keystoneauth1 import session
 from neutronclient.v2_0 import client
 
 try:
     from base_cloud import app_settings
 except Exception:
     pass
+from base_cloud.clients.session import get_session
 
 
 LOG = logging.getLogger(__name__)
@@ -48,15 +47,7 @@ class Client(object):
     }
 
     def __init__(self, **kwargs):
-        auth = v3.Password(
-                auth_url=kwargs.get("auth_url") or app_settings.OS_AUTH.get("auth_url"),
-                username=kwargs.get("username") or app_settings.OS_AUTH.get("username"),
-                password=kwargs.get("password") or app_settings.OS_AUTH.get("password"),
-                project_name=kwargs.get("project_name") or app_settings.OS_AUTH.get("project_name"),
-                user_domain_id=kwargs.get("user_domain_id") or app_settings.OS_AUTH.get("user_domain_id"),
-                project_domain_id=kwargs.get("project_domain_id") or app_settings.OS_AUTH.get("project_domain_id")
-        )
-        sess = session.Session(auth=auth)
+        sess = get_session(**kwargs)
         self.neutron_client = client.Client(session=sess)
 
     def _get_tenant_id(self):
@@ -269,6 +260,16 @@ class Client(object):
         body['port'].update(kwargs)
         return self.neutron_client.create_port(body=body).get('port')
 
+    def port_create_bulk(self, ports):
+        LOG.debug("port_create_bulk(): ports=%s" % ports)
+        body = {'ports': []}
+        for port in ports:
+            port = dict(port)
+            if 'policy_profile_id' in port:
+                port['n1kv:profile'] = port.pop('policy_profile_id')
+            body['ports'].append(unescape_port_kwargs(**port))
+        return self.neutron_client.create_port(body=body).get('ports')
+
     def port_get(self, port_id, **params):
         LOG.debug("port_get(): portid=%(port_id)s, params=%(params)s",
                   {'port_id': port_id, 'params': params})
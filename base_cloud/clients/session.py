@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+from keystoneauth1.identity import v3
+from keystoneauth1 import session
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from base_cloud import app_settings
+except Exception:
+    pass
+
+
+CREDENTIAL_FIELDS = (
+    'auth_url',
+    'username',
+    'password',
+    'project_name',
+    'user_domain_id',
+    'project_domain_id',
+)
+
+
+# 同一组认证信息共用的keystone session: 连接池复用http连接,
+# token在剩余有效期小于OS_TOKEN_REFRESH_SECONDS时由keystoneauth在get_token()中重新获取
+class SharedSession(object):
+
+    def __init__(self, credentials):
+        self.auth = v3.Password(**credentials)
+        self.auth.MIN_TOKEN_LIFE_SECONDS = app_settings.OS_TOKEN_REFRESH_SECONDS
+        http_session = requests.Session()
+        pool_size = app_settings.OS_SESSION_POOL_SIZE
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        http_session.mount('http://', adapter)
+        http_session.mount('https://', adapter)
+        self.session = session.Session(auth=self.auth, session=http_session)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_credentials(**kwargs):
+    return tuple((field, kwargs.get(field) or app_settings.OS_AUTH.get(field)) for field in CREDENTIAL_FIELDS)
+
+
+def get_session(**kwargs):
+    credentials = get_credentials(**kwargs)
+    shared = _sessions.get(credentials)
+    if shared is None:
+        with _sessions_lock:
+            shared = _sessions.get(credentials)
+            if shared is None:
+                shared = SharedSession(dict(credentials))
+                _sessions[credentials] = shared
+    return shared.session
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from base.utils.thread import async_exe
+from base_cloud import app_settings
+from base_cloud.complex.metadata import flavor_index, image_index
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CapacitySnapshot(object):
+
+    def __init__(self, allowance, flavors, images, refresh_time=None):
+        # (vcpus, memory_size, disk_size, fips)
+        self.allowance = allowance
+        # name -> (vcpus, ram, disk)
+        self.flavors = flavors
+        # name -> min_disk
+        self.images = images
+        # 开始读取openstack的时间, 之后释放的预分配还没有反映在allowance中
+        self.refresh_time = refresh_time or time.time()
+
+    @property
+    def staleness(self):
+        return time.time() - self.refresh_time
+
+
+# 进程内资源容量模型: 计算节点、外网ip、规格、镜像后台定时刷新, 准入检查直接读内存
+class CapacityModel(object):
+
+    def __init__(self, refresh_seconds=None, max_staleness=None):
+        self.refresh_seconds = refresh_seconds or app_settings.CAPACITY_REFRESH_SECONDS
+        self.max_staleness = max_staleness or app_settings.CAPACITY_MAX_STALENESS
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self, operator):
+        with self._refresh_lock:
+            refresh_time = time.time()
+            allowance = operator._calculate_allowance()
+            flavors = {flavor.name: (flavor.vcpus, flavor.ram, flavor.disk) for flavor in flavor_index.items(operator)}
+            images = {image.name: getattr(image, "min_disk", 0) for image in image_index.items(operator)
+                      if image.status.lower() == "active"}
+            self._snapshot = CapacitySnapshot(allowance, flavors, images, refresh_time)
+            LOG.debug("Refreshed capacity model: {}".format(allowance))
+            return self._snapshot
+
+    def _background_refresh(self, operator):
+        try:
+            self.refresh(operator)
+        except Exception as e:
+            LOG.error("Refresh capacity model error: {}".format(e))
+        finally:
+            self._refreshing = False
+
+    def snapshot(self, operator):
+        snapshot = self._snapshot
+        # 超过最大过期时间同步刷新, 超过刷新间隔后台刷新并先用旧数据
+        if snapshot is None or snapshot.staleness > self.max_staleness:
+            return self.refresh(operator)
+        if snapshot.staleness > self.refresh_seconds and not self._refreshing:
+            self._refreshing = True
+            async_exe(self._background_refresh, (operator,))
+        return snapshot
+
+    def invalidate(self):
+        self._snapshot = None
+
+
+capacity_model = CapacityModel()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import random
+import time
+
+from django.utils.translation import ugettext as _
+
+from base.utils.thread import async_exe
+from base_cloud import app_settings
+
+
+LOG = logging.getLogger(__name__)
+
+
+FIP_POOL_KEY = "fip_pool"
+FIP_CLAIM_KEY = "fip_pool_claim_%s"
+FIP_REFILL_RUNNING_KEY = "fip_pool_refilling"
+FIP_REFILL_REQUESTED_KEY = "fip_pool_refill_requested"
+FIP_STAT_KEY = "fip_pool_stat_%s"
+FIP_REFILL_LAG_KEY = "fip_pool_refill_lag"
+PREALLOCATED_FIPS_KEY = "preallocated_fips"
+
+# 补充任务的最长执行时间(秒), 超时后允许其它进程接手
+REFILL_EXPIRES = 300
+
+
+_in_use_providers = []
+
+
+# 登记返回正在使用的浮动ip地址的函数, 补充预热池时排除这些ip
+def register_in_use(func):
+    _in_use_providers.append(func)
+    return func
+
+
+def _in_use_addresses():
+    addresses = set()
+    for func in _in_use_providers:
+        addresses.update(func())
+    return addresses
+
+
+# 浮动ip预热池: 空闲ip列表放在memcache, 分配时逐个add占用标记, 不需要全局锁
+# 占用标记不过期, ip删除或显式释放时才清除
+class FloatingIPPool(object):
+
+    def __init__(self, operator, watermark=None):
+        self.operator = operator
+        self.mc = operator.mc
+        self.watermark = app_settings.FIP_POOL_WATERMARK if watermark is None else watermark
+
+    def _claim(self, fip_id):
+        return self.mc.add(str(FIP_CLAIM_KEY % fip_id), 1, 0)
+
+    def _incr(self, name, delta=1):
+        key = str(FIP_STAT_KEY % name)
+        if delta and self.mc.incr(key, delta) is None:
+            # 计数不存在时先创建, 并发创建失败时再累加
+            if not self.mc.add(key, delta, 0):
+                self.mc.incr(key, delta)
+
+    def claim(self, count):
+        pre_fips = {}
+        fips = (self.mc.get(FIP_POOL_KEY) or {}).items()
+        # 打散顺序, 减少并发分配时争抢同一个ip
+        random.shuffle(fips)
+        for fip_addr, fip_id in fips:
+            if len(pre_fips) >= count:
+                break
+            if self._claim(fip_id):
+                pre_fips[fip_addr] = fip_id
+        hits = len(pre_fips)
+
+        # 池中不够时直接创建
+        while len(pre_fips) < count:
+            fip = self.operator.create_fip()
+            if not fip:
+                self.operator._handle_error(_("Unable to get floating ip."))
+            self._claim(fip.get("id"))
+            pre_fips[fip.get("floating_ip_address")] = fip.get("id")
+
+        self._incr('hits', hits)
+        self._incr('misses', count - hits)
+        LOG.debug("Claimed fips {} from pool, hits {}/{}".format(pre_fips, hits, count))
+        self.request_refill()
+        return pre_fips
+
+    # 指定地址的ip也打上占用标记, 避免被预热池分走
+    def claim_fips(self, pre_fips):
+        for fip_id in pre_fips.values():
+            self._claim(fip_id)
+
+    def release(self, fip_ids):
+        self.mc.delete_multi([str(fip_id) for fip_id in fip_ids], key_prefix=str(FIP_CLAIM_KEY % ''))
+
+    def request_refill(self):
+        self.mc.add(FIP_REFILL_REQUESTED_KEY, time.time(), 0)
+        async_exe(self.refill)
+
+    def refill(self):
+        # 同时只有一个补充任务, 其它请求直接跳过
+        if not self.mc.add(FIP_REFILL_RUNNING_KEY, 1, REFILL_EXPIRES):
+            return
+        try:
+            requested_time = self.mc.get(FIP_REFILL_REQUESTED_KEY)
+            self.mc.delete(FIP_REFILL_REQUESTED_KEY)
+
+            # 已预分配和场景中记录的ip即使还没绑定也不能再分出去
+            exclude_list = set(self.mc.get(PREALLOCATED_FIPS_KEY) or {}) | _in_use_addresses()
+            avail_fips = self.operator.load_available_fips_dict(exclude_list=exclude_list)
+            claimed = self.mc.get_multi([str(fip_id) for fip_id in avail_fips.values()],
+                                        key_prefix=str(FIP_CLAIM_KEY % ''))
+            fips = {fip_addr: fip_id for fip_addr, fip_id in avail_fips.items() if fip_id not in claimed}
+            for i in range(self.watermark - len(fips)):
+                fip = self.operator.create_fip()
+                if fip:
+                    fips[fip.get("floating_ip_address")] = fip.get("id")
+            self.mc.set(FIP_POOL_KEY, fips)
+
+            self._incr('refills')
+            if requested_time:
+                self.mc.set(FIP_REFILL_LAG_KEY, time.time() - requested_time)
+            LOG.debug("Refilled fip pool to {}".format(len(fips)))
+        except Exception as e:
+            LOG.error("Refill fip pool error: {}".format(e))
+        finally:
+            self.mc.delete(FIP_REFILL_RUNNING_KEY)
+
+    def metrics(self):
+        fips = self.mc.get(FIP_POOL_KEY) or {}
+        claimed = self.mc.get_multi([str(fip_id) for fip_id in fips.values()],
+                                    key_prefix=str(FIP_CLAIM_KEY % '')) if fips else {}
+        stats = self.mc.get_multi(['hits', 'misses', 'refills'], key_prefix=str(FIP_STAT_KEY % ''))
+        requested_time = self.mc.get(FIP_REFILL_REQUESTED_KEY)
+        return {
+            'size': len(fips) - len(claimed),
+            'watermark': self.watermark,
+            'hits': int(stats.get('hits') or 0),
+            'misses': int(stats.get('misses') or 0),
+            'refills': int(stats.get('refills') or 0),
+            'last_refill_lag': self.mc.get(FIP_REFILL_LAG_KEY),
+            'refill_pending_seconds': time.time() - requested_time if requested_time else 0,
+        }
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+import uuid
+
+
+LOG = logging.getLogger(__name__)
+
+
+RESERVATION_KEY = "preallocated_resource_%s"
+RELEASED_KEY = "preallocated_released_%s"
+COUNTER_KEY = "preallocated_total_%s_%s"
+CONSUMED_KEY = "preallocated_consumed_%s_%s"
+
+FIELDS = ("vcpus", "memory_size", "disk_size", "fips")
+
+# 预分配有效期(秒)
+RESERVATION_TIMEOUT = 3600
+# 合计计数按时间分桶, 桶过期后其中已过期的预分配自然不再计入
+BUCKET_SECONDS = 300
+# 已释放(资源已被实际占用)的预分配按释放时间分桶, 保留到各进程的容量快照都刷新过
+CONSUMED_BUCKET_SECONDS = 10
+CONSUMED_TIMEOUT = 60
+
+
+# 预分配资源账本: 每个预分配单独一个带过期时间的key, 合计用原子计数
+class PreallocatedLedger(object):
+
+    def __init__(self, mc, timeout=RESERVATION_TIMEOUT, bucket_seconds=BUCKET_SECONDS,
+                 consumed_timeout=CONSUMED_TIMEOUT, consumed_bucket_seconds=CONSUMED_BUCKET_SECONDS):
+        self.mc = mc
+        self.timeout = timeout
+        self.bucket_seconds = bucket_seconds
+        self.consumed_timeout = consumed_timeout
+        self.consumed_bucket_seconds = consumed_bucket_seconds
+
+    def _counter_key(self, field, bucket):
+        return str(COUNTER_KEY % (field, bucket))
+
+    def _consumed_key(self, field, bucket):
+        return str(CONSUMED_KEY % (field, bucket))
+
+    def _live_buckets(self):
+        current = int(time.time() // self.bucket_seconds)
+        return range(current - self.timeout // self.bucket_seconds, current + 1)
+
+    def _add(self, field, bucket, value):
+        self._add_counter(self._counter_key(field, bucket), value, self.timeout + self.bucket_seconds)
+
+    def _add_counter(self, key, value, expires):
+        if not value:
+            return
+        if value > 0:
+            if self.mc.incr(key, value) is None and not self.mc.add(key, value, expires):
+                self.mc.incr(key, value)
+        else:
+            self.mc.decr(key, -value)
+
+    def reserve(self, locker_id, **amounts):
+        # 同一个locker重复预分配时替换之前的
+        self.release(locker_id)
+        bucket = int(time.time() // self.bucket_seconds)
+        data = {field: amounts.get(field, 0) for field in FIELDS}
+        # 每次预分配一个标识, 释放时按标识判重
+        self.mc.set(str(RESERVATION_KEY % locker_id), dict(data, bucket=bucket, token=uuid.uuid4().hex), self.timeout)
+        for field in FIELDS:
+            self._add(field, bucket, data[field])
+        return data
+
+    def release(self, locker_id, consumed=False):
+        key = str(RESERVATION_KEY % locker_id)
+        data = self.mc.get(key)
+        if not data:
+            return None
+        # 并发释放同一个预分配时, 只有add成功的一方扣减计数
+        token = data.get("token") or "{}_{}".format(locker_id, data["bucket"])
+        if not self.mc.add(str(RELEASED_KEY % token), 1, self.timeout):
+            return None
+        self.mc.delete(key)
+        for field in FIELDS:
+            self._add(field, data["bucket"], -data[field])
+        # 资源已被场景占用, 在容量快照反映之前仍计入合计
+        if consumed:
+            bucket = int(time.time() // self.consumed_bucket_seconds)
+            for field in FIELDS:
+                self._add_counter(self._consumed_key(field, bucket), data[field],
+                                  self.consumed_timeout + self.consumed_bucket_seconds)
+        return data
+
+    # 从since所在的分桶起已释放的预分配合计, 偏多不偏少
+    def consumed_since(self, since):
+        current = int(time.time() // self.consumed_bucket_seconds)
+        first = max(int(since // self.consumed_bucket_seconds),
+                    current - self.consumed_timeout // self.consumed_bucket_seconds)
+        buckets = range(first, current + 1)
+        counters = self.mc.get_multi([self._consumed_key(field, bucket) for field in FIELDS for bucket in buckets])
+        consumed = dict.fromkeys(FIELDS, 0)
+        for field in FIELDS:
+            for bucket in buckets:
+                consumed[field] += int(counters.get(self._consumed_key(field, bucket)) or 0)
+        return consumed
+
+    def totals(self):
+        keys = [self._counter_key(field, bucket) for field in FIELDS for bucket in self._live_buckets()]
+        counters = self.mc.get_multi(keys)
+        totals = dict.fromkeys(FIELDS, 0)
+        for field in FIELDS:
+            for bucket in self._live_buckets():
+                totals[field] += int(counters.get(self._counter_key(field, bucket)) or 0)
+        return totals
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+
+from base_cloud import app_settings
+
+
+LOG = logging.getLogger(__name__)
+
+
+# 进程内的镜像/规格索引: 按名称查找直接读内存
+# 定时增量刷新, 本进程或其它进程修改后通过版本号通知全量重建
+class MetadataIndex(object):
+    version_key = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._version = None
+        self._last_check = 0
+        self._last_poll = 0
+        self._last_full = 0
+        self._since = None
+
+    def _load_all(self, operator):
+        raise NotImplementedError('implement in sub class')
+
+    # 返回变化的对象, 不支持增量时返回None
+    def _load_changed(self, operator, since):
+        return None
+
+    def _updated_at(self, item):
+        return None
+
+    def _index(self, items, full):
+        index = {} if full else dict(self._items)
+        since = None if full else self._since
+        for item in items:
+            index[item.name] = item
+            updated_at = self._updated_at(item)
+            if updated_at and (not since or updated_at > since):
+                since = updated_at
+        self._items = index
+        self._since = since
+
+    def refresh(self, operator, full=True):
+        with self._lock:
+            now = time.time()
+            items = None
+            if not full:
+                try:
+                    items = self._load_changed(operator, self._since)
+                except Exception as e:
+                    LOG.warning("Load changes of {} error: {}".format(self.__class__.__name__, e))
+            if items is None:
+                full = True
+                # 先取版本号, 加载期间的修改在下次检查时再重建
+                self._version = cache.get(self.version_key)
+                self._last_check = now
+                items = self._load_all(operator)
+                self._last_full = now
+            self._index(items, full)
+            self._last_poll = now
+        LOG.debug("Refreshed {} ({})".format(self.__class__.__name__, "full" if full else "changes"))
+
+    def ensure(self, operator):
+        now = time.time()
+        full = not self._last_full or now - self._last_full > app_settings.METADATA_FULL_REFRESH_SECONDS
+        if not full and now - self._last_check > app_settings.METADATA_CHECK_SECONDS:
+            self._last_check = now
+            version = cache.get(self.version_key)
+            if version != self._version:
+                self._version = version
+                full = True
+        if full:
+            self.refresh(operator, full=True)
+        elif now - self._last_poll > app_settings.METADATA_POLL_SECONDS:
+            self.refresh(operator, full=False)
+
+    def get(self, operator, name):
+        self.ensure(operator)
+        item = self._items.get(name)
+        # 索引中没有时立即拉一次变化
+        if item is None and time.time() - self._last_poll > 1:
+            self.refresh(operator, full=False)
+            item = self._items.get(name)
+        return item
+
+    def items(self, operator):
+        self.ensure(operator)
+        return self._items.values()
+
+    # 通知所有进程重建索引
+    def invalidate(self):
+        self._last_full = 0
+        if not cache.add(self.version_key, 1, None):
+            try:
+                cache.incr(self.version_key)
+            except ValueError:
+                cache.set(self.version_key, 1, None)
+
+
+class ImageIndex(MetadataIndex):
+    version_key = 'metadata_index_images_version'
+
+    def _load_all(self, operator):
+        return list(operator.list_image())
+
+    def _load_changed(self, operator, since):
+        if not since:
+            return None
+        return list(operator.list_image(filters={'updated_at': 'gt:{}'.format(since)}))
+
+    def _updated_at(self, item):
+        return getattr(item, 'updated_at', None)
+
+
+class FlavorIndex(MetadataIndex):
+    version_key = 'metadata_index_flavors_version'
+
+    def _load_all(self, operator):
+        return list(operator.list_flavor())
+
+
+image_index = ImageIndex()
+flavor_index = FlavorIndex()
@@ -18,6 +18,10 @@ from django.utils.translation import ugettext as _
 
 from base.utils.functional import cached_property
 from base_cloud.clients import docker_client
+from base_cloud.complex.capacity import capacity_model
+from base_cloud.complex.fip_pool import FloatingIPPool, PREALLOCATED_FIPS_KEY
+from base_cloud.complex.ledger import PreallocatedLedger
+from base_cloud.complex.metadata import flavor_index, image_index
 from base_cloud.compute.views import InstanceAction
 from base_cloud.docker.views import ContainerAction
 from base_cloud.image.views import ImageAction
@@ -53,12 +57,8 @@ USED_CIDR_KEY = "used_cidrs"
 ALL_CIDR_KEY = "all_cidrs"
 AVAILABLE_CIDR_KEY = "available_cidrs"
 AVAILABLE_FIPS_KEY = "avialable_fips"
-PREALLOCATED_FIPS_KEY = "preallocated_fips"
 HYPERVISOR_KEY = "openstack_hypervisors"
-PREALLOCATED_RESOURCES = "preallocated_resources"
 MEMCACHE_LOCKER_KEY = "memcache_locker"
-IMAGES_CACHE_KEY = "glance_all_images"
-FLAVORS_CACHE_KEY = "nova_all_flavors"
 IMAGE_FOLDER = project_utils.glance_image_dir() or \
                app_settings.COMPLEX_MISC.get("glance_image_dir")
 CPU_RATIO = float(project_utils.get_nova_config("DEFAULT", "cpu_allocation_ratio") or
@@ -109,6 +109,15 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
     def mc(self):
         return memcache.Client(app_settings.COMPLEX_MISC.get("memcache_host"))
 
+    @cached_property
+    def fip_pool(self):
+        return FloatingIPPool(self)
+
+    @cached_property
+    def preallocated_ledger(self):
+        return PreallocatedLedger(self.mc, consumed_timeout=capacity_model.max_staleness,
+                                  consumed_bucket_seconds=capacity_model.refresh_seconds)
+
     def _handle_error(self, err_msg=None, e=None):
         if not err_msg:
             err_msg = _("Unknown error occurred, Please try again later.")
@@ -118,32 +127,17 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
         raise FriendlyException(err_msg)
 
     def update_image_cache(self, imgs=None):
-        if not imgs:
-            imgs = self.list_image()
-
-        img_dict = {}
-        for img in imgs:
-            img_dict.update({img.name: img.id})
-        LOG.debug("update image cache: {}".format(img_dict))
-        self.mc.set(IMAGES_CACHE_KEY, img_dict, 86400)
-        return img_dict
+        image_index.invalidate()
+        image_index.refresh(self)
 
     def _get_image_from_cache(self, image_name):
-        # get image from memcache
-        imgs = self.mc.get(IMAGES_CACHE_KEY)
-        if imgs and imgs.get(image_name):
-            img = self.get_image(id=imgs.get(image_name))
-            if img and img.status.lower() == "active":
-                return img
-
-        # get image from openstack
-        imgs = self.list_image()
-        imgs = self.update_image_cache(imgs)
-        if imgs and imgs.get(image_name):
-            img = self.get_image(id=imgs.get(image_name))
-            if img and img.status.lower() == "active":
-                return img
-
+        # get image from local index
+        img = image_index.get(self, image_name)
+        if img and img.status.lower() != "active":
+            # status may be changed since last refresh
+            img = self.get_image(id=img.id)
+        if img and img.status.lower() == "active":
+            return img
         return None
 
     def _get_image(self, image_name, snapshot=None):
@@ -207,31 +201,12 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
         return False
 
     def update_flavor_cache(self, flavors=None):
-        if not flavors:
-            flavors = self.list_flavor()
-
-        flavor_dict = {}
-        for flv in flavors:
-            flavor_dict.update({flv.name: flv.id})
-        LOG.debug("update flavor cache: {}".format(flavor_dict))
-        self.mc.set(FLAVORS_CACHE_KEY, flavor_dict)
+        flavor_index.invalidate()
+        flavor_index.refresh(self)
 
     def _get_flavor_from_cache(self, flavor_name):
-        # get image from memcache
-        flavors = self.mc.get(FLAVORS_CACHE_KEY)
-        if flavors and flavors.get(flavor_name):
-            flavor = self.get_flavor(flavor_id=flavors.get(flavor_name))
-            if flavor:
-                return flavor
-
-        # get flavors from openstack
-        flavors = self.list_flavor()
-        self.update_flavor_cache(flavors)
-
-        for flavor in flavors:
-            if flavor.name == flavor_name:
-                return flavor
-        return None
+        # get flavor from local index
+        return flavor_index.get(self, flavor_name)
 
     def _get_flavor(self, flavor_name=None, os_type=None):
         flavor = None
@@ -352,25 +327,12 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
                 if not fip:
                     fip = self.create_fip(ip)
                 pre_fips.update({ip: fip.get("id")})
+            self.fip_pool.claim_fips(pre_fips)
             return pre_fips
 
-        with project_utils.memcache_lock(self.mc, MEMCACHE_LOCKER_KEY):
-            # avialable_fips = self.load_available_fips_dict()
-            # self.mc.set(AVAILABLE_FIPS_KEY, avialable_fips)
-            #
-            # for i in range(count):
-            #     fip_addr, fip_id = self._get_fip()
-            #     pre_fips.update({fip_addr: fip_id})
-            #     self.mark_used_fips({fip_addr: fip_id})
-            # LOG.debug("Allocated fips : {}".format(pre_fips))
-            # self.mark_used_fips(pre_fips)
-            for i in range(count):
-                fip_addr, fip_id = self._get_fip(skip_cache=True)
-                pre_fips.update({fip_addr: fip_id})
-        return pre_fips
+        return self.fip_pool.claim(count)
 
     def preallocate_ports(self, network_id, count):
-        ports = []
         params = {
             "port_security_enabled": False,
             "admin_state_up": True
@@ -378,34 +340,46 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
         if self._get_security_groups():
             params.update({"port_security_enabled": True})
 
+        # create all ports in one bulk request
         if isinstance(count, list):
-            for ip in count:
-                params.update({"fixed_ips": [{"ip_address": ip}]})
-                port = self.create_port(network_id, **params)
-                ports.append(port)
+            ports = [dict(params, network_id=network_id, fixed_ips=[{"ip_address": ip}]) for ip in count]
         else:
-            for i in range(count):
-                port = self.create_port(network_id, **params)
-                ports.append(port)
-        return ports
+            ports = [dict(params, network_id=network_id) for i in range(count)]
+        return self.create_ports(ports)
 
-    def _calculate_require(self, servers):
+    def _calculate_require(self, servers, snapshot=None):
         req_vcpus = 0
         req_memory_size = 0
         req_disk_size = 0
         req_fips = 0
 
+        flavors = snapshot.flavors if snapshot else {}
+        images = snapshot.images if snapshot else {}
         for vm in servers:
             if vm.get("role") in FLOATING_ROLE:
                 req_fips += 1
             os_type = vm.get("system_type")
-            flavor = self._get_flavor(vm.get("flavor"), os_type)
-            req_vcpus += flavor.vcpus
-            req_memory_size += flavor.ram
-            disk_size = flavor.disk
+            flavor_name = vm.get("flavor")
+            if not flavor_name:
+                if os_type and os_type == "windows":
+                    flavor_name = app_settings.COMPLEX_MISC.get("windows_flavor")
+                else:
+                    flavor_name = app_settings.COMPLEX_MISC.get("linux_flavor")
+            if flavor_name in flavors:
+                vcpus, ram, disk_size = flavors[flavor_name]
+            else:
+                # unknown to the capacity model, resolve from openstack
+                flavor = self._get_flavor(vm.get("flavor"), os_type)
+                vcpus, ram, disk_size = flavor.vcpus, flavor.ram, flavor.disk
+            req_vcpus += vcpus
+            req_memory_size += ram
             if not disk_size:
-                image = self._get_image(image_name=vm.get("image"))
-                disk_size = getattr(image, "min_disk", 0)
+                image_name = vm.get("image")
+                if image_name in images:
+                    disk_size = images[image_name]
+                else:
+                    image = self._get_image(image_name=image_name)
+                    disk_size = getattr(image, "min_disk", 0)
             req_disk_size += disk_size
         return req_vcpus, req_memory_size, req_disk_size, req_fips
 
@@ -456,41 +430,30 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
         #         allow_fips += 1
         return allow_vcpus, allow_memory_size, allow_disk_size, allow_fips
 
-    def _calculate_preallocated(self):
-        pre_vcpus = 0
-        pre_memory_size = 0
-        pre_disk_size = 0
-        pre_fips = 0
-
-        preallocated_resoureces = self.mc.get(PREALLOCATED_RESOURCES)
-        if preallocated_resoureces:
-            for _tmp, data in preallocated_resoureces.items():
-                pre_vcpus += data.get("vcpus")
-                pre_memory_size += data.get("memory_size")
-                pre_disk_size += data.get("disk_size")
-                pre_fips += data.get("fips")
-        return pre_vcpus, pre_memory_size, pre_disk_size, pre_fips
+    # 未释放的预分配, 加上快照刷新后才释放(已占用但快照还没反映)的预分配
+    def _calculate_preallocated(self, snapshot=None):
+        totals = self.preallocated_ledger.totals()
+        if snapshot:
+            consumed = self.preallocated_ledger.consumed_since(snapshot.refresh_time)
+            totals = {field: totals[field] + consumed[field] for field in totals}
+        return totals["vcpus"], totals["memory_size"], totals["disk_size"], totals["fips"]
 
     @logger_decorator
     def ensure_preallocated(self, locker_id, req_vcpus,
                             req_memory_size, req_disk_size, req_fips):
-        preallocated_resoureces = self.mc.get(PREALLOCATED_RESOURCES) or {}
-        preallocated_resoureces.update({
-            locker_id: {
-                "vcpus": req_vcpus,
-                "memory_size": req_memory_size,
-                "disk_size": req_disk_size,
-                "fips": req_fips
-            }
-        })
-        self.mc.set(PREALLOCATED_RESOURCES, preallocated_resoureces, 3600)
+        self.preallocated_ledger.reserve(locker_id,
+                                         vcpus=req_vcpus,
+                                         memory_size=req_memory_size,
+                                         disk_size=req_disk_size,
+                                         fips=req_fips)
         LOG.info("Preallocated resource ({}) : ok".format(locker_id))
 
     @logger_decorator
     def release_preallocated(self, locker_id):
-        preallocated_resoureces = self.mc.get(PREALLOCATED_RESOURCES)
-        preallocated_resoureces.pop(locker_id)
-        self.mc.set(PREALLOCATED_RESOURCES, preallocated_resoureces, 3600)
+        data = self.preallocated_ledger.release(locker_id, consumed=True)
+        if not data:
+            LOG.info("Preallocated resource ({}) not found".format(locker_id))
+            return
         LOG.info("Release preallocated resource ({}) : ok".format(locker_id))
 
     @logger_decorator
@@ -499,15 +462,19 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
         servers = kwargs.get("servers", [])
         locker_id = kwargs.get("locker_id", uuid.uuid4().hex)
 
+        # allowance, flavors and images from the capacity model
+        snapshot = capacity_model.snapshot(self)
+        staleness = snapshot.staleness
+
         # calc current scene requirements
-        req_vcpus, req_memory_size, req_disk_size, req_fips = self._calculate_require(servers)
+        req_vcpus, req_memory_size, req_disk_size, req_fips = self._calculate_require(servers, snapshot)
 
         # lock memcache and calc remains
         with project_utils.memcache_lock(self.mc, MEMCACHE_LOCKER_KEY):
-            LOG.info("Checking hypervisor resources...")
+            LOG.info("Checking hypervisor resources (staleness {:.1f}s)...".format(staleness))
             # calc allowance
-            allow_vcpus, allow_memory_size, allow_disk_size, allow_fips = self._calculate_allowance()
-            pre_vcpus, pre_memory_size, pre_disk_size, pre_fips = self._calculate_preallocated()
+            allow_vcpus, allow_memory_size, allow_disk_size, allow_fips = snapshot.allowance
+            pre_vcpus, pre_memory_size, pre_disk_size, pre_fips = self._calculate_preallocated(snapshot)
 
             if allow_fips - pre_fips >= req_fips:
                 LOG.debug("Check floating ip quota: OK .")
@@ -545,6 +512,12 @@ class BaseScene(ImageAction, NetworkAction, InstanceAction, ContainerAction, Sto
             self.ensure_preallocated(locker_id, req_vcpus,
                                      req_memory_size,
                                      req_disk_size, req_fips)
+            if kwargs.get("detail"):
+                return {
+                    "locker_id": locker_id,
+                    "staleness": staleness,
+                    "max_staleness": capacity_model.max_staleness,
+                }
             return locker_id
 
     @logger_decorator
@@ -12,6 +12,7 @@ from novaclient import exceptions
 
 from base.utils.functional import cached_property
 from base_cloud.clients.nova_client import Client as nv_client
+from base_cloud.complex.metadata import flavor_index, image_index
 from base_cloud.exception import FriendlyException
 from base_cloud.utils import get_ip_by_hostname
 
@@ -256,6 +257,7 @@ class InstanceAction(object):
                                                         snapshot_name)
             msg = "Instance {} snapshot creating...".format(instance_id)
             LOG.info(msg)
+            image_index.invalidate()
             if check_status:
                 # TODO: check snapshot status
                 pass
@@ -301,7 +303,9 @@ class InstanceAction(object):
         :return: Flavor
         """
         try:
-            return self.nova_cli.flavor_create(**kwargs)
+            flavor = self.nova_cli.flavor_create(**kwargs)
+            flavor_index.invalidate()
+            return flavor
         except Exception as e:
             err_msg = _("Unable to create flavor by params {}").format(kwargs)
             self._handle_error(err_msg, e)
@@ -8,6 +8,7 @@ from django.utils.translation import ugettext as _
 
 from base.utils.functional import cached_property
 from base_cloud.clients.glance_client import Client as gl_client
+from base_cloud.complex.metadata import image_index
 from base_cloud.exception import FriendlyException
 
 
@@ -60,6 +61,7 @@ class ImageAction(object):
             image = self.glance_cli.image_create(**meta)
             LOG.info(_('Your image %s has been queued for creation.') %
                      meta['name'])
+            image_index.invalidate()
             return image
         except Exception as e:
             err_msg = _('Unable to create new image')
@@ -113,6 +115,7 @@ class ImageAction(object):
         try:
             self.glance_cli.image_delete(image_id)
             LOG.info("Successfully deleted image {} .".format(image_id))
+            image_index.invalidate()
             return True
         except Exception as e:
             err_msg = "Unable to delete image {}.".format(image_id)
@@ -131,6 +134,7 @@ class ImageAction(object):
 
         try:
             image = self.glance_cli.image_update(image_obj.id, **kwargs)
+            image_index.invalidate()
             return image
         except Exception as e:
             err_msg = "Unable to update image {}.".format(image)
@@ -188,6 +192,7 @@ class ImageAction(object):
             # load docker image from glance
             # if image:
             #     self.load_docker_image(image)
+            image_index.invalidate()
             return image
         except Exception as e:
             err_msg = _('Unable to create new image')
@@ -350,6 +350,48 @@ class NetworkAction(object):
             self._handle_error(err_msg, e)
         return port
 
+    def create_ports(self, ports):
+        """Create ports in one bulk request
+
+        :param ports: list of port params, each with network_id
+        :return: created ports in the same order
+
+        Bulk request is atomic, when it fails the ports are created one by
+        one to find out the failed ones, then the created ones are deleted.
+        """
+        if not ports:
+            return []
+        try:
+            created = self.neutron_cli.port_create_bulk(ports)
+            LOG.info("Created ports {}.".format([port.get("id") for port in created]))
+            return created
+        except Exception as e:
+            LOG.warning("Bulk create ports failed, retry one by one: {}".format(e))
+
+        created = []
+        errors = []
+        for index, port in enumerate(ports):
+            params = dict(port)
+            network_id = params.pop("network_id")
+            try:
+                created.append(self.neutron_cli.port_create(network_id, **params))
+            except Exception as e:
+                errors.append((index, port, e))
+
+        if errors:
+            for port in created:
+                try:
+                    self.neutron_cli.port_delete(port.get("id"))
+                except Exception:
+                    pass
+            err_msg = _("Unable to create ports: {}.").format("; ".join(
+                "{}({}): {}".format(port.get("network_id"), port.get("fixed_ips", ""), getattr(e, "message", e))
+                for index, port, e in errors
+            ))
+            LOG.error(err_msg)
+            raise FriendlyException(err_msg)
+        return created
+
     def get_port(self, port_id):
         try:
             return self.neutron_cli.port_get(port_id)
@@ -1,4 +1,4 @@
-
+# -*- coding: utf-8 -*-
 CONTROLLER_INFO = {
     'ssh_port': 22,
     'ssh_username': 'root',
@@ -45,3 +45,19 @@ DONT_SHOW = {
 CONTROLLER_HTTPD_PORT = 80
 
 RESOURCE_HOSTS = ['127.0.0.1']
+
+# 浮动ip预热池: 后台补充到的空闲数量
+FIP_POOL_WATERMARK = 10
+
+# 资源容量模型: 后台刷新间隔(秒), 数据最大过期时间(秒), 超过后同步刷新
+CAPACITY_REFRESH_SECONDS = 10
+CAPACITY_MAX_STALENESS = 60
+
+# openstack session: 每组认证信息的http连接池大小, token剩余有效期(秒)小于该值时重新获取
+OS_SESSION_POOL_SIZE = 20
+OS_TOKEN_REFRESH_SECONDS = 300
+
+# 镜像/规格索引: 增量刷新间隔, 检查修改通知间隔, 全量重建间隔(秒)
+METADATA_POLL_SECONDS = 30
+METADATA_CHECK_SECONDS = 5
+METADATA_FULL_REFRESH_SECONDS = 600
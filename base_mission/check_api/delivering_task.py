@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
-from channels import Channel
+from base.utils.delete_channel_delay import send_channel_delay
 
 
-def start_checker(data, logger, no_delay=False):
+def start_checker(data, logger, no_delay=False, scene_id=None):
     """
     start check function(Self-start)
     :param data:
@@ -18,9 +18,6 @@ def start_checker(data, logger, no_delay=False):
 
     logger.info("Check time : %s", first_check_time)
 
-    delayed_message = {
-        'channel': 'control',
-        'content': data,
-        'delay': first_check_time
-    }
-    Channel('asgi.delay').send(delayed_message)
+    # 按任务和场景索引, 停止时直接删除
+    send_channel_delay('control', data, first_check_time,
+                       mission_id=data.get('id'), scene_id=scene_id or data.get('scene_id'))
@@ -63,7 +63,11 @@ class ScriptClient(RpcThrift):
 
         check_func = self.thrift_client(self.content.get("checker_ip"), self.content.get("checker_port"))
         try:
-            version = check_func.version()
+            # 版本检查和下发脚本在同一连接上一次发出
+            with check_func.batch() as batch:
+                batch.version()
+                self.agent_python_client(batch, parameter)
+            version = batch.results[0]
             self.logger.info('RPC version[%s]', version)
             if version.get("status") == 'down':
                 self.logger.error("Link not on RPC")
@@ -72,7 +76,6 @@ class ScriptClient(RpcThrift):
                 self.logger.error("RPC error")
                 return False
             else:
-                self.agent_python_client(check_func, parameter)
                 return True
         except Exception as e:
             self.logger.error("RPC error:%s", e)
@@ -90,7 +93,11 @@ class ScriptClient(RpcThrift):
         check_func = self.thrift_client(self.content.get("checker_ip"), self.content.get("checker_port"))
 
         try:
-            version = check_func.version()
+            # 版本检查和下发脚本在同一连接上一次发出
+            with check_func.batch() as batch:
+                batch.version()
+                self.agent_shell_client(batch, parameter_str)
+            version = batch.results[0]
             self.logger.info('RPC version[%s]', version)
             if version.get("status") == 'down':
                 self.logger.error("Link not on RPC")
@@ -99,7 +106,6 @@ class ScriptClient(RpcThrift):
                 self.logger.error("RPC error")
                 return False
             else:
-                self.agent_shell_client(check_func, parameter_str)
                 return True
         except Exception as e:
             self.logger.error("RPC error: %s", e)
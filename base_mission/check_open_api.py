@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 
-from base.utils.delete_channel_delay import delete_channel_delay
+from base.utils.delete_channel_delay import cancel_channel_delay, delete_channel_delay
 from base.utils.thread import async_exe
 from base_mission import constant
 from base_mission.check_api.connect_num_cache import ConnectCache
@@ -53,7 +53,7 @@ class MissionCheckerManager(object):
         else:
             # 发布任务
             self.logger.info("Mission[%s]: Publish mission", self.mission.title)
-            start_checker(script_data, self.logger, no_delay)
+            start_checker(script_data, self.logger, no_delay, scene_id=self.scene_id)
 
     def stop(self):
         # 更改Mission状态是停止
@@ -62,7 +62,8 @@ class MissionCheckerManager(object):
             "Has stopped check",
             constant.MissionStatus.STOP)
 
-        delete_channel_delay({"id": self.mission.id})
+        cancel_channel_delay(mission_ids=[self.mission.id])
+        delete_channel_delay({"id": self.mission.id}, channel_name='control')
 
         self.logger.info("Mission[%s]: Has stopped check", self.mission.title)
 
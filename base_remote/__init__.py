@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 import logging
 
 from django.conf import settings
@@ -11,3 +12,12 @@ app_settings = load_app_settings(__package__)
 
 def sync_init():
     settings.DATABASES['guacamole'] = app_settings.DATABASE
+
+    from base_remote.utils.recording import configure_queue
+    configure_queue()
+
+
+# 继续执行进程重启前未完成的录像转换任务
+def async_global_init():
+    from base_remote.utils.recording import resume_jobs
+    resume_jobs()
@@ -2,8 +2,10 @@
 import logging
 import uuid
 
+from django.core.cache import cache
 from django.utils import six
 
+from base.utils.thread import TaskGraph
 from base_auth.models import User
 
 from base_remote.utils.guacamole import GuacamoleDatabase, GuacamoleServer, GuacamoleConsumer
@@ -51,6 +53,9 @@ class RemoteManager(object):
     def remove_connection(self, relation_id):
         return self.guacamole_db.remove_connection(relation_id)
 
+    def remove_connections(self, relation_ids):
+        return self.guacamole_db.remove_connections(relation_ids)
+
     def remove_ssh_connection(self, relation_id):
         return self.remove_connection(relation_id)
 
@@ -74,6 +79,10 @@ class RemoteManager(object):
         return self.guacamole_server.convert_recording(recording_name, screen_size=screen_size,
                                                        callback_script=callback_script)
 
+    def enqueue_convert_recording(self, recording_name, screen_size='1366x768', callback=None):
+        return self.guacamole_server.enqueue_convert_recording(recording_name, screen_size=screen_size,
+                                                               callback=callback)
+
     def _check_guacamole_consumer(self):
         if not self.guacamole_consumer:
             raise Exception('no user')
@@ -120,6 +129,49 @@ class MonitorManager(object):
         return self.guacamole_admin.share_active_sessions_for_assistance(connection_ids)
 
 
+# 汇总所有guacamole服务的监控共享链接: 各服务并发查询活动会话, 结果按连接短暂缓存
+class MonitorAggregator(object):
+    cache_key = 'guacamole_monitor_url_%s'
+
+    def _share_on_server(self, server, connection_ids):
+        try:
+            return MonitorManager(server=server).share_active_sessions_for_monitor(connection_ids)
+        except Exception as e:
+            # 单个服务不可用不影响其它服务的结果
+            logger.error('guacamole server[%s] share active sessions error: %s', server, e)
+            return {}
+
+    def share_active_sessions_for_monitor(self, connection_ids):
+        connection_ids = list(set(connection_ids))
+        if not connection_ids:
+            return {}
+
+        # 缓存值为(url,), 没有活动会话的连接缓存为空元组
+        keys = {self.cache_key % connection_id: connection_id for connection_id in connection_ids}
+        shared = {keys[key]: value for key, value in cache.get_many(keys.keys()).items()}
+        missing_ids = [connection_id for connection_id in connection_ids if connection_id not in shared]
+        if missing_ids:
+            servers = [server['server'] for server in app_settings.GUACAMOLE_SERVERS]
+            graph = TaskGraph(max_workers=len(servers))
+            for server in servers:
+                graph.add(server, self._share_on_server, (server, missing_ids))
+            results = graph.run()
+
+            fetched = {connection_id: () for connection_id in missing_ids}
+            for server in servers:
+                for connection_id, url in results[server].items():
+                    if not fetched.get(connection_id):
+                        fetched[connection_id] = (url,)
+            cache.set_many({self.cache_key % connection_id: value for connection_id, value in fetched.items()},
+                           app_settings.MONITOR_SHARE_CACHE_SECONDS)
+            shared.update(fetched)
+
+        return {connection_id: value[0] for connection_id, value in shared.items() if value}
+
+
+monitor_aggregator = MonitorAggregator()
+
+
 guacamole_host_server = {}
 for server in app_settings.GUACAMOLE_SERVERS:
     guacamole_host_server[server['host_ip']] = server['server']
@@ -5,6 +5,8 @@
 
 from __future__ import unicode_literals
 
+import json
+
 from django.db import models
 from django.utils import timezone
 
@@ -240,3 +242,36 @@ class GuacamoleUserPasswordHistory(models.Model):
     class Meta:
         db_table = 'guacamole_user_password_history'
         managed = False
+
+
+# 录像转换任务, 存在项目自己的数据库, 按录像名去重, 逐个文件记录进度便于中断后继续
+class RecordingConvertJob(models.Model):
+    recording_name = models.CharField(max_length=255, unique=True)
+    server = models.CharField(max_length=255, default='')
+    screen_size = models.CharField(max_length=32, default='1366x768')
+    bitrate = models.PositiveIntegerField(default=2000000)
+    Status = Enum(
+        PENDING=0,
+        RUNNING=1,
+        DONE=2,
+        FAILED=3,
+    )
+    status = models.PositiveIntegerField(default=Status.PENDING, db_index=True)
+    total_files = models.PositiveIntegerField(default=0)
+    # 已执行次数, 有文件失败时重试到RECORDING_CONVERT_MAX_ATTEMPTS次
+    attempts = models.PositiveIntegerField(default=0)
+    # 已转换完成的mp4文件名, json列表
+    mp4_names = models.TextField(default='[]')
+    # 转换完成后执行的Executor id, json列表
+    callbacks = models.TextField(default='[]')
+    error = models.TextField(default='')
+    create_time = models.DateTimeField(default=timezone.now)
+    update_time = models.DateTimeField(default=timezone.now)
+
+    @property
+    def progress(self):
+        if self.status == self.Status.DONE:
+            return 100
+        if not self.total_files:
+            return 0
+        return len(json.loads(self.mp4_names)) * 100 // self.total_files
@@ -2,20 +2,17 @@
 import json
 import urllib
 
-from django.conf import settings
-
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import NotFound, PermissionDenied
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
-from rest_framework.reverse import reverse
 
 from base.models import Executor
 from base.utils.rest.decorators import request_data
-from base.utils.thread import async_exe
 
 from base_remote import app_settings
 from base_remote.managers import RemoteManager, GuacamoleServer
+from base_remote.models import RecordingConvertJob
 
 
 @api_view(['GET'])
@@ -64,33 +61,38 @@ def recording_convert(request):
     if not convert_func:
         raise PermissionDenied()
 
-    def tmp_task():
-        remote_manager = RemoteManager(host=host_ip)
-        callback_script = ''
-        if host_ip and host_ip != app_settings.OJ_SERVER['host_ip']:
-            executor = {
-                'func': delay_convert_callback,
-                'params': {
-                    'recording_name': recording_name,
-                    'screen_size': screen_size,
-                    'convert_func': convert_func,
-                    'convert_params': convert_params,
-                }
-            }
-            condition = Executor.dump_executor(executor)
-            task = Executor.objects.filter(**condition).first()
-            if not task:
-                task = Executor.objects.create(extra=executor.get('extra', ''), **condition)
-            callback_url = settings.SERVER + reverse('api:public:base_remote:recording_convert_over', (task.id,))
-            callback_script = 'curl {callback_url}'.format(callback_url=callback_url)
-        video_names = remote_manager.convert_recording(recording_name, screen_size=screen_size,
-                                                       callback_script=callback_script)
-        convert_func(video_names, screen_size, **convert_params)
-    async_exe(tmp_task)
+    # 放入转换任务队列, 转换完成后扫描视频文件回调
+    executor = {
+        'func': delay_convert_callback,
+        'params': {
+            'recording_name': recording_name,
+            'screen_size': screen_size,
+            'convert_func': convert_func,
+            'convert_params': convert_params,
+        }
+    }
+    RemoteManager(host=host_ip).enqueue_convert_recording(recording_name, screen_size=screen_size, callback=executor)
 
     return Response({})
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def recording_convert_status(request, recording_name):
+    job = RecordingConvertJob.objects.filter(recording_name=recording_name).first()
+    if not job:
+        raise NotFound()
+
+    return Response({
+        'recording_name': job.recording_name,
+        'status': job.status,
+        'progress': job.progress,
+        'total_files': job.total_files,
+        'mp4_names': json.loads(job.mp4_names),
+        'error': job.error,
+    })
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def recording_convert_over(request, task_id):
@@ -10,6 +10,8 @@ apiurlpatterns = [
     url(r'^connection/(?P<connection_id>[0-9]+)/disable_recording/$', rest_views.disable_recording,
         name='disable_recording'),
     url(r'^recording_convert/$', rest_views.recording_convert, name='recording_convert'),
+    url(r'^recording_convert/(?P<recording_name>[^/]+)/status/$', rest_views.recording_convert_status,
+        name='recording_convert_status'),
     url(r'^recording_convert/(?P<task_id>[0-9]+)/over/$', rest_views.recording_convert_over,
         name='recording_convert_over'),
     url(r'^login_guacamoles/$', rest_views.login_guacamoles, name='login_guacamoles'),
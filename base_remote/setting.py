@@ -75,3 +75,24 @@ RECORDING_PATH = os.path.join(settings.MEDIA_ROOT, _guacamole_recording_dir_name
 
 # 视频转换回调
 RECORDING_CONVERT_CALLBACK = {}
+
+# 视频转换任务的并发数
+RECORDING_CONVERT_WORKERS = 4
+
+# 单个录像文件的转换超时时间(秒)
+RECORDING_CONVERT_FILE_TIMEOUT = 3600
+
+# 运行中的转换任务超过该时间(秒)没有进度视为已中断, 重新执行
+RECORDING_CONVERT_STALE_SECONDS = 2 * 3600
+
+# 有文件转换失败的任务最多执行的次数, 用完后按已转换的文件执行回调
+RECORDING_CONVERT_MAX_ATTEMPTS = 3
+
+# guacamole api token空闲过期时间(秒), 与guacamole的api-session-timeout一致
+GUACAMOLE_TOKEN_TIMEOUT = 60 * 60
+
+# api token距离过期不足该时间(秒)时重新登录
+GUACAMOLE_TOKEN_REFRESH_SECONDS = 5 * 60
+
+# 监控共享链接缓存时间(秒)
+MONITOR_SHARE_CACHE_SECONDS = 10
@@ -5,20 +5,21 @@ import json
 import logging
 import os
 import re
-import subprocess
+import threading
+import time
 import urllib
 
 from django.db import transaction
 
 from base.utils.functional import cached_property
 from base.utils.http import HttpClient
-from base.utils.ssh import ssh
 
 from base_remote import app_settings
 from base_remote.models import (GuacamoleConnectionGroup, GuacamoleConnection, GuacamoleUser, GuacamoleSharingProfile,
                                 GuacamoleConnectionParameter, GuacamoleSharingProfileParameter,
                                 GuacamoleConnectionPermission, GuacamoleConnectionGroupPermission,
                                 GuacamoleSharingProfilePermission, GuacamoleUserPermission)
+from base_remote.utils import recording
 
 
 logger = logging.getLogger(__name__)
@@ -28,6 +29,44 @@ MONITOR_SHARING_PROFILE_NAME = 'cyberpeace_monitor'
 
 ASSISTANCE_SHARING_PROFILE_NAME = 'cyberpeace_assistance'
 
+# 批量写入/删除guacamole数据时每批的数量
+BULK_BATCH_SIZE = 500
+
+
+# guacamole api token缓存, 按(server, username)复用, token空闲过期前重新登录
+class GuacamoleTokenCache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def get(self, server, username):
+        entry = self._tokens.get((server, username))
+        if not entry:
+            return None
+        token, last_used = entry
+        # guacamole的token按空闲时间过期, 每次使用都会续期
+        expires = app_settings.GUACAMOLE_TOKEN_TIMEOUT - app_settings.GUACAMOLE_TOKEN_REFRESH_SECONDS
+        if time.time() - last_used > expires:
+            self.invalidate(server, username, token)
+            return None
+        self._tokens[(server, username)] = (token, time.time())
+        return token
+
+    def set(self, server, username, token):
+        with self._lock:
+            self._tokens[(server, username)] = (token, time.time())
+
+    # 只清除指定的token, 避免清掉其它线程刚刷新的token
+    def invalidate(self, server, username, token=None):
+        with self._lock:
+            entry = self._tokens.get((server, username))
+            if entry and (token is None or entry[0] == token):
+                self._tokens.pop((server, username), None)
+
+
+token_cache = GuacamoleTokenCache()
+
 
 class GuacamoleDatabase(object):
     # 根据guacamole代码分析调用java类生成无salt密码
@@ -102,83 +141,115 @@ class GuacamoleDatabase(object):
 
     @classmethod
     def add_connection(cls, user_id, connection_name, protocol, config):
-        with transaction.atomic():
+        return cls.add_connections([{
+            'user_id': user_id,
+            'connection_name': connection_name,
+            'protocol': protocol,
+            'config': config,
+        }])[0]
+
+    # 批量添加连接: 连接、参数、权限、共享配置都在内存中组装, 每张表一次bulk_create
+    @classmethod
+    def add_connections(cls, connection_params):
+        connection_params = list(connection_params)
+        if not connection_params:
+            return []
+
+        with transaction.atomic(using=GuacamoleConnection.objects.db):
             # 创建连接, 指定连接所属的连接组为该用户
-            connection = GuacamoleConnection.objects.create(
-                parent_id=user_id,
-                connection_name=connection_name,
-                protocol=protocol,
+            GuacamoleConnection.objects.bulk_create([GuacamoleConnection(
+                parent_id=param['user_id'],
+                connection_name=param['connection_name'],
+                protocol=param['protocol'],
                 max_connections=app_settings.GUACADMIN_MAX_CONNECTIONS,
                 max_connections_per_user=app_settings.GUACADMIN_MAX_CONNECTIONS_PER_USER,
-            )
-            # 创建连接参数
+            ) for param in connection_params], batch_size=BULK_BATCH_SIZE)
+            # mysql批量插入不返回自增id, 按(连接组, 连接名)唯一约束查回
+            connection_map = {(connection.parent_id, connection.connection_name): connection
+                              for connection in GuacamoleConnection.objects.filter(
+                                  parent_id__in=set(param['user_id'] for param in connection_params),
+                                  connection_name__in=set(param['connection_name'] for param in connection_params),
+                              )}
+            connections = [connection_map[(param['user_id'], param['connection_name'])]
+                           for param in connection_params]
+
             connection_parameters = []
-            for name, value in config.items():
-                connection_parameters.append(GuacamoleConnectionParameter(
+            connection_permissions = []
+            sharing_profiles = []
+            for param, connection in zip(connection_params, connections):
+                # 创建连接参数
+                for name, value in param['config'].items():
+                    connection_parameters.append(GuacamoleConnectionParameter(
+                        connection=connection,
+                        parameter_name=name,
+                        parameter_value=value,
+                    ))
+                # 设置用户的连接权限为只读
+                connection_permissions.append(GuacamoleConnectionPermission(
+                    user_id=param['user_id'],
                     connection=connection,
-                    parameter_name=name,
-                    parameter_value=value,
+                    permission=GuacamoleConnectionPermission.Permission.READ
                 ))
-            GuacamoleConnectionParameter.objects.bulk_create(connection_parameters)
-            # 设置用户的连接权限为只读
-            GuacamoleConnectionPermission.objects.create(
-                user_id=user_id,
-                connection=connection,
-                permission=GuacamoleConnectionPermission.Permission.READ
-            )
-            # 创建共享连接配置：只读监控
-            monitor_sharing_profile = GuacamoleSharingProfile.objects.create(
-                sharing_profile_name=MONITOR_SHARING_PROFILE_NAME,
-                primary_connection=connection,
-            )
-            # 只读监控参数配置
-            GuacamoleSharingProfileParameter.objects.create(
-                sharing_profile=monitor_sharing_profile,
-                parameter_name='read-only',
-                parameter_value='true',
-            )
-            # 共享连接配置权限，所有者只读
-            GuacamoleSharingProfilePermission.objects.create(
-                user_id=user_id,
-                sharing_profile=monitor_sharing_profile,
-                permission=GuacamoleConnectionPermission.Permission.READ,
-            )
-            # 创建共享连接配置：远程协助
-            assistance_sharing_profile = GuacamoleSharingProfile.objects.create(
-                sharing_profile_name=ASSISTANCE_SHARING_PROFILE_NAME,
-                primary_connection=connection,
-            )
-            # 共享连接配置权限，所有者只读
-            GuacamoleSharingProfilePermission.objects.create(
-                user_id=user_id,
-                sharing_profile=assistance_sharing_profile,
-                permission=GuacamoleConnectionPermission.Permission.READ,
-            )
-
-        return connection
+                # 创建共享连接配置：只读监控, 远程协助
+                for sharing_profile_name in (MONITOR_SHARING_PROFILE_NAME, ASSISTANCE_SHARING_PROFILE_NAME):
+                    sharing_profiles.append(GuacamoleSharingProfile(
+                        sharing_profile_name=sharing_profile_name,
+                        primary_connection=connection,
+                    ))
+            GuacamoleConnectionParameter.objects.bulk_create(connection_parameters, batch_size=BULK_BATCH_SIZE)
+            GuacamoleConnectionPermission.objects.bulk_create(connection_permissions, batch_size=BULK_BATCH_SIZE)
+            GuacamoleSharingProfile.objects.bulk_create(sharing_profiles, batch_size=BULK_BATCH_SIZE)
+
+            connection_user_map = {connection.connection_id: param['user_id']
+                                   for param, connection in zip(connection_params, connections)}
+            sharing_profile_parameters = []
+            sharing_profile_permissions = []
+            for sharing_profile in GuacamoleSharingProfile.objects.filter(
+                    primary_connection_id__in=connection_user_map.keys()):
+                # 只读监控参数配置
+                if sharing_profile.sharing_profile_name == MONITOR_SHARING_PROFILE_NAME:
+                    sharing_profile_parameters.append(GuacamoleSharingProfileParameter(
+                        sharing_profile=sharing_profile,
+                        parameter_name='read-only',
+                        parameter_value='true',
+                    ))
+                # 共享连接配置权限，所有者只读
+                sharing_profile_permissions.append(GuacamoleSharingProfilePermission(
+                    user_id=connection_user_map[sharing_profile.primary_connection_id],
+                    sharing_profile=sharing_profile,
+                    permission=GuacamoleConnectionPermission.Permission.READ,
+                ))
+            GuacamoleSharingProfileParameter.objects.bulk_create(sharing_profile_parameters,
+                                                                 batch_size=BULK_BATCH_SIZE)
+            GuacamoleSharingProfilePermission.objects.bulk_create(sharing_profile_permissions,
+                                                                  batch_size=BULK_BATCH_SIZE)
 
-    # 批量添加连接
-    @classmethod
-    def add_connections(cls, connection_params):
-        connections = []
-        with transaction.atomic():
-            for param in connection_params:
-                connection = cls.add_connection(
-                    user_id=param['user_id'],
-                    connection_name=param['connection_name'],
-                    protocol=param['protocol'],
-                    config=param['config'],
-                )
-                connections.append(connection)
         return connections
 
     @classmethod
     def remove_connection(cls, connection_id):
-        GuacamoleConnection.objects.filter(connection_id=connection_id).delete()
+        cls.remove_connections([connection_id])
 
+    # 批量删除连接: 先按外键逐表删除关联数据, 每张表一条delete语句
     @classmethod
     def remove_connections(cls, connection_ids):
-        GuacamoleConnection.objects.filter(connection_id__in=connection_ids).delete()
+        connection_ids = list(connection_ids)
+        if not connection_ids:
+            return
+
+        with transaction.atomic(using=GuacamoleConnection.objects.db):
+            for i in range(0, len(connection_ids), BULK_BATCH_SIZE):
+                batch_ids = connection_ids[i:i + BULK_BATCH_SIZE]
+                sharing_profile_ids = list(GuacamoleSharingProfile.objects.filter(
+                    primary_connection_id__in=batch_ids,
+                ).values_list('sharing_profile_id', flat=True))
+                if sharing_profile_ids:
+                    for model in (GuacamoleSharingProfileParameter, GuacamoleSharingProfilePermission,
+                                  GuacamoleSharingProfile):
+                        model.objects.filter(sharing_profile_id__in=sharing_profile_ids).delete()
+                GuacamoleConnectionParameter.objects.filter(connection_id__in=batch_ids).delete()
+                GuacamoleConnectionPermission.objects.filter(connection_id__in=batch_ids).delete()
+                GuacamoleConnection.objects.filter(connection_id__in=batch_ids).delete()
 
     @classmethod
     def _get_connection_parameter(cls, connection_id, name):
@@ -301,130 +372,13 @@ class GuacamoleServer(object):
                           screen_size='1366x768',
                           bitrate=2000000,
                           callback_script=''):
+        return recording.convert_recording(self.server, recording_name, screen_size=screen_size, bitrate=bitrate,
+                                           callback_script=callback_script)
 
-        # fix screen_size
-        screen_sizes = screen_size.split('x')
-        try:
-            screen_width = int(screen_sizes[0])
-            screen_height = int(screen_sizes[1])
-            screen_width_remainder = screen_width % 32
-            if screen_width_remainder != 0:
-                screen_width = screen_width - screen_width_remainder
-
-            screen_height_remainder = screen_height % 2
-            if screen_height_remainder != 0:
-                screen_height = screen_height - screen_height_remainder
-        except Exception:
-            return []
-        else:
-            screen_size = '{width}x{height}'.format(width=screen_width, height=screen_height)
-
-        guacamole_server_mapping = {}
-        for server in app_settings.GUACAMOLE_SERVERS:
-            guacamole_server_mapping[server['server']] = server
-        server = guacamole_server_mapping.get(self.server)
-        if not server:
-            return False
-
-        mp4_names = []
-        recording_source_path = app_settings.RECORDING_SOURCE_PATH
-        recording_path = app_settings.RECORDING_PATH
-
-        if server['host_ip'] == app_settings.OJ_SERVER['host_ip']:
-            s2m4v_command = 'guacenc -s {screen_size} -r {bitrate} -f {file}'.format(
-                screen_size=screen_size,
-                bitrate=bitrate,
-                file='%s*' % os.path.join(recording_source_path, recording_name),
-            )
-            try:
-                subprocess.check_call(s2m4v_command, shell=True)
-            except subprocess.CalledProcessError as e:
-                logger.error('guacamole convert session recording error: command[%s], error[%s]', s2m4v_command, e)
-                return []
-
-            m4v_names = []
-            recording_name_pattern = re.compile(r'^{recording_name}(.\d+)?$'.format(recording_name=recording_name))
-            m4v_name_pattern = re.compile(r'^{recording_name}(.\d+)?.m4v$'.format(recording_name=recording_name))
-            for filename in os.listdir(recording_source_path):
-                if m4v_name_pattern.match(filename):
-                    m4v_names.append(filename)
-
-                elif recording_name_pattern.match(filename):
-                    os.remove(os.path.join(recording_source_path, filename))
-
-            mp4_names = []
-            for m4v_name in m4v_names:
-                m4v_file = os.path.join(recording_source_path, m4v_name)
-                mp4_name = m4v_name + '.mp4'
-                mp4_file = os.path.join(recording_path, mp4_name)
-                m4v2mp4_command = 'ffmpeg -i {m4v_file} {mp4_file}'.format(
-                    m4v_file=m4v_file,
-                    mp4_file=mp4_file,
-                )
-                try:
-                    subprocess.check_call(m4v2mp4_command, shell=True)
-                except subprocess.CalledProcessError as e:
-                    logger.error('guacamole convert session recording error: command[%s], error[%s]', m4v2mp4_command,
-                                 e)
-                else:
-                    os.remove(m4v_file)
-                    mp4_names.append(mp4_name)
-        else:
-            convert_command_template = r'\n'.join([
-                "",
-                r"guacenc -s {screen_size} -r {bitrate} -f {recording_source_path}/{recording_name}*",
-                r"find {recording_source_path} -type f  "
-                r"-regextype egrep -regex '^{recording_source_path}/{recording_name}(.[0-9]+)?$' "
-                r"-exec  rm -f {{}} \;",
-                r"find {recording_source_path} -type f  "
-                r"-regextype egrep -regex '^{recording_source_path}/{recording_name}(.[0-9]+)?.m4v$' "
-                r"-exec  ffmpeg -i {{}} {{}}.mp4 \;",
-                r"find {recording_source_path} -type f  "
-                r"-regextype egrep -regex '^{recording_source_path}/{recording_name}(.[0-9]+)?.m4v$' "
-                r"-exec  rm -f {{}} \;",
-                r"find {recording_source_path} -type f  "
-                r"-regextype egrep -regex '^{recording_source_path}/{recording_name}(.[0-9]+)?.m4v.mp4$' "
-                r"-exec  sshpass -p {self_ssh_pass} scp {{}} {self_ssh_user}@{self_ssh_host}:{recording_path} \;",
-                r"find {recording_source_path} -type f  "
-                r"-regextype egrep -regex '^{recording_source_path}/{recording_name}(.[0-9]+)?.m4v.mp4$' "
-                r"-exec  rm -f {{}} \;",
-                "",
-            ])
-            if callback_script:
-                convert_command_template = convert_command_template + callback_script
-
-            convert_command = convert_command_template.format(
-                screen_size=screen_size,
-                bitrate=bitrate,
-                recording_source_path=recording_source_path,
-                recording_path=recording_path,
-                recording_name=recording_name,
-                self_ssh_host=app_settings.OJ_SERVER['host_ip'],
-                self_ssh_user=app_settings.OJ_SERVER['ssh_username'],
-                self_ssh_pass=app_settings.OJ_SERVER['ssh_password'],
-            )
-
-            convert_command_hidden = convert_command_template.format(
-                screen_size=screen_size,
-                bitrate=bitrate,
-                recording_source_path=recording_source_path,
-                recording_path=recording_path,
-                recording_name=recording_name,
-                self_ssh_host=app_settings.OJ_SERVER['host_ip'],
-                self_ssh_user=app_settings.OJ_SERVER['ssh_username'],
-                self_ssh_pass='******',
-            )
-
-            logger.info('guacamole[%s] convert session recording start: command[%s]', server['host_ip'],
-                        convert_command_hidden)
-            try:
-                sc = ssh(server['host_ip'], 22, server['ssh_username'], server['ssh_password'])
-                sc.exe(convert_command, timeout=3600 * 2)
-            except Exception as e:
-                logger.error('guacamole[%s] convert session recording error: command[%s], error[%s]', server['host_ip'],
-                             convert_command_hidden, e)
-
-        return mp4_names
+    # 放入转换任务队列, 同名录像只转换一次
+    def enqueue_convert_recording(self, recording_name, screen_size='1366x768', bitrate=2000000, callback=None):
+        return recording.enqueue_convert(recording_name, server=self.server, screen_size=screen_size,
+                                         bitrate=bitrate, callback=callback)
 
 
 class GuacamoleConsumer(object):
@@ -476,20 +430,41 @@ class GuacamoleConsumer(object):
             logger.error('guacamole user[%s] get token with data[%s] failed', self.username, data)
             return None
 
-    def _get_token_str(self):
+    def _get_token_str(self, refresh=False):
+        if not refresh:
+            token = token_cache.get(self.server.server, self.username)
+            if token:
+                return token
+
         content = self._get_token()
         if content:
-            return json.loads(content).get('authToken')
+            token = json.loads(content).get('authToken')
+            if token:
+                token_cache.set(self.server.server, self.username, token)
+            return token
         else:
             return None
 
-    def _get_active_sessions(self):
+    # 带token调用api, token失效时重新登录再试一次
+    def _api_get(self, url):
         token = self._get_token_str()
         if not token:
             return None
 
-        data = {'token': token}
-        res = self.server.api_get(app_settings.GUACAMOLE_API_PATH_ACTIVE_SESSIONS, data)
+        res = self.server.api_get(url, {'token': token})
+        if res.status_code in (401, 403):
+            token_cache.invalidate(self.server.server, self.username, token)
+            token = self._get_token_str(refresh=True)
+            if not token:
+                return None
+            res = self.server.api_get(url, {'token': token})
+        return res
+
+    def _get_active_sessions(self):
+        res = self._api_get(app_settings.GUACAMOLE_API_PATH_ACTIVE_SESSIONS)
+        if res is None:
+            return None
+
         if res.status_code == 200:
             return res.json()
         else:
@@ -533,18 +508,15 @@ class GuacamoleConsumer(object):
             return filter_connection_id_session_map
 
     def _share_active_session(self, session_id, sharing_profile_id):
-        token = self._get_token_str()
-        if not token:
-            return None
-
-        data = {'token': token}
-        res = self.server.api_get(
+        res = self._api_get(
             app_settings.GUACAMOLE_API_PATH_SHARE_ACTIVE_SESSION.format(
                 session_id=session_id,
                 sharing_profile_id=sharing_profile_id,
-            ),
-            data
+            )
         )
+        if res is None:
+            return None
+
         if res.status_code == 200:
             return res.json().get('values', {}).get('key')
         else:
@@ -557,8 +529,9 @@ class GuacamoleConsumer(object):
         if not active_sessions:
             return {}
 
+        # 只查有活动会话的连接, 整批共享复用同一个token
         sharing_profiles = GuacamoleSharingProfile.objects.filter(
-            primary_connection__in=connection_ids,
+            primary_connection__in=active_sessions.keys(),
         )
         if sharing_profile_name:
             sharing_profiles = sharing_profiles.filter(
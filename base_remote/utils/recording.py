@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import logging
+import os
+import pipes
+import re
+import shutil
+import subprocess
+
+from django.db import transaction
+from django.utils import timezone
+
+from base.models import Executor
+from base.utils.ssh import ssh
+from base.utils.thread import async_exe, get_task_runtime
+
+from base_remote import app_settings
+from base_remote.models import RecordingConvertJob
+
+
+logger = logging.getLogger(__name__)
+
+
+QUEUE_NAME = 'recording_convert'
+
+
+def configure_queue():
+    get_task_runtime().configure_queue(QUEUE_NAME, app_settings.RECORDING_CONVERT_WORKERS)
+
+
+# guacenc要求宽度是32的倍数, 高度是2的倍数
+def fix_screen_size(screen_size):
+    screen_sizes = screen_size.split('x')
+    try:
+        screen_width = int(screen_sizes[0])
+        screen_height = int(screen_sizes[1])
+    except Exception:
+        return None
+
+    screen_width = screen_width - screen_width % 32
+    screen_height = screen_height - screen_height % 2
+    return '{width}x{height}'.format(width=screen_width, height=screen_height)
+
+
+def _recording_name_pattern(recording_name):
+    return re.compile(r'^{recording_name}(.\d+)?$'.format(recording_name=re.escape(recording_name)))
+
+
+def _get_server_config(server):
+    for server_config in app_settings.GUACAMOLE_SERVERS:
+        if server_config['server'] == server:
+            return server_config
+    return None
+
+
+def _encode_command(source_file, screen_size, bitrate):
+    # guacenc输出的mpeg4 part 2浏览器大多不能播放, 由ffmpeg一次转成h264
+    return ('guacenc -s {screen_size} -r {bitrate} -f {source_file} && '
+            'ffmpeg -y -v error -i {source_file}.m4v -c:v libx264 -pix_fmt yuv420p -movflags +faststart '
+            '{source_file}.m4v.mp4').format(
+        screen_size=screen_size,
+        bitrate=bitrate,
+        source_file=pipes.quote(source_file),
+    )
+
+
+class LocalRecordingConverter(object):
+
+    def __init__(self, server_config):
+        self.server_config = server_config
+
+    def list_files(self, recording_name):
+        pattern = _recording_name_pattern(recording_name)
+        return sorted(filename for filename in os.listdir(app_settings.RECORDING_SOURCE_PATH)
+                      if pattern.match(filename))
+
+    def convert_file(self, filename, screen_size, bitrate):
+        source_file = os.path.join(app_settings.RECORDING_SOURCE_PATH, filename)
+        mp4_name = filename + '.m4v.mp4'
+        command = _encode_command(source_file, screen_size, bitrate)
+        try:
+            subprocess.check_call(command, shell=True)
+            shutil.move(source_file + '.m4v.mp4', os.path.join(app_settings.RECORDING_PATH, mp4_name))
+        except (subprocess.CalledProcessError, IOError, OSError) as e:
+            logger.error('guacamole convert session recording error: command[%s], error[%s]', command, e)
+            return None
+        finally:
+            if os.path.exists(source_file + '.m4v'):
+                os.remove(source_file + '.m4v')
+
+        # 转换成功后才删除原始录像, 失败的文件下次继续转换
+        os.remove(source_file)
+        return mp4_name
+
+    def finish(self, callback_script=''):
+        pass
+
+
+# 远程guacamole服务: 一个ssh会话逐个文件转换, 转换好的mp4传回本机
+class RemoteRecordingConverter(object):
+
+    def __init__(self, server_config):
+        self.server_config = server_config
+        self.sc = ssh(server_config['host_ip'], 22, server_config['ssh_username'], server_config['ssh_password'])
+
+    def _exe(self, command, timeout=15):
+        stdin, stdout, stderr = self.sc.exe(command, timeout=timeout)
+        output = stdout.read()
+        return stdout.channel.recv_exit_status(), output, stderr.read()
+
+    def list_files(self, recording_name):
+        pattern = _recording_name_pattern(recording_name)
+        status, output, error = self._exe('ls -1 {}'.format(pipes.quote(app_settings.RECORDING_SOURCE_PATH)))
+        return sorted(filename for filename in output.split() if pattern.match(filename))
+
+    def convert_file(self, filename, screen_size, bitrate):
+        source_file = os.path.join(app_settings.RECORDING_SOURCE_PATH, filename)
+        mp4_name = filename + '.m4v.mp4'
+        command_template = ' && '.join([
+            _encode_command(source_file, screen_size, bitrate),
+            'sshpass -p {self_ssh_pass} scp {source_file}.m4v.mp4 {self_ssh_user}@{self_ssh_host}:{recording_path}',
+            'rm -f {source_file}',
+        ]) + '; status=$?; rm -f {source_file}.m4v {source_file}.m4v.mp4; exit $status'
+        params = {
+            'source_file': pipes.quote(source_file),
+            'self_ssh_host': app_settings.OJ_SERVER['host_ip'],
+            'self_ssh_user': app_settings.OJ_SERVER['ssh_username'],
+            'recording_path': pipes.quote(app_settings.RECORDING_PATH),
+        }
+        command = command_template.format(self_ssh_pass=pipes.quote(app_settings.OJ_SERVER['ssh_password']),
+                                          **params)
+        try:
+            status, output, error = self._exe(command, timeout=app_settings.RECORDING_CONVERT_FILE_TIMEOUT)
+        except Exception as e:
+            status, error = None, e
+        if status != 0:
+            logger.error('guacamole[%s] convert session recording error: command[%s], error[%s]',
+                         self.server_config['host_ip'], command_template.format(self_ssh_pass='******', **params),
+                         error)
+            return None
+        return mp4_name
+
+    def finish(self, callback_script=''):
+        try:
+            if callback_script:
+                self._exe(callback_script)
+        finally:
+            self.sc.close()
+
+
+def get_converter(server):
+    server_config = _get_server_config(server)
+    if not server_config:
+        return None
+    if server_config['host_ip'] == app_settings.OJ_SERVER['host_ip']:
+        return LocalRecordingConverter(server_config)
+    return RemoteRecordingConverter(server_config)
+
+
+# 同步转换一个录像的所有文件, progress_callback在每个文件转换完成后调用
+def convert_recording(server, recording_name, screen_size='1366x768', bitrate=2000000, callback_script='',
+                      skip_names=(), progress_callback=None):
+    screen_size = fix_screen_size(screen_size)
+    if not screen_size:
+        return []
+
+    converter = get_converter(server)
+    if not converter:
+        return []
+
+    mp4_names = []
+    try:
+        filenames = converter.list_files(recording_name)
+        if progress_callback:
+            progress_callback(filenames, mp4_names)
+        for filename in filenames:
+            mp4_name = filename + '.m4v.mp4'
+            if mp4_name in skip_names:
+                continue
+            if converter.convert_file(filename, screen_size, bitrate):
+                mp4_names.append(mp4_name)
+                if progress_callback:
+                    progress_callback(filenames, mp4_names)
+    finally:
+        converter.finish(callback_script)
+    return mp4_names
+
+
+# 添加转换任务, 同名录像只保留一个任务, 完成后执行callback(Executor格式)
+def enqueue_convert(recording_name, server=None, screen_size='1366x768', bitrate=2000000, callback=None):
+    server = server or app_settings.GUACAMOLE_SERVERS[0]['server']
+    with transaction.atomic():
+        job, created = RecordingConvertJob.objects.select_for_update().get_or_create(
+            recording_name=recording_name,
+            defaults={'server': server, 'screen_size': screen_size, 'bitrate': bitrate},
+        )
+        callbacks = json.loads(job.callbacks)
+        if callback:
+            executor = Executor.add_executor(callback)
+            callbacks.append(executor.pk)
+
+        if job.status == RecordingConvertJob.Status.DONE:
+            # 已转换完成的录像直接执行回调
+            job.callbacks = '[]'
+            job.save(update_fields=['callbacks'])
+            for executor_id in callbacks:
+                async_exe(_execute_callback, (executor_id,))
+            return job
+
+        job.callbacks = json.dumps(callbacks)
+        update_fields = ['callbacks']
+        if job.status == RecordingConvertJob.Status.FAILED:
+            job.status = RecordingConvertJob.Status.PENDING
+            job.error = ''
+            job.attempts = 0
+            update_fields.extend(['status', 'error', 'attempts'])
+        job.save(update_fields=update_fields)
+
+    if job.status == RecordingConvertJob.Status.PENDING:
+        async_exe(run_job, (job.pk,), queue=QUEUE_NAME)
+    return job
+
+
+def _execute_callback(executor_id):
+    try:
+        Executor.objects.get(pk=executor_id).execute()
+    except Exception as e:
+        logger.exception('recording convert callback[%s] error: %s', executor_id, e)
+
+
+def run_job(job_id):
+    # 多个进程同时拿到同一个任务时只有一个能执行
+    claimed = RecordingConvertJob.objects.filter(pk=job_id, status=RecordingConvertJob.Status.PENDING).update(
+        status=RecordingConvertJob.Status.RUNNING, update_time=timezone.now())
+    if not claimed:
+        return
+    job = RecordingConvertJob.objects.get(pk=job_id)
+
+    def progress_callback(filenames, mp4_names):
+        all_filenames[:] = filenames
+        done_names = list(skip_names) + mp4_names
+        RecordingConvertJob.objects.filter(pk=job_id).update(
+            total_files=len(set(filename + '.m4v.mp4' for filename in filenames) | set(done_names)),
+            mp4_names=json.dumps(done_names),
+            update_time=timezone.now(),
+        )
+
+    # 中断过的任务跳过已完成的文件
+    skip_names = json.loads(job.mp4_names)
+    all_filenames = []
+    try:
+        mp4_names = convert_recording(job.server, job.recording_name, screen_size=job.screen_size, bitrate=job.bitrate,
+                                      skip_names=skip_names, progress_callback=progress_callback)
+    except Exception as e:
+        logger.exception('recording convert job[%s] error: %s', job.recording_name, e)
+        _retry_or_fail(job, str(e))
+        return
+
+    failed_names = set(filename + '.m4v.mp4' for filename in all_filenames) - set(skip_names) - set(mp4_names)
+    if failed_names:
+        _retry_or_fail(job, 'convert failed: {}'.format(', '.join(sorted(failed_names))))
+        return
+
+    _finish_job(job_id, RecordingConvertJob.Status.DONE)
+
+
+# 有文件转换失败时重新排队, 只转换失败的文件; 次数用完后标记失败并按已转换的文件执行回调
+def _retry_or_fail(job, error):
+    attempts = job.attempts + 1
+    if attempts < app_settings.RECORDING_CONVERT_MAX_ATTEMPTS:
+        logger.info('recording convert job[%s] retry %s: %s', job.recording_name, attempts, error)
+        RecordingConvertJob.objects.filter(pk=job.pk).update(
+            status=RecordingConvertJob.Status.PENDING, attempts=attempts, error=error, update_time=timezone.now())
+        async_exe(run_job, (job.pk,), queue=QUEUE_NAME)
+    else:
+        _finish_job(job.pk, RecordingConvertJob.Status.FAILED, error=error, attempts=attempts)
+
+
+def _finish_job(job_id, status, error='', attempts=None):
+    with transaction.atomic():
+        job = RecordingConvertJob.objects.select_for_update().get(pk=job_id)
+        callbacks = json.loads(job.callbacks)
+        job.status = status
+        job.error = error
+        job.callbacks = '[]'
+        job.update_time = timezone.now()
+        update_fields = ['status', 'error', 'callbacks', 'update_time']
+        if attempts is not None:
+            job.attempts = attempts
+            update_fields.append('attempts')
+        job.save(update_fields=update_fields)
+    for executor_id in callbacks:
+        _execute_callback(executor_id)
+
+
+# 进程重启后继续未完成的任务, 长时间没有进度的运行中任务视为已中断
+def resume_jobs():
+    stale_time = timezone.now() - datetime.timedelta(seconds=app_settings.RECORDING_CONVERT_STALE_SECONDS)
+    RecordingConvertJob.objects.filter(status=RecordingConvertJob.Status.RUNNING, update_time__lt=stale_time).update(
+        status=RecordingConvertJob.Status.PENDING)
+    jobs = RecordingConvertJob.objects.filter(status=RecordingConvertJob.Status.PENDING)
+    job_ids = jobs.values_list('pk', flat=True)
+    for job_id in job_ids:
+        async_exe(run_job, (job_id,), queue=QUEUE_NAME)
+    return len(job_ids)
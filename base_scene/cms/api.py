@@ -12,7 +12,7 @@ from rest_framework.response import Response
 
 from base.utils.rest.mixins import CacheModelMixin, DestroyModelMixin, PMixin
 from base.utils.text import rk
-from base.utils.thread import async_exe
+from base.utils.thread import async_exe, POLL_QUEUE
 
 from base_cloud import api as cloud
 from base_auth.utils.owner import filter_operate_queryset
@@ -333,7 +333,7 @@ class StandardDeviceViewSet(BatchSetOwnerModelMixin, DestroyModelMixin, CacheMod
                 mconsumers.StandardDeviceWebsocket.image_status_update(request.user, device.pk)
 
             handler = DeviceHandler(request.user, device=device)
-            async_exe(handler.create_image, (name, created, failed))
+            async_exe(handler.create_image, (name, created, failed), queue=POLL_QUEUE)
 
             return Response(status=status.HTTP_201_CREATED)
 
@@ -358,8 +358,9 @@ class StandardDeviceSnapshotViewSet(DestroyModelMixin, CacheModelMixin, PMixin,
 
 
 def _image_scene_status_updated(user_id, device_id, *args, **kwargs):
-    StandardDeviceViewSet.clear_self_cache()
     scene_terminal_id = kwargs.get('scene_terminal_id')
+    # 机器状态变化只影响该设备, 场景状态变化可能改变设备镜像状态, 同时失效列表
+    StandardDeviceViewSet.invalidate_cache_rows([device_id], membership=not scene_terminal_id)
     if scene_terminal_id:
         mconsumers.StandardDeviceWebsocket.scene_status_update(user_id, device_id)
 
@@ -1,4 +1,6 @@
+# -*- coding: utf-8 -*-
 
+from base.utils import udict
 from base.utils.models.common import get_obj
 from base.utils.enum import Enum
 from base_auth.utils.common import get_user
@@ -85,3 +87,63 @@ class SceneWebsocket(UserWebsocket):
         if data_handler:
             data_handler(data)
         cls.user_send(user, data, code=cls.Event.SCENE_TERMINAL_STATUS_UPDATE)
+
+    # 多用户推送, 数据只序列化一次
+    @classmethod
+    def scene_status_update_users(cls, users, scene, fields=None):
+        users = list(users)
+        if not users:
+            return
+        data = cls._get_scene_data(users[0], scene, fields=fields)
+        cls.user_send(users, data, code=cls.Event.SCENE_STATUS_UPDATE)
+
+    @classmethod
+    def scene_net_status_update_users(cls, users, scene_net, fields=None):
+        users = list(users)
+        if not users:
+            return
+        data = cls._get_scene_net_data(users[0], scene_net, fields=fields)
+        cls.user_send(users, data, code=cls.Event.SCENE_NET_STATUS_UPDATE)
+
+    # user_fields为各用户不同的字段(远程连接), 其余字段共用
+    @classmethod
+    def scene_terminal_status_update_users(cls, users, scene_terminal, fields=None, data_handler=None,
+                                           user_fields=('access_mode',)):
+        users = list(users)
+        if not users:
+            return
+        scene_terminal = get_obj(scene_terminal, SceneTerminal)
+        data = cls._get_scene_terminal_data(users[0], scene_terminal, fields=fields)
+        if data_handler:
+            data_handler(data)
+
+        user_fields = [field for field in user_fields if udict.need_field(field, fields)]
+        if not user_fields:
+            cls.user_send(users, data, code=cls.Event.SCENE_TERMINAL_STATUS_UPDATE)
+            return
+
+        cls.user_send(users[0], data, code=cls.Event.SCENE_TERMINAL_STATUS_UPDATE)
+        for user in users[1:]:
+            user_data = cls._get_scene_terminal_data(user, scene_terminal, fields=user_fields)
+            if data_handler:
+                data_handler(user_data)
+            user_data = dict(data, **user_data)
+            cls.user_send(user, user_data, code=cls.Event.SCENE_TERMINAL_STATUS_UPDATE)
+
+    # 广播组推送, user仅用于序列化
+    @classmethod
+    def scene_status_update_group(cls, name, user, scene, fields=None):
+        data = cls._get_scene_data(user, scene, fields=fields)
+        cls.group_send(name, data, code=cls.Event.SCENE_STATUS_UPDATE)
+
+    @classmethod
+    def scene_net_status_update_group(cls, name, user, scene_net, fields=None):
+        data = cls._get_scene_net_data(user, scene_net, fields=fields)
+        cls.group_send(name, data, code=cls.Event.SCENE_NET_STATUS_UPDATE)
+
+    @classmethod
+    def scene_terminal_status_update_group(cls, name, user, scene_terminal, fields=None, data_handler=None):
+        data = cls._get_scene_terminal_data(user, scene_terminal, fields=fields)
+        if data_handler:
+            data_handler(data)
+        cls.group_send(name, data, code=cls.Event.SCENE_TERMINAL_STATUS_UPDATE)
@@ -6,9 +6,11 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 
 from base.utils.rest.decorators import request_data
+from base_auth.utils.rest.permissions import IsAdmin
 
-from base_scene.models import SceneTerminal
+from base_scene.models import Scene, SceneTerminal
 from base_scene.common.scene import SceneHandler
+from base_scene.common.util.executor import get_build_executor
 
 from .error import error
 
@@ -42,8 +44,31 @@ def report_server_status(request):
     handler = SceneHandler(scene_terminal.scene.user, scene=scene_terminal.scene)
     try:
         handler.scene_util.report_terminal_status(scene_terminal, server_status)
+        handler.scene_util.get_terminal_util(scene_terminal).report_probe_status(server_status)
     except Exception as e:
         logger.error('terminal[server=%s] save error: %s', server_id, e)
         raise exceptions.APIException(error.ERROR)
 
     return Response()
+
+
+# 场景创建日志, 前端带上次返回的cursor增量读取
+@api_view(['GET'])
+@permission_classes((IsAdmin,))
+@request_data()
+def scene_logs(request, scene_id):
+    try:
+        scene = Scene.objects.get(pk=scene_id)
+    except Scene.DoesNotExist:
+        raise exceptions.NotFound()
+
+    since = request.query_data.get('since', int) or 0
+    handler = SceneHandler(request.user, scene=scene)
+    return Response(handler.tail_logs(since=since))
+
+
+# 当前进程场景构建执行器的排队、运行、等待时间统计
+@api_view(['GET'])
+@permission_classes((IsAdmin,))
+def build_executor_metrics(request):
+    return Response(get_build_executor().metrics())
@@ -14,4 +14,6 @@ viewsets = (
 
 apiurlpatterns = [
     url(r'^report_server_status/$', rest_views.report_server_status, name='report_server_status'),
+    url(r'^scene/(?P<scene_id>[0-9]+)/logs/$', rest_views.scene_logs, name='scene_logs'),
+    url(r'^build_executor/metrics/$', rest_views.build_executor_metrics, name='build_executor_metrics'),
 ]
@@ -81,6 +81,9 @@ class GetMixin(object):
     def get_all_remote_info(self):
         return self.scene_util.get_all_remote_info()
 
+    def tail_logs(self, since=0, limit=None):
+        return self.scene_util.tail_logs(since=since, limit=limit)
+
     def get_console_url(self, scene_terminal=None, terminal_sub_id=None):
         terminal_util = self.get_terminal_util(scene_terminal=scene_terminal, sub_id=terminal_sub_id)
         return terminal_util.get_console_url()
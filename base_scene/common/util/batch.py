@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import threading
+
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+
+logger = logging.getLogger(__name__)
+
+
+# 状态事件按节点合并的键
+status_event_keys = (
+    'scene_id',
+    'scene_net_id',
+    'scene_gateway_id',
+    'scene_terminal_id',
+)
+
+
+# 场景创建阶段的工作单元: 收集节点字段变更和状态事件, 阶段结束时批量写库、合并通知
+class SceneUnitOfWork(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changes = collections.OrderedDict()
+        self._events = collections.OrderedDict()
+
+    def stage(self, node, fields):
+        key = (node.__class__, node.pk)
+        with self._lock:
+            staged = self._changes.get(key)
+            if staged:
+                staged[1].update(fields)
+            else:
+                self._changes[key] = (node, set(fields))
+
+    def emit(self, kwargs):
+        key = tuple((name, kwargs.get(name)) for name in status_event_keys)
+        with self._lock:
+            # 同一节点只保留最后一次状态
+            self._events.pop(key, None)
+            self._events[key] = kwargs
+
+    def flush(self):
+        with self._lock:
+            changes = self._changes
+            events = self._events
+            self._changes = collections.OrderedDict()
+            self._events = collections.OrderedDict()
+
+        if changes:
+            model_changes = collections.OrderedDict()
+            for (model, pk), (node, fields) in changes.items():
+                model_changes.setdefault(model, []).append((node, fields))
+            with transaction.atomic():
+                for model, node_fields in model_changes.items():
+                    self._bulk_update(model, node_fields)
+
+        return events.values()
+
+    def _bulk_update(self, model, node_fields):
+        field_nodes = collections.OrderedDict()
+        for node, fields in node_fields:
+            for field in fields:
+                field_nodes.setdefault(field, []).append(node)
+
+        # 每个字段一条update
+        for field, nodes in field_nodes.items():
+            model_field = model._meta.get_field(field)
+            if len(nodes) == 1:
+                node = nodes[0]
+                model.objects.filter(pk=node.pk).update(**{field: getattr(node, model_field.attname)})
+                continue
+            whens = [When(pk=node.pk, then=Value(getattr(node, model_field.attname), output_field=model_field))
+                     for node in nodes]
+            model.objects.filter(pk__in=[node.pk for node in nodes]).update(**{
+                field: Case(*whens, output_field=model_field)
+            })
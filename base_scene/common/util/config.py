@@ -5,6 +5,7 @@ from base.utils.models.common import get_obj
 
 from base_scene.models import StandardDevice, SceneConfig, Scene, SceneNet, SceneGateway, SceneTerminal
 from base_scene.utils import common
+from base_scene.utils.estimate import config_fingerprint
 
 
 class ConfigUtil(object):
@@ -22,6 +23,7 @@ class ConfigUtil(object):
             'type': self.scene_config.type,
             'file': self.scene_config.file,
             'json_config': self.scene_config.json_config,
+            'config_fingerprint': config_fingerprint(self.json_config),
             'hang_info': json.dumps(self.hang_info),
             'status': Scene.Status.CREATING,
         }
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+
+from base_scene import app_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HOST = ''
+
+
+class BuildJob(object):
+
+    def __init__(self, func, args=None, kwargs=None, scene=None, host=None, tag=None):
+        self.func = func
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.scene = scene
+        self.host = host or DEFAULT_HOST
+        self.tag = tag
+        self.submit_time = time.time()
+        self.start_time = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+
+# 场景资源构建执行器: 全局并发上限、单场景并发上限, 各计算节点队列轮转取任务
+class SceneBuildExecutor(object):
+
+    def __init__(self, max_workers=None, scene_workers=None, host_workers=None):
+        self.max_workers = max_workers or app_settings.BUILD_WORKERS
+        self.scene_workers = scene_workers or app_settings.BUILD_SCENE_WORKERS
+        self.host_workers = host_workers or app_settings.BUILD_HOST_WORKERS
+
+        self._condition = threading.Condition()
+        self._queues = collections.OrderedDict()
+        self._running_scenes = collections.Counter()
+        self._running_hosts = collections.Counter()
+        self._running = 0
+        self._workers = []
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'max_queue_depth': 0,
+            'total_wait_seconds': 0.0,
+        }
+
+    def submit(self, func, args=None, kwargs=None, scene=None, host=None, tag=None):
+        job = BuildJob(func, args, kwargs, scene=scene, host=host, tag=tag)
+        with self._condition:
+            self._queues.setdefault(job.host, collections.deque()).append(job)
+            self._stats['submitted'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self._queue_depth())
+            self._ensure_workers()
+            self._condition.notify_all()
+        return job
+
+    # 取消还在排队的任务
+    def cancel(self, scene=None, tag=None):
+        cancelled = 0
+        with self._condition:
+            for host, queue in self._queues.items():
+                for job in list(queue):
+                    if scene is not None and job.scene != scene:
+                        continue
+                    if tag is not None and job.tag != tag:
+                        continue
+                    queue.remove(job)
+                    job.cancelled = True
+                    job.done.set()
+                    cancelled += 1
+                if not queue:
+                    self._queues.pop(host)
+            self._stats['cancelled'] += cancelled
+        return cancelled
+
+    def metrics(self):
+        with self._condition:
+            queued_by_host = {host: len(queue) for host, queue in self._queues.items()}
+            queued_by_scene = collections.Counter()
+            for queue in self._queues.values():
+                for job in queue:
+                    queued_by_scene[job.scene] += 1
+            finished = self._stats['completed'] + self._stats['failed']
+            metrics = {
+                'workers': len(self._workers),
+                'max_workers': self.max_workers,
+                'running': self._running,
+                'queued': sum(queued_by_host.values()),
+                'queued_by_host': queued_by_host,
+                'queued_by_scene': dict(queued_by_scene),
+                'running_by_host': dict(self._running_hosts),
+                'running_by_scene': dict(self._running_scenes),
+                'avg_wait_seconds': round(self._stats['total_wait_seconds'] / finished, 3) if finished else 0,
+            }
+            metrics.update(self._stats)
+            metrics.pop('total_wait_seconds')
+        return metrics
+
+    def _queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _ensure_workers(self):
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.max_workers and len(self._workers) < self._running + self._queue_depth():
+            worker = threading.Thread(target=self._work, name='scene-build-%s' % len(self._workers))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _can_run(self, job):
+        if job.scene is not None and self._running_scenes[job.scene] >= self.scene_workers:
+            return False
+        if job.host != DEFAULT_HOST and self._running_hosts[job.host] >= self.host_workers:
+            return False
+        return True
+
+    # 按计算节点轮转, 避免单个节点的任务占满执行器
+    def _next_job(self):
+        for host in list(self._queues.keys()):
+            queue = self._queues[host]
+            for job in queue:
+                if self._can_run(job):
+                    queue.remove(job)
+                    # 取过任务的节点排到最后
+                    self._queues.pop(host)
+                    if queue:
+                        self._queues[host] = queue
+                    return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    if not self._queues:
+                        # 空闲退出, 由下次提交重新拉起
+                        self._condition.wait(app_settings.BUILD_WORKER_IDLE_SECONDS)
+                        if not self._queues:
+                            self._workers = [worker for worker in self._workers
+                                             if worker is not threading.current_thread()]
+                            return
+                    else:
+                        self._condition.wait()
+                    job = self._next_job()
+
+                job.start_time = time.time()
+                self._stats['total_wait_seconds'] += job.start_time - job.submit_time
+                self._running += 1
+                self._running_hosts[job.host] += 1
+                if job.scene is not None:
+                    self._running_scenes[job.scene] += 1
+
+            failed = False
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                failed = True
+                logger.exception('scene[%s] build job %s error: %s', job.scene, job.tag, e)
+            finally:
+                close_old_connections()
+
+            with self._condition:
+                self._running -= 1
+                self._running_hosts[job.host] -= 1
+                if not self._running_hosts[job.host]:
+                    del self._running_hosts[job.host]
+                if job.scene is not None:
+                    self._running_scenes[job.scene] -= 1
+                    if not self._running_scenes[job.scene]:
+                        del self._running_scenes[job.scene]
+                self._stats['failed' if failed else 'completed'] += 1
+                self._condition.notify_all()
+            job.done.set()
+
+
+_build_executor = None
+_build_executor_lock = threading.Lock()
+
+
+def get_build_executor():
+    global _build_executor
+    if _build_executor is None:
+        with _build_executor_lock:
+            if _build_executor is None:
+                _build_executor = SceneBuildExecutor()
+    return _build_executor
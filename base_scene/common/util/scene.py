@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import logging
 import json
+import threading
 import time
 
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Q, F
 from django.utils import timezone
 from rest_framework.reverse import reverse
 
@@ -13,28 +15,35 @@ from base.utils.enum import Enum
 from base.utils.functional import cached_property
 from base.utils.models.common import get_obj
 from base.utils.text import md5
-from base.utils.thread import async_exe
+from base.utils.thread import async_exe, TaskGraph
 
 from base_proxy import api as proxy
 from base_proxy import app_settings as proxy_settings
 from base_cloud import api as cloud
+from base_remote.managers import RemoteManager, get_remote_server
 from base_scene import app_settings
 from base_scene.common.error import error
 from base_scene.common.exceptions import SceneException
-from base_scene.utils import common
-from base_scene.utils.vis_config import backend_to_vis
-from base_scene.models import Scene, SceneNet, SceneGateway, SceneTerminal
+from base_scene.utils import common, estimate
+from base_scene.utils.vis_config import cached_backend_to_vis
+from base_scene.models import Scene, SceneLog, SceneNet, SceneGateway, SceneTerminal, StandardDevice
 
 from .net import NetUtil
 from .gateway import GatewayUtil
-from .terminal import (TerminalUtil, ip_type, process_status as terminal_process_status,
-                       using_status as terminal_using_status)
+from .terminal import (TerminalUtil, allocate_network_ports, ip_type, load_remote_connections,
+                       process_status as terminal_process_status, using_status as terminal_using_status)
 from .constants import StatusUpdateEvent
+from .executor import get_build_executor
+from .batch import SceneUnitOfWork
 
 
 logger = logging.getLogger(__name__)
 
 
+TERMINAL_CREATE_TAG = 'create_terminal'
+TERMINAL_DELETE_TAG = 'delete_terminal'
+
+
 create_message = Enum(
     CREATE_NETWORK='正在创建网络{name}',
     CREATE_ROUTER='正在创建路由{name}',
@@ -55,6 +64,28 @@ using_status = (
 
 default_name_prefix = 'default'
 
+# 创建准备阶段写入的终端字段
+terminal_prepare_fields = (
+    'system_type',
+    'system_sub_type',
+    'image_type',
+    'flavor',
+    'net_configs',
+    'float_ip',
+    'float_ip_params',
+    'net_ports',
+    'init_script',
+    'install_script',
+    'deploy_script',
+    'clean_script',
+    'push_flag_script',
+    'check_script',
+    'attack_script',
+    'volumes',
+    'create_params',
+    'proxy_port',
+)
+
 node_classes = (
     NetUtil,
     GatewayUtil,
@@ -62,6 +93,20 @@ node_classes = (
 )
 
 
+# 场景终端记录的浮动ip(包括准备好但还没绑定的), 浮动ip预热池补充时排除
+@cloud.network.register_fips_in_use
+def scene_fips_in_use():
+    fip_addrs = set()
+    terminals = SceneTerminal.objects.exclude(status=SceneTerminal.Status.DELETED)
+    for float_ip, float_ip_params in terminals.values_list('float_ip', 'float_ip_params'):
+        if float_ip:
+            fip_addrs.add(float_ip)
+        float_ip_info = json.loads(float_ip_params or '{}').get('float_ip_info')
+        if float_ip_info:
+            fip_addrs.add(float_ip_info[0])
+    return fip_addrs
+
+
 class PropertyMixin(object):
 
     @cached_property
@@ -76,15 +121,24 @@ class PropertyMixin(object):
         return json.loads(self.scene.hang_info)
 
     @cached_property
-    def status_updated(self):
+    def status_executor(self):
         if self.scene.status_updated:
-            execute = self.scene.status_updated.execute
+            return self.scene.status_updated.execute
         else:
-            execute = None
+            return None
+
+    @cached_property
+    def status_updated(self):
+        execute = self.status_executor
 
         def wrapper(*args, **kwargs):
             if execute:
-                async_exe(execute, args=args, kwargs=kwargs)
+                unit = self._unit
+                # 批量阶段中的状态事件合并到阶段结束统一通知
+                if unit is not None and not args:
+                    unit.emit(kwargs)
+                else:
+                    async_exe(execute, args=args, kwargs=kwargs, queue='status')
 
         return wrapper
 
@@ -105,15 +159,47 @@ class PropertyMixin(object):
     def scene_nets(self):
         return list(self.scene.scenenet_set.all())
 
+    # 网关、终端连接的网络一次预加载, 避免逐个节点查询
     @cached_property
     def scene_gateways(self):
-        return list(self.scene.scenegateway_set.all())
+        return list(self.scene.scenegateway_set.prefetch_related('nets'))
 
     @cached_property
     def scene_terminals(self):
         if self.scene is None:
             return []
-        return list(self.scene.sceneterminal_set.all())
+        return list(self.scene.sceneterminal_set.prefetch_related('nets'))
+
+    # 终端镜像对应的标准设备, 镜像名或快照名匹配
+    @cached_property
+    def terminal_standard_devices(self):
+        images = set(scene_terminal.image for scene_terminal in self.scene_terminals if scene_terminal.image)
+        if not images:
+            return {}
+
+        devices = StandardDevice.objects.filter(
+            Q(standarddevicesnapshot__name__in=images) | Q(name__in=images)
+        ).annotate(snapshot_name=F('standarddevicesnapshot__name')).order_by('pk')
+        mapping = {}
+        for device in devices:
+            if device.name in images:
+                mapping.setdefault(device.name, device)
+            if device.snapshot_name in images:
+                mapping.setdefault(device.snapshot_name, device)
+        return mapping
+
+    @cached_property
+    def remote_managers(self):
+        return {}
+
+    # 同一个guacamole服务的终端共用一个RemoteManager
+    def get_remote_manager(self, host):
+        server = get_remote_server(host)
+        remote_manager = self.remote_managers.get(server)
+        if not remote_manager:
+            remote_manager = RemoteManager(self.user, server=server)
+            self.remote_managers[server] = remote_manager
+        return remote_manager
 
     @cached_property
     def virtual_scene_nets(self):
@@ -238,6 +324,23 @@ class GetMixin(object):
             data['vis_structure'] = self.get_vis_structure(fields=fields)
         return data
 
+    # 预先给终端填充批量查询的标准设备、远程连接和共用的RemoteManager
+    def prefetch_node_utils(self):
+        standard_devices = self.terminal_standard_devices
+        user = getattr(self, 'user', None)
+        remote = getattr(self, 'remote', False) and user
+        if remote:
+            terminal_connections = load_remote_connections(self.scene_terminals, user_id=user.id)
+        for scene_terminal in self.scene_terminals:
+            terminal_util = self.get_terminal_util(scene_terminal)
+            terminal_util.standard_device = standard_devices.get(scene_terminal.image)
+            if remote:
+                terminal_util.remote_manager = self.get_remote_manager(scene_terminal.host_ip)
+                terminal_util.user_remote_connections = {
+                    access_mode_key: connection_id
+                    for user_id, access_mode_key, connection_id in terminal_connections[scene_terminal.pk]
+                }
+
     def get_vis_structure(self, fields=None):
         scene = self.scene
         net_fields = fields.get('net') if fields else None
@@ -251,8 +354,9 @@ class GetMixin(object):
         sub_id_scenegateway = {scene_gateway.sub_id: scene_gateway for scene_gateway in self.scene_gateways}
         sub_id_sceneterminal = {scene_terminal.sub_id: scene_terminal for scene_terminal in self.scene_terminals}
 
-        json_config = json.loads(scene.json_config)
-        vis_structure = backend_to_vis(json_config)
+        self.prefetch_node_utils()
+        # 拓扑骨架按配置指纹缓存, 每次只重新计算各节点的_instance
+        vis_structure = cached_backend_to_vis(scene.json_config, fingerprint=scene.config_fingerprint)
         vis_nodes = vis_structure['nodes']
         id_node = {}
         sub_id_node = {}
@@ -315,19 +419,22 @@ class GetMixin(object):
     def get_data(self, fields=None):
         scene = self.scene
 
-        logs = json.loads(scene.log)
-        if logs:
-            log = logs[-1]
-            log = log['message'].format(**log['params'] or {})
-        else:
-            log = ''
         data = {
             'id': scene.id,
             'name': scene.name,
             'status': scene.status,
             'error': scene.error,
-            'log': log,
         }
+        if udict.need_field('log', fields):
+            # 只取最新一条, 按(scene, id)索引倒序
+            latest = SceneLog.objects.filter(scene_id=scene.pk).order_by('-id').values('message', 'params').first()
+            if latest:
+                log = SceneLog.render(latest['message'], json.loads(latest['params']))
+            else:
+                # 兼容旧数据记录在Scene.log中的日志
+                logs = json.loads(scene.log)
+                log = SceneLog.render(logs[-1]['message'], logs[-1]['params']) if logs else ''
+            data['log'] = log
         return udict.filter_data(data, fields)
 
     # 获取最新状态
@@ -340,7 +447,7 @@ class GetMixin(object):
         return latest_status
 
     def get_process_seconds(self):
-        consume_time = get_scene_estimate_consume_time(self.scene.json_config)
+        consume_time = estimate.estimate_scene(self.scene)
         return common.get_part_seconds(self.scene.create_time, consume_time)
 
     def get_resource_name(self, name):
@@ -348,11 +455,13 @@ class GetMixin(object):
         return '.'.join([app_settings.BASE_GROUP_NAME, name_prefix, self.scene.name, name])
 
     def get_all_remote_info(self):
+        terminal_connections = load_remote_connections(self.scene_terminals)
         remote_info = {}
         for scene_terminal in self.scene_terminals:
-            terminal_util = self.get_terminal_util(scene_terminal)
-            terminal_remote_info = terminal_util.get_all_remote_info()
-            remote_info[scene_terminal.sub_id] = terminal_remote_info
+            remote_info[scene_terminal.sub_id] = {
+                str(user_id): connection_id
+                for user_id, access_mode_key, connection_id in terminal_connections[scene_terminal.pk]
+            }
         return remote_info
 
 
@@ -367,12 +476,68 @@ class CreateMixin(object):
                 'routers': [],
                 'fips': {},
                 'external_net_ports': {},
+                'ports': [],
                 'vms': [],
                 'dockers': {},
                 'firewalls': [],
                 'policies': [],
             }
 
+    def track_resource(self, resource_type, resource_id):
+        with self._lock:
+            self._resource[resource_type].append(resource_id)
+
+    # 记录创建各阶段耗时, 开始新阶段即结束上一阶段
+    # batch阶段的节点写入和状态事件在阶段结束时批量提交
+    def start_phase(self, phase, batch=False):
+        self.flush_unit()
+        if batch:
+            self._unit = SceneUnitOfWork()
+
+        now = time.time()
+        if not hasattr(self, 'phase_timing'):
+            self.phase_timing = []
+        if self.phase_timing and self.phase_timing[-1]['end'] is None:
+            self.phase_timing[-1]['end'] = now
+        if phase:
+            self.phase_timing.append({'phase': phase, 'start': now, 'end': None})
+
+    def stage_node(self, node, fields):
+        unit = self._unit
+        if unit is not None:
+            unit.stage(node, fields)
+        else:
+            node.__class__.objects.filter(pk=node.pk).update(**{field: getattr(node, field) for field in fields})
+
+    def flush_unit(self):
+        unit = self._unit
+        if unit is None:
+            return
+        self._unit = None
+
+        events = unit.flush()
+        execute = self.status_executor
+        if events and execute:
+            def dispatch():
+                for kwargs in events:
+                    try:
+                        execute(**kwargs)
+                    except Exception as e:
+                        logger.error('scene[%s] status updated error: %s', self.scene.pk, e)
+            async_exe(dispatch, queue='status')
+
+    def get_phase_timing(self):
+        return [(timing['phase'], round((timing['end'] or time.time()) - timing['start'], 3))
+                for timing in getattr(self, 'phase_timing', [])]
+
+    def report_phase_timing(self):
+        self.start_phase(None)
+        timing = self.get_phase_timing()
+        if timing:
+            logger.info('scene[%s] create phase timing: %s', self.scene.pk,
+                        ', '.join('%s=%ss' % (phase, seconds) for phase, seconds in timing))
+        return timing
+
     def prepare_create(self, float_ips=None, pre_fips=None):
         self.float_ips = float_ips
         self.pre_fips = pre_fips
@@ -386,9 +551,9 @@ class CreateMixin(object):
 
         self.ensure_create_resource()
         if self.is_local:
-            async_exe(self._local_create_resourcem, (prepare,))
+            async_exe(self._local_create_resourcem, (prepare,), queue='scene')
         else:
-            async_exe(self._create_resource, (prepare,))
+            async_exe(self._create_resource, (prepare,), queue='scene')
 
     def create_related_resources(self):
         self.ensure_create_resource()
@@ -474,6 +639,14 @@ class CreateMixin(object):
                 except Exception:
                     pass
 
+        ports = self._resource.get('ports')
+        if ports:
+            for port_id in ports:
+                try:
+                    cloud.network.delete_port(port_id)
+                except Exception:
+                    pass
+
         firewalls = self._resource.get('firewalls')
         if firewalls:
             for firewall_id in firewalls:
@@ -519,6 +692,7 @@ class CreateMixin(object):
             else:
                 logger.info('scene[%s] create ok', scene.pk)
                 self.status_updated(status=Scene.Status.RUNNING, scene_id=scene.pk, scene=scene)
+                async_exe(estimate.record_scene, (scene,))
         elif scene.status in using_status:
             pass
         else:
@@ -529,7 +703,7 @@ class CreateMixin(object):
                 'created_time': current_time,
                 'consume_time': int(consume_time.total_seconds()),
             })
-            async_exe(self.delete_resource)
+            async_exe(self.delete_resource, queue='scene')
 
     def create_resource_failed(self, error):
         scene = self.scene
@@ -548,7 +722,7 @@ class CreateMixin(object):
             logger.error('scene[%s] update except: %s' % (scene.id, e))
         else:
             if has_deleted:
-                async_exe(self.delete_resource)
+                async_exe(self.delete_resource, queue='scene')
             else:
                 self.status_updated(status=Scene.Status.ERROR, scene_id=scene.pk, scene=scene)
 
@@ -564,6 +738,7 @@ class CreateMixin(object):
                                                               net_configs}
 
             # 解析脚本
+            self.start_phase('terminal_prepare', batch=True)
             for scene_terminal in self.virtual_scene_terminals:
                 terminal_util = self.get_terminal_util(scene_terminal)
                 update_params = {
@@ -577,9 +752,11 @@ class CreateMixin(object):
                     'attack_script': terminal_util.parse_script(scene_terminal.attack_script, terminal_sub_id_net),
                     'status': SceneTerminal.Status.PREPARED,
                 }
-                terminal_util.update_node(update_params)
+                terminal_util.update_node(update_params, save=False)
+                self.stage_node(scene_terminal, update_params.keys())
                 self.status_updated(status=SceneTerminal.Status.PREPARED, scene_terminal_id=scene_terminal.pk,
                                     scene_terminal=scene_terminal)
+            self.report_phase_timing()
 
             if prepare:
                 pass
@@ -591,79 +768,107 @@ class CreateMixin(object):
                             self.local_create_terminal_task(scene_terminal)
                         except Exception as e:
                             self.create_resource_failed(e)
-                    async_exe(tmp_task, (scene_terminal,))
+                    self.submit_terminal_task(scene_terminal, tmp_task, (scene_terminal,))
         except Exception as e:
+            self.report_phase_timing()
             self.create_resource_failed(scene, e)
 
+    def _create_scene_net(self, scene_net, net_util, cidr=None):
+        self.log(create_message.CREATE_NETWORK, {'name': scene_net.name})
+        resource_name = self.get_resource_name(scene_net.name)
+
+        interfaces = []
+        if scene_net.is_real:
+            real_attachs = self.net_real_attachs.get(scene_net.sub_id)
+            for real_attach in real_attachs:
+                try:
+                    net_configs = json.loads(real_attach.net_configs)
+                except Exception:
+                    net_configs = []
+                for net_config in net_configs:
+                    interfaces.extend(net_config.get('interfaces', []))
+
+        network = net_util.create_network(resource_name, cidr, interfaces=interfaces)
+        self.track_resource('nets', network['net_id'])
+        scene_net.net_id = network['net_id']
+        scene_net.subnet_id = network['subnet_id']
+        scene_net.cidr = network['cidr']
+        scene_net.vlan_id = network['vlan_id']
+        scene_net.vlan_info = json.dumps(network['vlan_info'])
+
+        if not scene_net.is_real:
+            attach_terminals = self.net_terminals.get(scene_net.sub_id)
+            if attach_terminals and net_util.need_proxy_router(attach_terminals=attach_terminals):
+                router = net_util.create_proxy_router('%s_proxy_router' % resource_name)
+                self.track_resource('routers', router['router_id'])
+                scene_net.proxy_router_id = router['router_id']
+
+        scene_net.save()
+        self.status_updated(scene_net_id=scene_net.pk, scene_net=scene_net)
+
+    def _create_scene_gateway(self, scene_gateway, gateway_util):
+        if scene_gateway.type == SceneGateway.Type.ROUTER:
+            self.log(create_message.CREATE_ROUTER, {'name': scene_gateway.name})
+        resource_name = self.get_resource_name(scene_gateway.name)
+
+        router = gateway_util.create_router(resource_name)
+        self.track_resource('routers', router['router_id'])
+
+        scene_gateway.router_id = router['router_id']
+        scene_gateway.save()
+
+    # 按 网络(子网) -> 路由 的依赖关系并发创建网络结构
+    def _create_structure(self):
+        fixed_cidrs = []
+        random_cidr_count = 0
+
+        for scene_net in self.scene_nets:
+            if not common.is_external_net(scene_net.sub_id):
+                if scene_net.cidr:
+                    fixed_cidrs.append(scene_net.cidr)
+                else:
+                    random_cidr_count += 1
+        ran_cidrs = common.random_cidrs(random_cidr_count, fixed_cidrs) if random_cidr_count else []
+
+        # 工作线程中只读, 提前加载
+        self.net_terminals
+        self.net_real_attachs
+
+        graph = TaskGraph(app_settings.PROVISION_WORKERS)
+        for scene_net in self.scene_nets:
+            if not common.is_external_net(scene_net.sub_id):
+                cidr = None if scene_net.cidr else ran_cidrs.pop(0)
+                graph.add(('net', scene_net.sub_id), self._create_scene_net,
+                          (scene_net, self.get_net_util(scene_net), cidr))
+
+        for scene_gateway in self.virtual_scene_gateways:
+            if scene_gateway.type in (SceneGateway.Type.ROUTER, SceneGateway.Type.FIREWALL):
+                deps = [('net', scene_net.sub_id) for scene_net in scene_gateway.nets.all()
+                        if not common.is_external_net(scene_net.sub_id)]
+                graph.add(('gateway', scene_gateway.sub_id), self._create_scene_gateway,
+                          (scene_gateway, self.get_gateway_util(scene_gateway)), deps=deps)
+
+        graph.run()
+
+    # 并发更新网络网关
+    def _update_subnet_gateways(self):
+        graph = TaskGraph(app_settings.PROVISION_WORKERS)
+        for scene_net in self.virtual_scene_nets:
+            if scene_net.gateway and scene_net.subnet_id:
+                graph.add(scene_net.sub_id, cloud.network.update_subnet, (scene_net.subnet_id,),
+                          {'gateway_ip': scene_net.gateway})
+        graph.run()
+
     def _create_resource(self, prepare=False):
         scene = self.scene
         try:
-            # 创建网络
-            fixed_cidrs = []
-            random_cidr_count = 0
-
-            for scene_net in self.scene_nets:
-                if not common.is_external_net(scene_net.sub_id):
-                    if scene_net.cidr:
-                        fixed_cidrs.append(scene_net.cidr)
-                    else:
-                        random_cidr_count += 1
-            ran_cidrs = common.random_cidrs(random_cidr_count, fixed_cidrs) if random_cidr_count else []
-
-            for scene_net in self.scene_nets:
-                if not common.is_external_net(scene_net.sub_id):
-                    self.log(create_message.CREATE_NETWORK, {'name': scene_net.name})
-                    resource_name = self.get_resource_name(scene_net.name)
-
-                    interfaces = []
-                    if scene_net.is_real:
-                        real_attachs = self.net_real_attachs.get(scene_net.sub_id)
-                        for real_attach in real_attachs:
-                            try:
-                                net_configs = json.loads(real_attach.net_configs)
-                            except Exception:
-                                net_configs = []
-                            for net_config in net_configs:
-                                interfaces.extend(net_config.get('interfaces', []))
-
-                    net_util = self.get_net_util(scene_net)
-                    if scene_net.cidr:
-                        network = net_util.create_network(resource_name, interfaces=interfaces)
-                    else:
-                        network = net_util.create_network(resource_name, ran_cidrs.pop(0), interfaces=interfaces)
-                    self._resource['nets'].append(network['net_id'])
-                    scene_net.net_id = network['net_id']
-                    scene_net.subnet_id = network['subnet_id']
-                    scene_net.cidr = network['cidr']
-                    scene_net.vlan_id = network['vlan_id']
-                    scene_net.vlan_info = json.dumps(network['vlan_info'])
-
-                    if not scene_net.is_real:
-                        attach_terminals = self.net_terminals.get(scene_net.sub_id)
-                        if attach_terminals and net_util.need_proxy_router(attach_terminals=attach_terminals):
-                            router = net_util.create_proxy_router('%s_proxy_router' % resource_name)
-                            self._resource['routers'].append(router['router_id'])
-                            scene_net.proxy_router_id = router['router_id']
-
-                    scene_net.save()
-                    self.status_updated(scene_net_id=scene_net.pk, scene_net=scene_net)
-
-            # 创建网关(路由器、防火墙)
-            for scene_gateway in self.virtual_scene_gateways:
-                if scene_gateway.type in (SceneGateway.Type.ROUTER, SceneGateway.Type.FIREWALL):
-                    if scene_gateway.type == SceneGateway.Type.ROUTER:
-                        self.log(create_message.CREATE_ROUTER, {'name': scene_gateway.name})
-                    resource_name = self.get_resource_name(scene_gateway.name)
-
-                    gateway_util = self.get_gateway_util(scene_gateway)
-                    router = gateway_util.create_router(resource_name)
-                    self._resource['routers'].append(router['router_id'])
-
-                    scene_gateway.router_id = router['router_id']
-                    scene_gateway.save()
+            # 创建网络、网关(路由器、防火墙)
+            self.start_phase('structure', batch=True)
+            self._create_structure()
 
             # 创建终端
             # 预分配浮动ip
+            self.start_phase('address')
             float_ip_count = 0
             outer_ip_count = 0
             for scene_terminal in self.virtual_scene_terminals:
@@ -727,20 +932,27 @@ class CreateMixin(object):
                 cidr = net_sub_id_cidr[net_sub_id]
                 ran_ips[net_sub_id] = common.random_ips(cidr, count, declared_ips.get(net_sub_id))
 
+            self.start_phase('terminal_network')
             terminal_sub_id_net = {}
             terminal_sub_id_networks = {}
+            network_infos = []
             for scene_terminal in self.virtual_scene_terminals:
                 terminal_util = self.get_terminal_util(scene_terminal)
 
                 prepare_network_param = {
                     'ran_ips': ran_ips,
+                    'allocate_ports': False,
                 }
                 if terminal_util.ip_type == ip_type.FLOAT:
                     prepare_network_param['float_ip_info'] = float_ip_list.pop(0)
                 elif terminal_util.ip_type == ip_type.OUTER_FIXED:
                     prepare_network_param['external_port_info'] = external_net_port_list.pop(0)
-                network_info = terminal_util.prepare_network(**prepare_network_param)
+                network_infos.append(terminal_util.prepare_network(**prepare_network_param))
+
+            # 全部终端的网络端口按网络批量创建
+            allocate_network_ports(network_infos, created_ports=self._resource['ports'])
 
+            for scene_terminal, network_info in zip(self.virtual_scene_terminals, network_infos):
                 scene_terminal.net_configs = json.dumps(network_info['net_configs'])
                 scene_terminal.float_ip = network_info['float_ip']
                 scene_terminal.float_ip_params = json.dumps(network_info['float_ip_params'])
@@ -751,6 +963,7 @@ class CreateMixin(object):
                 terminal_sub_id_net[scene_terminal.sub_id] = {net_config['id']: net_config['ip'] for net_config in
                                                               network_info['net_configs']}
 
+            self.start_phase('terminal_prepare', batch=True)
             restart_proxy = False
             gateway_terminals = []
             normal_terminals = []
@@ -803,7 +1016,7 @@ class CreateMixin(object):
                         self._resource['proxys'].setdefault(scene_terminal.float_ip, set()).update(source_ports)
                         scene_terminal.proxy_port = json.dumps(scene_terminal_proxy_port)
 
-                scene_terminal.save()
+                self.stage_node(scene_terminal, terminal_prepare_fields)
 
                 # 分配创建任务
                 if scene_terminal.role == SceneTerminal.Role.GATEWAY:
@@ -815,22 +1028,26 @@ class CreateMixin(object):
                 proxy.restart_proxy()
 
             # 同步创建虚拟网关机器
+            self.start_phase('gateway_terminal')
             for scene_terminal in gateway_terminals:
                 self.create_terminal_task(scene_terminal)
 
             # 更新网络网关
-            for scene_net in self.virtual_scene_nets:
-                if scene_net.gateway and scene_net.subnet_id:
-                    cloud.network.update_subnet(scene_net.subnet_id, gateway_ip=scene_net.gateway)
+            self.start_phase('subnet_gateway')
+            self._update_subnet_gateways()
 
             if prepare:
+                self.start_phase('prepared', batch=True)
                 for scene_terminal in normal_terminals:
                     terminal_util = self.get_terminal_util(scene_terminal)
-                    terminal_util.update_node({'status': SceneTerminal.Status.PREPARED})
+                    terminal_util.update_node({'status': SceneTerminal.Status.PREPARED}, save=False)
+                    self.stage_node(scene_terminal, ['status'])
                     self.status_updated(status=SceneTerminal.Status.PREPARED, scene_terminal_id=scene_terminal.pk,
                                         scene_terminal=scene_terminal)
                 self.log(create_message.STRUCTURE_CREATED)
+                self.report_phase_timing()
             else:
+                self.report_phase_timing()
                 # 异步创建其他机器
                 for scene_terminal in normal_terminals:
                     def tmp_task(scene_terminal):
@@ -841,9 +1058,10 @@ class CreateMixin(object):
                             msg = traceback.format_exc()
                             logger.error(msg)
                             self.create_resource_failed(e)
-                    async_exe(tmp_task, (scene_terminal,))
+                    self.submit_terminal_task(scene_terminal, tmp_task, (scene_terminal,))
 
         except Exception as e:
+            self.report_phase_timing()
             self.create_resource_failed(e)
 
     def create_terminal_error(self, scene_terminal, error):
@@ -912,11 +1130,6 @@ class CreateMixin(object):
             update_params['host_proxy_port'] = json.dumps(host_proxy_port)
             terminal_util.update_node(update_params, save=False)
 
-        if self.remote:
-            access_modes = json.loads(scene_terminal.access_modes) if scene_terminal.access_modes else []
-            if access_modes and terminal_util._server_add_remote_connection(access_modes):
-                update_params['access_modes'] = json.dumps(access_modes)
-
         terminal_util.update_node(update_params)
 
         if scene_terminal.image_type == SceneTerminal.ImageType.VM and terminal_util.can_access:
@@ -997,7 +1210,12 @@ class CreateMixin(object):
                 terminal_util.attach_disk(volumes)
 
         terminal_util.update_node(terminal_update_params)
+        # 机器可用后批量创建场景所有者的远程连接, 推送状态前完成
+        if is_updating_finally and self.remote and self.scene.user_id:
+            terminal_util.provision_remote_connections([self.scene.user_id])
         self.status_updated(status=status, scene_terminal_id=scene_terminal.pk, scene_terminal=scene_terminal)
+        if is_updating_finally:
+            async_exe(estimate.record_terminal, (terminal_util.node,))
 
         # 全部机器都启动部署完了
         if (not is_updated_finally
@@ -1005,6 +1223,20 @@ class CreateMixin(object):
                 and not terminal_util.scene.sceneterminal_set.exclude(status__in=terminal_using_status).exists()):
             self.create_resource_end()
 
+    # 为运行中的终端批量创建远程连接 terminal_users: {terminal_sub_id: user_ids}
+    def provision_remote_connections(self, terminal_users):
+        count = 0
+        for scene_terminal in self.scene_terminals:
+            user_ids = terminal_users.get(scene_terminal.sub_id)
+            if user_ids and scene_terminal.status in terminal_using_status:
+                terminal_util = self.get_terminal_util(scene_terminal)
+                count += terminal_util.provision_remote_connections(user_ids)
+        return count
+
+    # 终端创建、删除任务统一提交到有界执行器, 按场景和计算节点限制并发
+    def submit_terminal_task(self, scene_terminal, func, args=None, tag=TERMINAL_CREATE_TAG):
+        return get_build_executor().submit(func, args, scene=self.scene.pk, host=scene_terminal.host_ip, tag=tag)
+
     def create_prepared_terminal(self, scene_terminal):
         if scene_terminal.status != SceneTerminal.Status.PREPARED:
             return
@@ -1019,7 +1251,7 @@ class CreateMixin(object):
                     self.create_terminal_task(scene_terminal)
             except Exception as e:
                 self.create_resource_failed(e)
-        async_exe(tmp_task)
+        self.submit_terminal_task(scene_terminal, tmp_task)
 
     def recreate_terminal(self, scene_terminal):
         self.ensure_create_resource()
@@ -1045,7 +1277,7 @@ class CreateMixin(object):
                     self.create_terminal_task(scene_terminal)
             except Exception as e:
                 self.create_resource_failed(e)
-        async_exe(tmp_task)
+        self.submit_terminal_task(scene_terminal, tmp_task)
 
 
 class ControlMixin(object):
@@ -1116,7 +1348,7 @@ class ControlMixin(object):
                     proxy.restart_proxy()
             except Exception as e:
                 logger.error('scene_terminal[%s] delete resource error: %s', scene_terminal.id, e)
-        async_exe(tmp_delete_resource)
+        self.submit_terminal_task(scene_terminal, tmp_delete_resource, tag=TERMINAL_DELETE_TAG)
 
 
 class DeleteMixin(object):
@@ -1134,21 +1366,32 @@ class DeleteMixin(object):
         self.status_updated(status=Scene.Status.DELETED, scene_id=scene.pk, scene=scene,
                             event=StatusUpdateEvent.SCENE_DELETE)
 
+        # 还在排队的终端不用再创建
+        get_build_executor().cancel(scene=scene.pk, tag=TERMINAL_CREATE_TAG)
+
         if sync:
             self.delete_resource(shutdown=shutdown)
         else:
-            async_exe(self.delete_resource, (shutdown,))
+            async_exe(self.delete_resource, (shutdown,), queue='scene')
 
     def delete_resource(self, shutdown=False):
         scene = self.scene
 
         try:
-            has_proxy = False
-            for scene_terminal in self.virtual_scene_terminals:
+            # 终端经执行器并发删除, 全部删完再删网关和网络
+            proxy_results = []
+
+            def tmp_delete_terminal(scene_terminal):
                 terminal_util = self.get_terminal_util(scene_terminal)
                 res = terminal_util.delete_resource(shutdown)
-                if res['has_proxy']:
-                    has_proxy = True
+                proxy_results.append(res['has_proxy'])
+
+            jobs = [self.submit_terminal_task(scene_terminal, tmp_delete_terminal, (scene_terminal,),
+                                              tag=TERMINAL_DELETE_TAG)
+                    for scene_terminal in self.virtual_scene_terminals]
+            for job in jobs:
+                job.wait()
+            has_proxy = any(proxy_results)
 
             if has_proxy:
                 # 删完重启代理
@@ -1170,6 +1413,8 @@ class SceneUtil(GetMixin, CreateMixin, ControlMixin, DeleteMixin, NodeMixin, Pro
     def __init__(self, scene):
         self.scene = get_obj(scene, Scene)
         self._nodes = {}
+        self._lock = threading.RLock()
+        self._unit = None
 
     def __call__(self, user=None, remote=True, proxy=False):
         self.user = user
@@ -1185,21 +1430,20 @@ class SceneUtil(GetMixin, CreateMixin, ControlMixin, DeleteMixin, NodeMixin, Pro
         Scene.objects.filter(pk=self.scene.pk).update(**params)
 
     def log(self, message, params=None):
-        log = Scene.objects.filter(pk=self.scene.pk).values('log')[0]['log']
-        try:
-            log = json.loads(log)
-        except Exception:
-            log = []
-        log.append({'message': message, 'params': params})
-        self.update({'log': json.dumps(log)})
+        SceneLog.objects.create(scene_id=self.scene.pk, message=message, params=json.dumps(params))
         self.status_updated(scene_id=self.scene.pk, scene=self.scene)
 
-
-# 获取预估的场景创建消耗时间
-def get_scene_estimate_consume_time(json_config):
-    similar_scene = Scene.objects.filter(
-        consume_time__gt=0,
-        json_config=json_config,
-    ).order_by('-create_time').first()
-    consume_time = similar_scene.consume_time if similar_scene else None
-    return consume_time
+    # 读取游标since之后的日志, 返回新的游标
+    def tail_logs(self, since=0, limit=None):
+        queryset = SceneLog.objects.filter(scene_id=self.scene.pk, id__gt=since or 0).order_by('id')
+        if limit:
+            queryset = queryset[:limit]
+        logs = [{
+            'id': scene_log.id,
+            'log': SceneLog.render(scene_log.message, json.loads(scene_log.params)),
+            'create_time': scene_log.create_time,
+        } for scene_log in queryset]
+        return {
+            'cursor': logs[-1]['id'] if logs else since or 0,
+            'logs': logs,
+        }
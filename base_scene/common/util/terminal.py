@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import collections
 import json
 import logging
 import re
 import time
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
 from django.utils import six, timezone
 from django.db.models import Q
 
@@ -12,10 +15,12 @@ from base.utils import udict
 from base.utils.enum import Enum
 from base.utils.functional import cached_property
 from base.utils.models.common import get_obj
-from base.utils.network import probe
+from base.utils.network import probe_monitor
 from base.utils.text import rk
 
+from base_auth.models import User
 from base_cloud import api as cloud
+from base_cloud.utils import memcache_lock, MemcacheLockException
 from base_proxy import app_settings as proxy_settings
 from base_proxy import api as proxy
 from base_remote.managers import RemoteManager, MonitorManager
@@ -23,8 +28,8 @@ from base_remote.managers import RemoteManager, MonitorManager
 from base_scene import app_settings
 from base_scene.common.error import error
 from base_scene.common.exceptions import SceneException
-from base_scene.models import StandardDevice, SceneTerminal, Installer
-from base_scene.utils import common
+from base_scene.models import StandardDevice, SceneTerminal, SceneTerminalConnection, Installer
+from base_scene.utils import common, estimate
 from base_scene.utils.docker import create_docker_lock
 
 from .installer import generate_install_script
@@ -83,6 +88,40 @@ remote_protocols = (
 )
 
 
+# 批量预分配终端网络端口, 每个网络一次请求, 失败时删除已创建的端口
+def allocate_network_ports(network_infos, created_ports=None):
+    net_requests = collections.OrderedDict()
+    for network_info in network_infos:
+        for network, net_id, fixed_ip in network_info['port_requests']:
+            net_requests.setdefault(net_id, []).append((network, fixed_ip))
+
+    net_ports = []
+    try:
+        for net_id, requests in net_requests.items():
+            port_map = cloud.network.preallocate_ports(net_id, pre_ips=[fixed_ip for network, fixed_ip in requests])
+            net_ports.extend(port_map.values())
+            if len(port_map) < len(requests):
+                raise SceneException(error.NO_ENOUGH_IP)
+            for network, fixed_ip in requests:
+                network['port_id'] = port_map[fixed_ip]
+    except Exception as e:
+        for net_port in net_ports:
+            try:
+                cloud.network.delete_port(net_port)
+            except Exception:
+                pass
+        raise e
+
+    if created_ports is not None:
+        created_ports.extend(net_ports)
+    for network_info in network_infos:
+        network_info['net_ports'] = [network['port_id'] for network, net_id, fixed_ip in
+                                     network_info.pop('port_requests')]
+        external_port_id = network_info.pop('external_port_id')
+        if external_port_id:
+            network_info['net_ports'].append(external_port_id)
+
+
 class PropertyMixin(object):
 
     node_model = SceneTerminal
@@ -151,6 +190,14 @@ class PropertyMixin(object):
     def remote_manager(self):
         return RemoteManager(self.user, host=self.node.host_ip)
 
+    # 当前用户各访问方式的远程连接 {access_mode_key: connection_id}
+    @cached_property
+    def user_remote_connections(self):
+        if not getattr(self, 'user', None):
+            return {}
+        connections = load_remote_connections([self.node], user_id=self.user.id)[self.node.pk]
+        return {access_mode_key: connection_id for user_id, access_mode_key, connection_id in connections}
+
     @property
     def can_access(self):
         return can_access_terminal(self.node, self.standard_device)
@@ -186,9 +233,10 @@ class UtilMixin(object):
             last_status = self.get_latest_status()
             return last_status in end_status
 
-        probe(
+        probe_monitor.watch(
             ip,
             port=port,
+            key=self.probe_key,
             limit_time=limit_time,
             step_time=step_time,
             stop_check=stop_check,
@@ -197,6 +245,15 @@ class UtilMixin(object):
             timeout_callback=created
         )
 
+    @property
+    def probe_key(self):
+        return 'terminal:%s' % self.node.pk
+
+    # 机器上报运行(RUNNING)等最终状态时结束探测; 部署中(DEPLOYING)的上报只走正常的状态更新, 探测继续
+    def report_probe_status(self, status):
+        if status in end_status:
+            probe_monitor.cancel(self.probe_key)
+
     # 超时检查
     def timout_check_status(self, created, limit_time=app_settings.CHECK_TERMINAL_TIMEOUT, step_time=1):
         scene_terminal = self.node
@@ -263,7 +320,7 @@ class UtilMixin(object):
 
         return ' '.join(parsed_parts)
 
-    def add_ssh_connection(self, hostname, port=22, username=None, password=None, private_key=None):
+    def _ssh_connection_param(self, hostname, port=22, username=None, password=None, private_key=None):
         connection_name = '%s:%s:%s:%s' % (self.user.id, hostname, port, rk())
         kwargs = {
             'port': port
@@ -274,15 +331,10 @@ class UtilMixin(object):
             kwargs['password'] = password
         if private_key:
             kwargs['private_key'] = private_key
-        try:
-            connection = self.remote_manager.create_ssh_connection(connection_name, hostname, **kwargs)
-        except Exception as e:
-            logger.error('add ssh connection error: %s' % e)
-            return None
-
-        return connection.connection_id
+        return dict(kwargs, connection_name=connection_name, hostname=hostname)
 
-    def add_rdp_connection(self, hostname, port=3389, username=None, password=None, security=None, system_type=None):
+    def _rdp_connection_param(self, hostname, port=3389, username=None, password=None, security=None,
+                              system_type=None):
         connection_name = '%s:%s:%s:%s' % (self.user.id, hostname, port, rk())
         kwargs = {
             'port': port
@@ -296,21 +348,154 @@ class UtilMixin(object):
 
         if system_type and system_type == SceneTerminal.SystemType.LINUX:
             kwargs['enable-sftp'] = 'true'
+        return dict(kwargs, connection_name=connection_name, hostname=hostname)
+
+    def add_ssh_connection(self, hostname, port=22, username=None, password=None, private_key=None):
+        connection_ids = self.add_ssh_connections([{
+            'hostname': hostname,
+            'port': port,
+            'username': username,
+            'password': password,
+            'private_key': private_key,
+        }])
+        return connection_ids[0] if connection_ids else None
+
+    def add_rdp_connection(self, hostname, port=3389, username=None, password=None, security=None, system_type=None):
+        connection_ids = self.add_rdp_connections([{
+            'hostname': hostname,
+            'port': port,
+            'username': username,
+            'password': password,
+            'security': security,
+            'system_type': system_type,
+        }])
+        return connection_ids[0] if connection_ids else None
+
+    # 批量添加, 失败时返回空列表
+    def add_ssh_connections(self, params_list):
+        try:
+            connections = self.remote_manager.create_ssh_connections(
+                [self._ssh_connection_param(**params) for params in params_list])
+        except Exception as e:
+            logger.error('add ssh connection error: %s' % e)
+            return []
+
+        return [connection.connection_id for connection in connections]
 
+    def add_rdp_connections(self, params_list):
         try:
-            connection = self.remote_manager.create_rdp_connection(connection_name, hostname, **kwargs)
+            connections = self.remote_manager.create_rdp_connections(
+                [self._rdp_connection_param(**params) for params in params_list])
         except Exception as e:
             logger.error('add rdp connection error: %s' % e)
-            return None
+            return []
 
-        return connection.connection_id
+        return [connection.connection_id for connection in connections]
 
     def remove_connection(self, connection_id):
+        self.remove_connections([connection_id])
+
+    def remove_connections(self, connection_ids):
         try:
-            self.remote_manager.remove_connection(connection_id)
+            self.remote_manager.remove_connections(connection_ids)
         except Exception as e:
             logger.error('remove connection error: %s' % e)
 
+    # 可创建远程连接的访问方式 [(access_mode_key, protocol, params)]
+    def _remote_connection_params(self):
+        scene_terminal = self.node
+
+        params_list = []
+        host_proxy_port_mapping = json.loads(scene_terminal.host_proxy_port)
+        for access_mode in json.loads(scene_terminal.access_modes):
+            protocol = access_mode['protocol']
+            username = access_mode.get('username')
+            if protocol not in remote_protocols or not username:
+                continue
+
+            ip, port = get_ip_port_for_remote(scene_terminal, access_mode, host_proxy_port_mapping)
+            if not ip:
+                continue
+
+            params = {
+                'hostname': ip,
+                'port': port,
+                'username': username,
+                'password': access_mode.get('password', ''),
+            }
+            if protocol == SceneTerminal.AccessMode.RDP:
+                params['system_type'] = scene_terminal.system_type
+                security = access_mode.get('mode')
+                if security:
+                    params['security'] = security
+            params_list.append((get_access_mode_key(access_mode), protocol, params))
+        return params_list
+
+    def _missing_remote_connections(self, user_ids, params_list):
+        scene_terminal = self.node
+
+        exist_keys = set((user_id, access_mode_key) for user_id, access_mode_key, connection_id in
+                         load_remote_connections([scene_terminal])[scene_terminal.pk])
+        missing = {}
+        for user_id in user_ids:
+            user_params_list = [params for params in params_list if (user_id, params[0]) not in exist_keys]
+            if user_params_list:
+                missing[user_id] = user_params_list
+        return missing
+
+    # 为有权限的用户批量创建远程连接, 已有连接的跳过, 返回新建的连接数
+    def provision_remote_connections(self, user_ids):
+        scene_terminal = self.node
+
+        user_ids = set(int(user_id) for user_id in user_ids if user_id)
+        params_list = self._remote_connection_params()
+        if not user_ids or not params_list:
+            return 0
+
+        # 先不加锁检查, 连接都已存在时直接返回
+        if not self._missing_remote_connections(user_ids, params_list):
+            return 0
+
+        try:
+            with memcache_lock(cache, 'scene_terminal_connection_%s' % scene_terminal.pk, 100, 60):
+                missing = self._missing_remote_connections(user_ids, params_list)
+                current_user = getattr(self, 'user', None)
+                connections = []
+                for user in User.objects.filter(pk__in=missing.keys()):
+                    if current_user and current_user.pk == user.pk:
+                        user_util = self
+                    else:
+                        user_util = TerminalUtil(scene_terminal)(user, self.remote, self.proxy)
+                    user_params_list = missing[user.pk]
+                    for protocol, add_connections in ((SceneTerminal.AccessMode.SSH, user_util.add_ssh_connections),
+                                                      (SceneTerminal.AccessMode.RDP, user_util.add_rdp_connections)):
+                        protocol_params_list = [params for params in user_params_list if params[1] == protocol]
+                        if not protocol_params_list:
+                            continue
+                        connection_ids = add_connections([params[2] for params in protocol_params_list])
+                        for params, connection_id in zip(protocol_params_list, connection_ids):
+                            connections.append(SceneTerminalConnection(
+                                scene_terminal=scene_terminal,
+                                user=user,
+                                access_mode_key=params[0],
+                                protocol=protocol,
+                                connection_id=connection_id,
+                            ))
+
+                try:
+                    SceneTerminalConnection.objects.bulk_create(connections)
+                except IntegrityError as e:
+                    logger.error('terminal[%s] save remote connections error: %s', scene_terminal.pk, e)
+                    self.remove_connections([connection.connection_id for connection in connections])
+                    return 0
+        except MemcacheLockException as e:
+            logger.error('terminal[%s] provision remote connections error: %s', scene_terminal.pk, e)
+            return 0
+
+        if connections:
+            del self.user_remote_connections
+        return len(connections)
+
 
 class ControlMixin(object):
 
@@ -487,10 +672,10 @@ class GetMixin(object):
             access_mode_map = {get_access_mode_key(mode): mode for mode in access_modes}
 
             if self.remote:
-                self._ensure_remote_connection(access_mode_map)
+                user_remote_connections = self.user_remote_connections
                 for access_mode_key, access_mode in access_mode_map.items():
-                    connection = access_mode.pop('connections', {}).get(str(self.user.id), {})
-                    connection_id = connection.get('connection_id')
+                    access_mode.pop('connections', None)
+                    connection_id = user_remote_connections.get(access_mode_key)
                     if connection_id:
                         if access_mode['protocol'] == SceneTerminal.AccessMode.SSH:
                             access_mode['connection_url'] = self.remote_manager.get_ssh_connection_url(connection_id)
@@ -532,57 +717,6 @@ class GetMixin(object):
 
         return udict.filter_data(data, fields)
 
-    def _ensure_remote_connection(self, access_mode_map):
-        scene_terminal = self.node
-
-        access_modes = json.loads(scene_terminal.access_modes)
-        host_proxy_port_mapping = json.loads(scene_terminal.host_proxy_port)
-        need_update = False
-        for access_mode in access_modes:
-            protocol = access_mode['protocol']
-            if protocol not in remote_protocols or not access_mode.get('username'):
-                continue
-
-            access_mode_key = get_access_mode_key(access_mode)
-            if access_mode_key not in access_mode_map:
-                continue
-
-            ip, port = get_ip_port_for_remote(scene_terminal, access_mode, host_proxy_port_mapping)
-            if not ip:
-                continue
-
-            connections = access_mode.get('connections', {})
-            connection = connections.get(str(self.user.id), {})
-            if not connection:
-                if protocol == SceneTerminal.AccessMode.SSH:
-                    connection['connection_id'] = self.add_ssh_connection(
-                        ip,
-                        port,
-                        access_mode['username'],
-                        access_mode.get('password', '')
-                    )
-                    need_update = True
-                elif protocol == SceneTerminal.AccessMode.RDP:
-                    rdp_params = {
-                        'hostname': ip,
-                        'port': port,
-                        'username': access_mode['username'],
-                        'password': access_mode.get('password', ''),
-                        'system_type': scene_terminal.system_type,
-                    }
-                    security = access_mode.get('mode')
-                    if security:
-                        rdp_params['security'] = security
-                    connection['connection_id'] = self.add_rdp_connection(**rdp_params)
-                    need_update = True
-                connections[str(self.user.id)] = connection
-
-            access_mode['connections'] = connections
-            access_mode_map[access_mode_key]['connections'] = connections
-
-        if need_update:
-            self.update_node({'access_modes': json.dumps(access_modes)})
-
     # 获取最新状态
     def get_latest_status(self, status=None):
         scene_terminal = self.node
@@ -598,16 +732,7 @@ class GetMixin(object):
         return latest_status
 
     def get_estimate_consume_time(self):
-        scene_terminal = self.node
-
-        similar_terminal = SceneTerminal.objects.filter(
-            consume_time__gt=0,
-            image=scene_terminal.image,
-            install_script=scene_terminal.install_script,
-            init_script=scene_terminal.init_script
-        ).order_by('-create_time').first()
-        consume_time = similar_terminal.consume_time if similar_terminal else None
-        return consume_time
+        return estimate.estimate_terminal(self.node)
 
     # 获取预估的机器创建消耗时间
     def get_process_seconds(self):
@@ -630,27 +755,13 @@ class GetMixin(object):
         scene_terminal = self.node
 
         remote_info = {}
-        access_modes = json.loads(scene_terminal.access_modes)
-        for access_mode in access_modes:
-            if access_mode['protocol'] in remote_protocols:
-                connections = access_mode.get('connections', {})
-                for user_id, connection in connections.items():
-                    connection_id = connection.get('connection_id')
-                    if connection_id:
-                        remote_info[user_id] = connection_id
+        for user_id, access_mode_key, connection_id in load_remote_connections([scene_terminal])[scene_terminal.pk]:
+            remote_info[str(user_id)] = connection_id
         return remote_info
 
     def _get_connection_id(self):
-        scene_terminal = self.node
-
-        access_modes = json.loads(scene_terminal.access_modes)
-        for access_mode in access_modes:
-            if access_mode['protocol'] in remote_protocols:
-                connections = access_mode.get('connections', {})
-                connection = connections.get(str(self.user.id), {})
-                connection_id = connection.get('connection_id')
-                if connection_id:
-                    return connection_id
+        for access_mode_key, connection_id in self.user_remote_connections.items():
+            return connection_id
 
         return None
 
@@ -705,7 +816,7 @@ class CreateMixin(object):
             if scene_terminal.flavor < standard_device.flavor:
                 scene_terminal.flavor = standard_device.flavor
 
-    def prepare_network(self, ran_ips=None, float_ip_info=None, external_port_info=None):
+    def prepare_network(self, ran_ips=None, float_ip_info=None, external_port_info=None, allocate_ports=True):
         scene_terminal = self.node
 
         # 准备网络参数
@@ -772,30 +883,13 @@ class CreateMixin(object):
         for network in networks:
             network.pop('gateway_port_id', None)
 
-        net_ports = []
-        # 预分配网络端口
+        # 待预分配的网络端口, 场景创建时所有终端合并批量创建
+        port_requests = []
         for network in networks:
             net_id = network.pop('net_id', None)
             fixed_ip = network.pop('fixed_ip', None)
             if net_id and fixed_ip:
-                try:
-                    port_map = cloud.network.preallocate_ports(net_id, pre_ips=[fixed_ip])
-                    if not port_map:
-                        raise SceneException(error.NO_ENOUGH_IP)
-                except Exception as e:
-                    for net_port in net_ports:
-                        try:
-                            cloud.network.delete_port(net_port)
-                        except Exception:
-                            pass
-                    raise e
-
-                port_id = port_map.values()[0]
-                network['port_id'] = port_id
-                net_ports.append(port_id)
-
-        if external_port_info:
-            net_ports.append(external_port_info[1])
+                port_requests.append((network, net_id, fixed_ip))
 
         float_ip_params = {}
         if float_ip:
@@ -823,13 +917,17 @@ class CreateMixin(object):
                 if route_net_sub_id:
                     float_ip_params['route_net'] = route_net_sub_id
 
-        return {
+        network_info = {
             'networks': networks,
             'net_configs': net_configs,
             'float_ip_params': float_ip_params,
             'float_ip': float_ip or external_ip or hang_access_ip,
-            'net_ports': net_ports
+            'port_requests': port_requests,
+            'external_port_id': external_port_info[1] if external_port_info else None,
         }
+        if allocate_ports:
+            allocate_network_ports([network_info])
+        return network_info
 
     def prepare_install(self):
         volumes = []
@@ -952,51 +1050,6 @@ class CreateMixin(object):
             port_info = '_'.join([fip_port['id'], fixed_ip])
             cloud.docker.update(server_id, fip_port=port_info, float_ip=float_ip_info[1])
 
-    def _server_add_remote_connection(self, access_modes):
-        scene_terminal = self.node
-
-        is_add = False
-        host_proxy_port_mapping = json.loads(scene_terminal.host_proxy_port)
-        for access_mode in access_modes:
-            protocol = access_mode['protocol']
-            if protocol not in remote_protocols:
-                continue
-
-            username = access_mode.get('username')
-            if not username:
-                continue
-
-            connections = access_mode.get('connections', {})
-            connection = connections.get(self.user.id, {})
-            if connection.get('connection_id'):
-                continue
-
-            ip, port = get_ip_port_for_remote(scene_terminal, access_mode, host_proxy_port_mapping)
-            if not ip:
-                continue
-
-            password = access_mode.get('password')
-            if protocol == SceneTerminal.AccessMode.SSH:
-                connection_id = self.add_ssh_connection(ip, port, username, password)
-            else:
-                rdp_params = {
-                    'hostname': ip,
-                    'port': port,
-                    'username': username,
-                    'password': password,
-                    'system_type': scene_terminal.system_type,
-                }
-                security = access_mode.get('mode')
-                if security:
-                    rdp_params['security'] = security
-                connection_id = self.add_rdp_connection(**rdp_params)
-
-            connection['connection_id'] = connection_id
-            connections[self.user.id] = connection
-            access_mode['connections'] = connections
-            is_add = True
-        return is_add
-
     # 宿主机代理
     def create_host_proxy(self, server=None):
         scene_terminal = self.node
@@ -1211,13 +1264,11 @@ class DeleteMixin(object):
         scene_terminal = self.node
 
         if self.remote:
-            access_modes = json.loads(scene_terminal.access_modes)
-            for access_mode in access_modes:
-                connections = access_mode.get('connections', {})
-                for user_id, connection in connections.items():
-                    connection_id = connection.get('connection_id')
-                    if connection_id:
-                        self.remove_connection(connection_id)
+            connection_ids = [connection_id for user_id, access_mode_key, connection_id in
+                              load_remote_connections([scene_terminal])[scene_terminal.pk]]
+            if connection_ids:
+                self.remove_connections(connection_ids)
+                SceneTerminalConnection.objects.filter(scene_terminal=scene_terminal).delete()
 
     def delete_host_proxy_resource(self):
         scene_terminal = self.node
@@ -1276,6 +1327,38 @@ def get_access_mode_key(access_mode):
     return '%s:%s:%s' % (protocol, port, access_mode.get('username'))
 
 
+# 旧数据的远程连接记在access_modes的connections里
+def get_legacy_remote_connections(scene_terminal):
+    connections = []
+    for access_mode in json.loads(scene_terminal.access_modes):
+        if access_mode.get('protocol') not in remote_protocols:
+            continue
+        access_mode_key = get_access_mode_key(access_mode)
+        for user_id, connection in access_mode.get('connections', {}).items():
+            connection_id = connection.get('connection_id')
+            if connection_id:
+                connections.append((int(user_id), access_mode_key, connection_id))
+    return connections
+
+
+# 一次查询终端的远程连接 {scene_terminal_id: [(user_id, access_mode_key, connection_id)]}
+def load_remote_connections(scene_terminals, user_id=None):
+    terminal_connections = {}
+    for scene_terminal in scene_terminals:
+        connections = get_legacy_remote_connections(scene_terminal)
+        if user_id is not None:
+            connections = [connection for connection in connections if connection[0] == user_id]
+        terminal_connections[scene_terminal.pk] = connections
+
+    if terminal_connections:
+        queryset = SceneTerminalConnection.objects.filter(scene_terminal__in=terminal_connections.keys())
+        if user_id is not None:
+            queryset = queryset.filter(user=user_id)
+        for connection in queryset.values_list('scene_terminal', 'user', 'access_mode_key', 'connection_id'):
+            terminal_connections[connection[0]].append(connection[1:])
+    return terminal_connections
+
+
 def get_terminal_hang_info(scene_terminal):
     scene_hang_info = json.loads(scene_terminal.scene.hang_info)
     if not scene_hang_info:
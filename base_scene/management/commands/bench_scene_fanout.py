@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from django.core.management import BaseCommand
+
+from base_scene.web.consumers import SceneWebsocket
+
+
+logger = logging.getLogger(__name__)
+
+
+BENCH_USER_ID_START = 10000000
+
+
+# 终端状态推送扇出耗时: 逐用户序列化推送 vs 广播组一次推送
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('terminal', type=int, help='scene terminal id')
+        parser.add_argument('--user', type=int, required=True, help='user id used for serialization')
+        parser.add_argument('--participants', default='10,50,100,300')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        terminal_id = options['terminal']
+        user_id = options['user']
+        repeat = options['repeat']
+
+        self.stdout.write('participants  per_user(ms)  group(ms)  speedup')
+        for participants in [int(count) for count in options['participants'].split(',')]:
+            # 压测用户不存在连接, 只计序列化和channel layer写入
+            users = range(BENCH_USER_ID_START, BENCH_USER_ID_START + participants)
+            group_name = 'bench-fanout-%s' % participants
+            SceneWebsocket.set_group_users(group_name, users)
+
+            per_user_cost = self._measure(repeat, self._per_user_fanout, users, user_id, terminal_id)
+            group_cost = self._measure(repeat, SceneWebsocket.scene_terminal_status_update_group, group_name,
+                                       user_id, terminal_id)
+            SceneWebsocket.set_group_users(group_name, [])
+
+            self.stdout.write('%12d  %12.1f  %9.1f  %6.1fx' % (
+                participants, per_user_cost, group_cost, per_user_cost / group_cost if group_cost else 0,
+            ))
+
+    def _per_user_fanout(self, users, user_id, terminal_id):
+        for user in users:
+            data = SceneWebsocket._get_scene_terminal_data(user_id, terminal_id)
+            SceneWebsocket.user_send(user, data, code=SceneWebsocket.Event.SCENE_TERMINAL_STATUS_UPDATE)
+
+    def _measure(self, repeat, func, *args):
+        costs = []
+        for i in xrange(repeat):
+            start = time.time()
+            func(*args)
+            costs.append((time.time() - start) * 1000)
+        return min(costs)
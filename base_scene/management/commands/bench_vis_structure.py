@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from django.core.cache import cache
+from django.core.management import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from base_scene.common.util.scene import SceneUtil
+from base_scene.models import Scene
+from base_scene.utils import estimate
+from base_scene.utils.vis_config import VIS_SKELETON_CACHE_KEY, backend_to_vis, cached_backend_to_vis
+
+
+logger = logging.getLogger(__name__)
+
+
+# 场景拓扑获取耗时: 每次转换 vs 按配置指纹缓存骨架, 指定场景时同时统计查询数
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=500, help='node count of the generated config')
+        parser.add_argument('--scene', type=int, help='existing scene id')
+        parser.add_argument('--user', type=int, help='user id used for remote connections')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+
+        json_config = self._generate_config(options['nodes'])
+        fingerprint = estimate.config_fingerprint(json_config)
+        cache.delete(VIS_SKELETON_CACHE_KEY % fingerprint)
+        convert_cost = self._measure(repeat, backend_to_vis, json_config)
+        cached_backend_to_vis(json_config, fingerprint=fingerprint)
+        cached_cost = self._measure(repeat, cached_backend_to_vis, json_config, fingerprint)
+        cache.delete(VIS_SKELETON_CACHE_KEY % fingerprint)
+
+        self.stdout.write('nodes  convert(ms)  cached(ms)  speedup')
+        self.stdout.write('%5d  %11.1f  %10.1f  %6.1fx' % (
+            options['nodes'], convert_cost, cached_cost, convert_cost / cached_cost if cached_cost else 0,
+        ))
+
+        if options['scene']:
+            scene = Scene.objects.get(pk=options['scene'])
+            cache.delete(VIS_SKELETON_CACHE_KEY % (scene.config_fingerprint or
+                                                   estimate.config_fingerprint(scene.json_config)))
+            self.stdout.write('scene[%s]  round  cost(ms)  queries' % scene.pk)
+            for i in xrange(repeat):
+                scene_util = SceneUtil(scene)(options['user'])
+                with CaptureQueriesContext(connection) as context:
+                    start = time.time()
+                    scene_util.get_vis_structure()
+                    cost = (time.time() - start) * 1000
+                self.stdout.write('%9s  %5d  %8.1f  %7d' % ('', i, cost, len(context.captured_queries)))
+
+    def _generate_config(self, node_count):
+        # 每10个节点一个网络, 网络之间用一个路由连接, 其余为终端
+        net_count = max(node_count // 10, 1)
+        networks = [{
+            'id': 'net-%s' % i,
+            'name': 'net-%s' % i,
+            'range': '10.%s.%s.0/24' % (i // 256, i % 256),
+        } for i in xrange(net_count)]
+        routers = [{
+            'id': 'router-0',
+            'name': 'router-0',
+            'net': [network['id'] for network in networks],
+        }]
+        servers = [{
+            'id': 'server-%s' % i,
+            'name': 'server-%s' % i,
+            'image': 'bench',
+            'role': 'target',
+            'imageType': 'docker',
+            'systemType': 'linux',
+            'net': [networks[i % net_count]['id']],
+        } for i in xrange(max(node_count - net_count - 1, 0))]
+        return {
+            'scene': {'name': 'bench'},
+            'networks': networks,
+            'routers': routers,
+            'servers': servers,
+        }
+
+    def _measure(self, repeat, func, *args):
+        costs = []
+        for i in xrange(repeat):
+            start = time.time()
+            func(*args)
+            costs.append((time.time() - start) * 1000)
+        return min(costs)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from django.core.management import BaseCommand
+
+from base_scene.models import BuildTimeEstimate, Scene, SceneTerminal
+from base_scene.utils import estimate
+
+
+# 根据历史场景和机器的创建耗时重建耗时估计, 同时补全旧场景的配置指纹
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        BuildTimeEstimate.objects.all().delete()
+
+        scene_count = 0
+        for scene in Scene.objects.order_by('create_time').iterator():
+            if not scene.config_fingerprint:
+                scene.config_fingerprint = estimate.config_fingerprint(scene.json_config)
+                Scene.objects.filter(pk=scene.pk).update(config_fingerprint=scene.config_fingerprint)
+            if scene.consume_time > 0:
+                estimate.record_scene(scene)
+                scene_count += 1
+
+        terminal_count = 0
+        for scene_terminal in SceneTerminal.objects.filter(consume_time__gt=0).order_by('create_time').iterator():
+            estimate.record_terminal(scene_terminal)
+            terminal_count += 1
+
+        self.stdout.write('rebuilt estimates from %s scenes, %s terminals' % (scene_count, terminal_count))
@@ -30,6 +30,8 @@ class Scene(models.Model):
     type = models.PositiveIntegerField(default=Type.BASE)
     file = models.FileField(upload_to='scene', null=True, default=None)
     json_config = models.TextField(default='{}')
+    # 规范化配置的hash, 用于查找相同配置的历史创建耗时
+    config_fingerprint = models.CharField(max_length=32, default='', db_index=True)
 
     # 被外部引用的关系
     hang_info = models.TextField(default='{}')
@@ -63,6 +65,41 @@ class Scene(models.Model):
         return json.loads(self.json_config).get('scene', {}).get('name')
 
 
+# 按配置指纹汇总的历史创建耗时, 场景或机器创建完成时更新
+class BuildTimeEstimate(models.Model):
+    Kind = Enum(
+        SCENE='scene',
+        TERMINAL='terminal',
+        IMAGE_FLAVOR='image_flavor',
+    )
+    kind = models.CharField(max_length=32)
+    fingerprint = models.CharField(max_length=32)
+    count = models.PositiveIntegerField(default=0)
+    # 耗时的指数移动平均(秒)
+    average = models.FloatField(default=0)
+    # 最近的耗时样本, json列表, 用于计算分位数
+    samples = models.TextField(default='[]')
+    update_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = (('kind', 'fingerprint'), )
+
+
+# 场景创建流程日志, 只追加不修改, 自增id作为读取游标
+class SceneLog(models.Model):
+    scene = models.ForeignKey(Scene, on_delete=models.CASCADE, related_name='+')
+    message = models.TextField(default='')
+    params = models.TextField(default='null')
+    create_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        index_together = (('scene', 'id'), )
+
+    @classmethod
+    def render(cls, message, params):
+        return message.format(**params or {})
+
+
 # 标靶
 class StandardDevice(Owner):
     name = models.CharField(max_length=100)
@@ -454,6 +491,20 @@ class SceneTerminal(SceneNode):
     extra = models.TextField(default='')
 
 
+# 终端远程连接: 用户在终端每个远程访问方式上的guacamole连接, 终端运行后批量创建
+class SceneTerminalConnection(models.Model):
+    scene_terminal = models.ForeignKey(SceneTerminal, on_delete=models.CASCADE, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    # 访问方式标识 protocol:port:username
+    access_mode_key = models.CharField(max_length=255)
+    protocol = models.CharField(max_length=100)
+    connection_id = models.IntegerField()
+    create_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('scene_terminal', 'user', 'access_mode_key')
+
+
 class InstallerType(models.Model):
     name = models.CharField(max_length=100)
 
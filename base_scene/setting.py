@@ -42,6 +42,25 @@ MAX_DOCKER_BLOCK_SECONDS = 20
 # 终端检查超时时间
 CHECK_TERMINAL_TIMEOUT = 20
 
+# 创建网络、路由的并发数
+PROVISION_WORKERS = 8
+
+# 终端创建执行器全局并发数、单场景并发数、单计算节点并发数
+BUILD_WORKERS = 16
+BUILD_SCENE_WORKERS = 8
+BUILD_HOST_WORKERS = 4
+
+# 终端创建执行器线程空闲退出时间
+BUILD_WORKER_IDLE_SECONDS = 60
+
+# 创建耗时估计: 移动平均权重, 保留的样本数, 估计值缓存时间(秒)
+BUILD_ESTIMATE_ALPHA = 0.3
+BUILD_ESTIMATE_SAMPLES = 50
+BUILD_ESTIMATE_CACHE_SECONDS = 60
+
+# 场景拓扑骨架缓存时间(秒), 标准设备信息变更后最多延迟这么久生效
+VIS_SKELETON_CACHE_SECONDS = 10 * 60
+
 # 链路
 TUNNELS = ({
     'id': 'hk',
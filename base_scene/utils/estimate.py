@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from base.utils.text import md5
+
+from base_scene import app_settings
+from base_scene.models import BuildTimeEstimate
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_KEY = 'build_time_estimate_%s_%s'
+
+# 没有估计值时缓存的占位
+NO_ESTIMATE = {}
+
+
+# 规范化配置后的指纹, key顺序、空白不同的相同配置得到相同指纹
+def config_fingerprint(json_config):
+    if not isinstance(json_config, dict):
+        try:
+            json_config = json.loads(json_config)
+        except Exception:
+            return md5(json_config or '')
+    return md5(json.dumps(json_config, sort_keys=True, separators=(',', ':')))
+
+
+def terminal_fingerprint(scene_terminal):
+    return md5(json.dumps([
+        scene_terminal.image_type,
+        scene_terminal.image,
+        scene_terminal.flavor,
+        scene_terminal.install_script,
+        scene_terminal.init_script,
+    ]))
+
+
+def image_flavor_fingerprint(scene_terminal):
+    return md5(json.dumps([scene_terminal.image_type, scene_terminal.image, scene_terminal.flavor]))
+
+
+def _percentile(samples, percent):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, len(samples) * percent // 100)]
+
+
+def record(kind, fingerprint, consume_time):
+    if not fingerprint or consume_time <= 0:
+        return
+
+    with transaction.atomic():
+        estimate, created = BuildTimeEstimate.objects.select_for_update().get_or_create(
+            kind=kind,
+            fingerprint=fingerprint,
+        )
+        samples = json.loads(estimate.samples)
+        samples.append(consume_time)
+        estimate.samples = json.dumps(samples[-app_settings.BUILD_ESTIMATE_SAMPLES:])
+        if estimate.count:
+            alpha = app_settings.BUILD_ESTIMATE_ALPHA
+            estimate.average = alpha * consume_time + (1 - alpha) * estimate.average
+        else:
+            estimate.average = consume_time
+        estimate.count += 1
+        estimate.update_time = timezone.now()
+        estimate.save()
+    cache.delete(CACHE_KEY % (kind, fingerprint))
+
+
+def get_estimate(kind, fingerprint):
+    key = CACHE_KEY % (kind, fingerprint)
+    data = cache.get(key)
+    if data is not None:
+        return data or None
+
+    estimate = BuildTimeEstimate.objects.filter(kind=kind, fingerprint=fingerprint).first()
+    if estimate and estimate.count:
+        samples = json.loads(estimate.samples)
+        data = {
+            'count': estimate.count,
+            'average': int(estimate.average),
+            'p50': _percentile(samples, 50),
+            'p90': _percentile(samples, 90),
+        }
+    else:
+        data = NO_ESTIMATE
+    cache.set(key, data, app_settings.BUILD_ESTIMATE_CACHE_SECONDS)
+    return data or None
+
+
+def estimate_consume_time(kind, fingerprint):
+    data = get_estimate(kind, fingerprint)
+    return data['average'] if data else None
+
+
+def record_scene(scene):
+    fingerprint = scene.config_fingerprint or config_fingerprint(scene.json_config)
+    record(BuildTimeEstimate.Kind.SCENE, fingerprint, scene.consume_time)
+
+
+def estimate_scene(scene):
+    fingerprint = scene.config_fingerprint or config_fingerprint(scene.json_config)
+    return estimate_consume_time(BuildTimeEstimate.Kind.SCENE, fingerprint)
+
+
+def record_terminal(scene_terminal):
+    record(BuildTimeEstimate.Kind.TERMINAL, terminal_fingerprint(scene_terminal), scene_terminal.consume_time)
+    record(BuildTimeEstimate.Kind.IMAGE_FLAVOR, image_flavor_fingerprint(scene_terminal), scene_terminal.consume_time)
+
+
+# 相同镜像、规格、脚本的机器没有记录时用相同镜像和规格的估计
+def estimate_terminal(scene_terminal):
+    consume_time = estimate_consume_time(BuildTimeEstimate.Kind.TERMINAL, terminal_fingerprint(scene_terminal))
+    if consume_time is None:
+        consume_time = estimate_consume_time(BuildTimeEstimate.Kind.IMAGE_FLAVOR,
+                                             image_flavor_fingerprint(scene_terminal))
+    return consume_time
@@ -5,9 +5,15 @@ import os
 import json
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Q, F
 
+from .. import app_settings
 from ..models import StandardDevice
+from .estimate import config_fingerprint
+
+
+VIS_SKELETON_CACHE_KEY = 'scene_vis_skeleton_%s'
 
 
 # 获取对应标靶的信息
@@ -379,15 +385,15 @@ class JsonConfigHandler(object):
     def _generate_edges(self, node_id_map):
         edges = []
         # 已经添加过边的节点组
-        connected_node_groups = []
+        connected_node_groups = set()
         for node_id, node in node_id_map.items():
             connected_node_ids = node['connections']
             for connected_node_id in connected_node_ids:
-                node_group = {node_id, connected_node_id}
+                node_group = frozenset((node_id, connected_node_id))
                 if node_group in connected_node_groups:
                     continue
                 else:
-                    connected_node_groups.append(node_group)
+                    connected_node_groups.add(node_group)
                 edge = {
                     'from': node_id,
                     'to': connected_node_id,
@@ -464,3 +470,16 @@ def backend_to_vis(json_config):
     handler = JsonConfigHandler(json_config)
     vis_config = handler.convert()
     return vis_config
+
+
+# 转换结果按配置指纹缓存, 缓存取出的是新对象, 调用方可以直接修改
+def cached_backend_to_vis(json_config, fingerprint=None):
+    fingerprint = fingerprint or config_fingerprint(json_config)
+    key = VIS_SKELETON_CACHE_KEY % fingerprint
+    vis_config = cache.get(key)
+    if vis_config is None:
+        if not isinstance(json_config, dict):
+            json_config = json.loads(json_config)
+        vis_config = backend_to_vis(json_config)
+        cache.set(key, vis_config, app_settings.VIS_SKELETON_CACHE_SECONDS)
+    return vis_config
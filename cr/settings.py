@@ -177,6 +177,8 @@ AUTH_USER_MODEL = 'base_auth.User'
 
 
 DEFAULT_CACHE_AGE = 300
+# 接口缓存过期或依赖失效后, 重新计算期间返回旧数据的最长时间(秒)
+API_CACHE_STALE_AGE = 10
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
@@ -276,6 +278,11 @@ RPC_DEFAULT_PORT = 8192
 SOCKET_TIMEOUT = 10000
 CONNECT_TIMEOUT = 10000
 
+# agent rpc连接池: 每个agent保留的空闲连接数, 空闲回收时间(秒), 复用前检查的空闲时间(秒)
+RPC_POOL_SIZE = 4
+RPC_POOL_IDLE_SECONDS = 60
+RPC_POOL_CHECK_SECONDS = 10
+
 DOWNLOAD_SERVER = 'http://169.254.169.254/cr'
 
 
@@ -4,3 +4,14 @@ from base.utils.app import AppConfig as BaseAppConfig
 
 class AppConfig(BaseAppConfig):
     name = 'cr_scene'
+
+    def ready(self):
+        super(AppConfig, self).ready()
+
+        from django.db.models.signals import post_save, post_delete
+        from cr_scene.models import CrScene, CrEventScene
+        from cr_scene.utils.fanout import cr_event_scene_changed, cr_scene_changed
+
+        post_save.connect(cr_event_scene_changed, sender=CrEventScene)
+        post_delete.connect(cr_event_scene_changed, sender=CrEventScene)
+        post_save.connect(cr_scene_changed, sender=CrScene)
@@ -14,6 +14,7 @@ from rest_framework.response import Response
 from base.utils import udict
 from base.utils.enum import Enum
 from base.utils.rest.mixins import CacheModelMixin, DestroyModelMixin, PMixin
+from base.utils.thread import async_exe
 from base_auth.utils.rest.mixins import BatchSetOwnerModelMixin
 from base_mission.cms.serializers import MissionSerializer
 from base_mission.utils.mission_data_handle import save_related_mission
@@ -24,8 +25,10 @@ from base_scene.common.util.constants import StatusUpdateEvent as SceneStatusUpd
 from base_scene.models import Scene, SceneTerminal
 from base_traffic.utils.traffic import copy_traffic
 from cr_scene.models import CrScene, CrEvent, CrEventScene, MissionPeriod
+from cr_scene.utils import fanout
 from cr_scene.utils.agent_util import report_sys_info
 from cr_scene.utils.mission_util import SceneMissionManager
+from cr_scene.utils.scene import provision_cr_event_remote_connections
 from cr_scene.utils.traffic_util import SceneTrafficManager
 from traffic_event.cms.serializers import TrafficEventSerializer
 from traffic_event.utils.event_data_handle import save_related_traffic
@@ -297,7 +300,8 @@ class CrSceneViewSet(BatchSetOwnerModelMixin,
 
 
 def _cr_scene_instance_status_updated(user_id, cr_scene_id, *args, **kwargs):
-    CrSceneViewSet.clear_self_cache()
+    # 状态变化只影响该场景的缓存页和详情
+    CrSceneViewSet.invalidate_cache_rows([cr_scene_id])
     event = kwargs.get('event', SceneStatusUpdateEvent.SCENE_CREATE)
     status = kwargs.get('status')
     scene_id = kwargs.get('scene_id')
@@ -332,7 +336,6 @@ def _cr_scene_instance_status_updated(user_id, cr_scene_id, *args, **kwargs):
             if event == SceneStatusUpdateEvent.SCENE_CREATE:
                 # 机器创建完成
                 # report_sys_info(cr_scene_id, scene_terminal_id)
-                from base.utils.thread import async_exe
                 async_exe(report_sys_info, (cr_scene_id, scene_terminal_id), delay=1)
 
         scene_consumers.SceneWebsocket.scene_terminal_status_update(user_id, scene_terminal_id)
@@ -416,6 +419,13 @@ def update_cr_scenes_data(cr_event, cr_scenes):
     for cr_scene in id_old_cr_scene.values():
         cr_scene.delete()
 
+    # update()不触发信号, 手动清除推送计划
+    fanout.clear_event_fanout_plan(cr_event)
+
+    # 角色人员可能有变化, 提交后为运行中的终端补建远程连接
+    cr_event_id = cr_event.pk
+    transaction.on_commit(lambda: async_exe(provision_cr_event_remote_connections, (cr_event_id,)))
+
 
 def delete_cr_scene_instance(user, cr_scene):
     handler = SceneHandler(user, scene=cr_scene.scene)
@@ -12,6 +12,7 @@ from base_scene.cms.serializers import SceneConfigSerializer
 from base_scene.common.scene import SceneHandler
 
 from cr_scene.models import CrScene, CrEvent, CrEventScene, MissionPeriod
+from cr_scene.utils.scene import provision_viewer_remote_connections
 
 
 class CrSceneSerializer(ModelSerializer):
@@ -34,6 +35,7 @@ class CrSceneSerializer(ModelSerializer):
         request = self.context.get('request')
         user = request.user if request else self.context.get('user')
         if obj.scene and user:
+            provision_viewer_remote_connections(user, obj.scene)
             handler = SceneHandler(user, scene=obj.scene)
             return handler.get()
         else:
@@ -78,6 +80,7 @@ class CrEventSceneSeriallizer(ModelSerializer):
         request = self.context.get('request')
         user = request.user if request else self.context.get('user')
         if obj.cr_scene_instance and user:
+            provision_viewer_remote_connections(user, obj.cr_scene_instance)
             handler = SceneHandler(user, scene=obj.cr_scene_instance)
             return handler.get()
         else:
@@ -15,6 +15,12 @@ DEFAULT_EVENT_LOGO_DIR = 'event_logo/default_event_logo/'
 # 态势拓扑显示logo
 DEFAULT_TOPO_LOGO = 'http://58.213.63.28:9098/static/logos/cpcr.png'
 
+# 场景状态推送计划缓存时间(秒)
+STATUS_FANOUT_CACHE_TIMEOUT = 60
+
+# 裁判监控的机器连接索引缓存时间(秒)
+MONITOR_INDEX_CACHE_SECONDS = 30
+
 REDIS_CONF = {
     'host': '127.0.0.1',
     'port': 6379,
@@ -69,6 +69,20 @@ def get_user_role_info(user_id, cr_event_scene, fields=None):
     return udict.filter_data(data, fields)
 
 
+# 终端 -> 有权限用户 {terminal_sub_id: user_ids}
+def get_server_access_users(role_users_list, role_servers_list):
+    role_users_mapping = {role_users['role']: role_users['users'] for role_users in role_users_list}
+    server_access_users = {}
+    for role_servers in role_servers_list:
+        role = role_servers.get('value')
+        servers = role_servers.get('servers')
+        users = role_users_mapping.get(role)
+        if role and servers and users:
+            for server in servers:
+                server_access_users.setdefault(server, set()).update(users)
+    return server_access_users
+
+
 # 获取用户场景可读取数据字段配置
 def get_role_scene_fields_config(user_id, cr_event_scene, public=False):
     try:
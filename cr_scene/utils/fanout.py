@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+from django.core.cache import cache
+
+from base.utils.text import md5
+from base_auth.cms.consumers import GROUP_TIMEOUT
+from base_scene.web.consumers import SceneWebsocket
+
+from cr_scene import app_settings
+from cr_scene.models import CrEventScene
+from cr_scene.utils import common
+
+
+logger = logging.getLogger(__name__)
+
+
+def _fanout_key(cr_event_scene_id):
+    return 'cr_event_scene_fanout:%s' % cr_event_scene_id
+
+
+def _fanout_groups_key(cr_event_scene_id):
+    return 'cr_event_scene_fanout_groups:%s' % cr_event_scene_id
+
+
+def _group_name(cr_event_scene_id, visibility, users=None):
+    name = 'cr_event_scene-%s-%s' % (cr_event_scene_id, visibility)
+    if users is not None:
+        name = '%s-%s' % (name, md5(','.join(str(user) for user in sorted(users)))[:12])
+    return name
+
+
+def _build_fanout_plan(cr_event_scene_id, user_id):
+    cr_event_scene = CrEventScene.objects.filter(pk=cr_event_scene_id).values(
+        'cr_event_id',
+        'roles',
+        'cr_scene__roles',
+        'cr_scene__scene_config__json_config',
+        'cr_scene_instance__json_config',
+    )[0]
+    role_users_list = json.loads(cr_event_scene['roles'])
+    scene_json_config = json.loads(
+        cr_event_scene['cr_scene_instance__json_config'] or cr_event_scene['cr_scene__scene_config__json_config'])
+
+    user_ids = {user_id}
+    for role_users in role_users_list:
+        user_ids.update(role_users.get('users', []))
+
+    # 由于业务场景合并，需要向其它场景人员推送
+    other_user_ids = set()
+    other_cr_event_scenes = CrEventScene.objects.exclude(pk=cr_event_scene_id).filter(
+        cr_event=cr_event_scene['cr_event_id']).values('roles')
+    for other_cr_event_scene in other_cr_event_scenes:
+        for other_role_users in json.loads(other_cr_event_scene['roles']):
+            other_user_ids.update(other_role_users.get('users', []))
+    other_user_ids = other_user_ids - user_ids
+
+    # 终端 -> 可访问用户
+    try:
+        server_access_users = common.get_server_access_users(role_users_list,
+                                                             json.loads(cr_event_scene['cr_scene__roles']))
+    except Exception as e:
+        logger.error('get event role servers config error: %s', e)
+        server_access_users = None
+
+    # 按可见性分组: 全部人员、本场景人员、其它场景人员、各终端的无权限人员
+    groups = {
+        _group_name(cr_event_scene_id, 'all'): user_ids | other_user_ids,
+        _group_name(cr_event_scene_id, 'member'): user_ids,
+        _group_name(cr_event_scene_id, 'other'): other_user_ids,
+    }
+    server_forbid_groups = {}
+    for server in scene_json_config.get('servers', []):
+        access_users = (server_access_users or {}).get(server['id'], set())
+        forbid_users = user_ids - access_users
+        group_name = _group_name(cr_event_scene_id, 'forbid', forbid_users)
+        groups[group_name] = forbid_users
+        server_forbid_groups[server['id']] = group_name
+
+    for group_name, users in groups.items():
+        SceneWebsocket.set_group_users(group_name, users)
+
+    # 无权限人员变化后旧的forbid组不再使用, 清空成员
+    groups_key = _fanout_groups_key(cr_event_scene_id)
+    for group_name in set(cache.get(groups_key) or []) - set(groups):
+        SceneWebsocket.set_group_users(group_name, [])
+    cache.set(groups_key, list(groups), GROUP_TIMEOUT)
+
+    return {
+        'user_id': user_id,
+        'cr_event_id': cr_event_scene['cr_event_id'],
+        'user_ids': user_ids,
+        'other_user_ids': other_user_ids,
+        'public_data_ids': common.get_public_data_ids(scene_json_config),
+        'server_access_users': server_access_users,
+        'all_group': _group_name(cr_event_scene_id, 'all'),
+        'member_group': _group_name(cr_event_scene_id, 'member'),
+        'other_group': _group_name(cr_event_scene_id, 'other'),
+        'server_forbid_groups': server_forbid_groups,
+    }
+
+
+# 场景状态推送计划: 推送用户、终端访问权限、公共数据, 缓存到场景配置变化
+def get_fanout_plan(cr_event_scene_id, user_id):
+    key = _fanout_key(cr_event_scene_id)
+    plan = cache.get(key)
+    if plan is None or plan['user_id'] != user_id:
+        plan = _build_fanout_plan(cr_event_scene_id, user_id)
+        cache.set(key, plan, app_settings.STATUS_FANOUT_CACHE_TIMEOUT)
+    return plan
+
+
+def clear_fanout_plan(cr_event_scene_ids):
+    cache.delete_many([_fanout_key(cr_event_scene_id) for cr_event_scene_id in cr_event_scene_ids])
+
+
+def clear_event_fanout_plan(cr_event):
+    clear_fanout_plan(CrEventScene.objects.filter(cr_event=cr_event).values_list('pk', flat=True))
+
+
+def clear_scene_fanout_plan(cr_scene):
+    clear_fanout_plan(CrEventScene.objects.filter(cr_scene=cr_scene).values_list('pk', flat=True))
+
+
+def cr_event_scene_changed(sender, instance, **kwargs):
+    clear_event_fanout_plan(instance.cr_event_id)
+
+
+def cr_scene_changed(sender, instance, **kwargs):
+    clear_scene_fanout_plan(instance.pk)
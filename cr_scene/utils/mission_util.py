@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from base.utils.enum import Enum
+from base.utils.delete_channel_delay import cancel_channel_delay
 from base.utils.thread import async_exe
 from base_mission import constant as MissionConstant
 from base_mission.check_open_api import MissionAgentCheckerManager, MissionRpcCheckerManager
@@ -32,6 +33,9 @@ class SceneMissionManager(object):
 
     def _handle_scene_mission_check(self, action, mission_id=None):
         if self.cr_scene:
+            # 整个场景停止时一次取消全部待执行的检测
+            if action == self.ActionType.STOP and not mission_id:
+                cancel_channel_delay(scene_ids=[self.scene_id])
             if mission_id:
                 missions = self.cr_scene.missions.filter(type=MissionType.CHECK, id=mission_id)
             else:
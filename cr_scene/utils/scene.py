@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 import functools
+import json
 import logging
 
 from base_scene.common.util.scene import SceneUtil
-from base_scene.common.util.terminal import TerminalUtil
+from base_scene.common.util.terminal import (TerminalUtil, load_remote_connections,
+                                             using_status as terminal_using_status)
 from base_scene.models import Scene, SceneTerminal
 
+from cr_scene.models import CrEventScene
+from cr_scene.utils import common
+
 LOG = logging.getLogger(__name__)
 
 
@@ -57,6 +62,43 @@ def get_scene_all_remote_info(scene):
     return scene_util.get_all_remote_info()
 
 
+# 为终端有权限的用户创建远程连接
+def provision_terminal_remote_connections(scene_terminal, user_ids):
+    return TerminalUtil(scene_terminal)(remote=True).provision_remote_connections(user_ids)
+
+
+# 角色人员变化后为实例中运行的终端补建远程连接
+def provision_cr_event_remote_connections(cr_event_id):
+    cr_event_scenes = CrEventScene.objects.filter(
+        cr_event=cr_event_id,
+        cr_scene_instance__isnull=False,
+    ).select_related('cr_scene', 'cr_scene_instance')
+    for cr_event_scene in cr_event_scenes:
+        try:
+            server_access_users = common.get_server_access_users(json.loads(cr_event_scene.roles),
+                                                                 json.loads(cr_event_scene.cr_scene.roles))
+        except Exception as e:
+            LOG.error('get event role servers config error: %s', e)
+            continue
+
+        scene_util = SceneUtil(cr_event_scene.cr_scene_instance)(remote=True)
+        scene_util.provision_remote_connections(server_access_users)
+
+
+# 管理员、裁判不在角色配置里, 查看实例时为自己补建运行中终端的远程连接, 已有连接时只有一次查询
+def provision_viewer_remote_connections(user, scene):
+    scene_util = SceneUtil(scene)(user, remote=True)
+    scene_terminals = scene_util.scene_terminals
+    terminal_connections = load_remote_connections(scene_terminals, user_id=user.id)
+    terminal_users = {
+        scene_terminal.sub_id: [user.id] for scene_terminal in scene_terminals
+        if scene_terminal.status in terminal_using_status and not terminal_connections[scene_terminal.pk]
+    }
+    if not terminal_users:
+        return 0
+    return scene_util.provision_remote_connections(terminal_users)
+
+
 # 获取终端网络配置
 def get_terminal_net_config(net_sub_id, scene=None, terminal_sub_id=None, terminal_id=None, terminal_util=None):
     terminal_util = get_terminal_util(scene, terminal_sub_id, terminal_id, terminal_util)
@@ -2,6 +2,7 @@
 import json
 import logging
 
+from django.core.cache import cache
 from django.db import transaction
 from django.utils import timezone
 from rest_framework import exceptions, filters, status, viewsets
@@ -14,25 +15,29 @@ from base.utils import udict
 from base.utils.enum import Enum
 from base.utils.rest.decorators import request_data
 from base.utils.rest.mixins import CacheModelMixin, DestroyModelMixin, PMixin, PublicModelMixin
+from base.utils.thread import async_exe
 from base_auth.utils.rest.mixins import BatchSetOwnerModelMixin
 from base_auth.utils.rest.permissions import IsAdmin
 from base_mission import models as mission_models, constant
 from base_mission.cms import serializers as cms_mission_serializer
 from base_mission.web import serializers as web_mission_serializer
-from base_remote.managers import MonitorManager
+from base_remote.managers import monitor_aggregator
 from base_scene.common.scene import SceneHandler
 from base_scene.common.util.constants import StatusUpdateEvent as SceneStatusUpdateEvent
 from base_scene.models import Scene, SceneNet, SceneTerminal
 from base_scene.web import consumers as scene_consumers
 from base_traffic.utils.traffic import get_terminal_info
+from cr_scene import app_settings
 from cr_scene import models as scene_models
 from cr_scene import permission as cr_permissions
 from cr_scene.error import error
 from cr_scene.utils import common
+from cr_scene.utils import fanout
 from cr_scene.utils import uitls as cr_scene_utils
 from cr_scene.utils.agent_util import report_sys_info
 from cr_scene.utils.mission_util import SceneMissionManager
-from cr_scene.utils.scene import get_scene_all_remote_info
+from cr_scene.utils.scene import (get_scene_all_remote_info, provision_cr_event_remote_connections,
+                                  provision_terminal_remote_connections)
 from cr_scene.utils.traffic_util import SceneTrafficManager
 from cr_scene.utils.vis import VisApi, check_vis_is_run
 from cr_scene.web import consumers as cr_scene_consumers
@@ -102,12 +107,9 @@ class CrEventViewSet(BatchSetOwnerModelMixin,
 
     def retrieve(self, request, *args, **kwargs):
         if self.get_cache_flag():
-            cache_value = self.cache.get(self.get_retrieve_cache_key())
-            if cache_value:
-                data = cache_value
-            else:
-                data = self._get_retrieve_data()
-                self.cache.set(self.get_retrieve_cache_key(), data, self.get_cache_age())
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            data = self.get_or_set_cached_data(self.get_retrieve_cache_key(), self._get_retrieve_data,
+                                               self.get_object_cache_tags(self.kwargs[lookup_url_kwarg]))
         else:
             data = self._get_retrieve_data()
         return Response(data)
@@ -541,39 +543,61 @@ class CrEventViewSet(BatchSetOwnerModelMixin,
         }
         return Response(data=data, status=status.HTTP_200_OK)
 
+    # 监控索引: 按场景顺序记录(连接id -> 机器和用户, 机器id -> {用户id: 连接id})
+    def _get_monitor_index(self, cr_event, cr_scene_id=None, cr_event_scenes=None):
+        cache_key = 'cr_event_monitor_index_%s_%s_%s' % (cr_event.pk, cr_scene_id or 0, self.request.user.id)
+        if cr_event_scenes is not None:
+            instance_ids = [scene_obj.get('cr_scene_instance', None) for scene_obj in cr_event_scenes]
+        else:
+            index = cache.get(cache_key)
+            if index is not None:
+                return index
+
+            event_scenes = scene_models.CrEventScene.objects.filter(cr_event=cr_event)
+            if cr_scene_id:
+                event_scenes = event_scenes.filter(cr_scene_id=cr_scene_id)
+            # 与CrEventDetailSerializers一致, 没有权限的场景不返回实例
+            instance_ids = [event_scene.cr_scene_instance_id for event_scene in event_scenes
+                            if app_settings.CHECKER_ONE_AS_ADMIN
+                            or common.can_role_get_scene(self.request.user.id, event_scene)]
+
+        index = []
+        for instance_id in instance_ids:
+            if instance_id is None:
+                index.append(({}, {}))
+                continue
+            all_server_connection_ids = get_scene_all_remote_info(instance_id)
+            key_connnction_server_info = cr_scene_utils.get_deep_dict_value_as_key(all_server_connection_ids)
+            index.append((key_connnction_server_info, all_server_connection_ids))
+        cache.set(cache_key, index, app_settings.MONITOR_INDEX_CACHE_SECONDS)
+        return index
+
     @action(methods=['GET', 'POST'], detail=True,
             permission_classes=[permissions.IsAuthenticated, cr_permissions.RefereePermission])
     def monitor(self, request, pk):
         obj = self.get_object()
 
-        cr_event_data = webserializers.CrEventDetailSerializers(obj, context={
-            'request': request}).data  # 处理 request cr_scene_id
-
-        def _get_base_connection_info(scene_obj):
-            cr_scene_instance = scene_obj.get('cr_scene_instance', None)
-            if cr_scene_instance is None:
-                return {}, {}, {}
-
-            all_server_connection_ids = get_scene_all_remote_info(scene_obj["cr_scene_instance"])
-            key_connnction_server_info = cr_scene_utils.get_deep_dict_value_as_key(all_server_connection_ids)
-
-            monitor_manager = MonitorManager()
-            monitor_ret = monitor_manager.share_active_sessions_for_monitor(
-                connection_ids=key_connnction_server_info.keys())
+        if request.method == 'GET':
+            cr_event_data = webserializers.CrEventDetailSerializers(obj, context={
+                'request': request}).data  # 处理 request cr_scene_id
+            cr_event_scenes = cr_event_data['cr_event_scenes']
+            monitor_index = self._get_monitor_index(obj, cr_event_scenes=cr_event_scenes)
 
-            return key_connnction_server_info, monitor_ret, all_server_connection_ids
+            # 所有场景的连接一次查询, 各guacamole服务并发
+            all_connection_ids = set()
+            for key_connnction_server_info, all_server_connection_ids in monitor_index:
+                all_connection_ids.update(key_connnction_server_info.keys())
+            all_monitor_ret = monitor_aggregator.share_active_sessions_for_monitor(all_connection_ids)
 
-        if request.method == 'GET':
             # 获取正在使用的机器列表
             scene_obj_serve = []
-            for scene_obj in cr_event_data['cr_event_scenes']:
-                key_connnction_server_info, monitor_ret, all_server_connection_ids = \
-                    _get_base_connection_info(scene_obj)
-
+            scene_monitor_index = zip(cr_event_scenes, monitor_index)
+            for scene_obj, (key_connnction_server_info, all_server_connection_ids) in scene_monitor_index:
                 server_info_dict = {}
-                for connection_id, ret in monitor_ret.items():
+                for connection_id in all_monitor_ret:
                     server_info = key_connnction_server_info.get(connection_id)
-                    server_info_dict.setdefault(server_info['machine_id'], {}).update(**server_info)
+                    if server_info:
+                        server_info_dict.setdefault(server_info['machine_id'], {}).update(**server_info)
 
                 if scene_obj["cr_scene_instance_data"] is None:
                     continue
@@ -592,25 +616,21 @@ class CrEventViewSet(BatchSetOwnerModelMixin,
             return Response(data=scene_obj_serve, status=status.HTTP_200_OK)
 
         elif request.method == 'POST':
-            # 或单个机器的监控链接
+            # 或单个机器的监控链接, 从索引直接找到机器的连接
             machine_id = self.request.data.get('machine_id')
-            # scene_id = self.request.data.get('cr_scene_id') 已经处理
+            cr_scene_id = self.request.data.get('cr_scene_id')
             url = None
 
-            for scene_obj in cr_event_data['cr_event_scenes']:
-
-                key_connnction_server_info, monitor_ret, all_server_connection_ids = _get_base_connection_info(
-                    scene_obj)
-
+            for key_connnction_server_info, all_server_connection_ids in self._get_monitor_index(obj, cr_scene_id):
                 machine_user_conection_ids_dict = all_server_connection_ids.get(machine_id, None)
                 if machine_user_conection_ids_dict is None:
                     continue
 
+                monitor_ret = monitor_aggregator.share_active_sessions_for_monitor(
+                    machine_user_conection_ids_dict.values())
                 for connection_id, ret in monitor_ret.items():
-                    server_info = key_connnction_server_info.get(connection_id)
-                    if server_info['machine_id'] == machine_id:
-                        url = ret
-                        break
+                    url = ret
+                    break
             return Response(data={'url': url}, status=status.HTTP_200_OK)
 
     def extra_handle_list_data(self, data):
@@ -860,42 +880,28 @@ def update_cr_scenes_data(cr_event, cr_scenes):
     for cr_scene in id_old_cr_scene.values():
         cr_scene.delete()
 
+    # update()不触发信号, 手动清除推送计划
+    fanout.clear_event_fanout_plan(cr_event)
+
+    # 角色人员可能有变化, 提交后为运行中的终端补建远程连接
+    cr_event_id = cr_event.pk
+    transaction.on_commit(lambda: async_exe(provision_cr_event_remote_connections, (cr_event_id,)))
+
 
 def _cr_event_scene_instance_status_updated(user_id, cr_event_scene_id, *args, **kwargs):
-    CrEventViewSet.clear_self_cache()
     try:
-        cr_event_scene = scene_models.CrEventScene.objects.filter(pk=cr_event_scene_id).values(
-            'cr_event_id',
-            'roles',
-            'cr_scene__roles',
-            'cr_scene__scene_config__json_config',
-            'cr_scene_instance__json_config',
-        )[0]
-        role_users_list = json.loads(cr_event_scene['roles'])
-        scene_json_config = json.loads(
-            cr_event_scene['cr_scene_instance__json_config'] or cr_event_scene['cr_scene__scene_config__json_config'])
-
-        # 由于业务场景合并，需要向其它场景人员推送
-        other_cr_event_scenes = scene_models.CrEventScene.objects.exclude(pk=cr_event_scene_id).filter(
-            cr_event=cr_event_scene['cr_event_id']).values('roles')
-        other_role_users_list_collection = []
-        for other_cr_event_scene in other_cr_event_scenes:
-            other_role_users_list = json.loads(other_cr_event_scene['roles'])
-            other_role_users_list_collection.append(other_role_users_list)
+        plan = fanout.get_fanout_plan(cr_event_scene_id, user_id)
     except Exception as e:
         logger.error('get event role users config error: %s', e)
+        CrEventViewSet.clear_self_cache()
         return
 
-    user_ids = {user_id}
-    for role_users in role_users_list:
-        user_ids.update(role_users.get('users', []))
+    # 状态变化只影响该实例的缓存页和详情
+    CrEventViewSet.invalidate_cache_rows([plan['cr_event_id']])
 
-    other_user_ids = set()
-    for other_role_users_list in other_role_users_list_collection:
-        for other_role_users in other_role_users_list:
-            other_user_ids.update(other_role_users.get('users', []))
-    other_user_ids = other_user_ids - user_ids
-    public_data_ids = common.get_public_data_ids(scene_json_config) if other_user_ids else []
+    user_ids = plan['user_ids']
+    other_user_ids = plan['other_user_ids']
+    public_data_ids = plan['public_data_ids'] if other_user_ids else set()
 
     event = kwargs.get('event', SceneStatusUpdateEvent.SCENE_CREATE)
     status = kwargs.get('status')
@@ -922,19 +928,13 @@ def _cr_event_scene_instance_status_updated(user_id, cr_event_scene_id, *args, *
         else:
             pass
 
-        for user_id in user_ids:
-            scene_consumers.SceneWebsocket.scene_status_update(user_id, scene or scene_id)
-
-        for user_id in other_user_ids:
-            scene_consumers.SceneWebsocket.scene_status_update(user_id, scene or scene_id)
+        scene_consumers.SceneWebsocket.scene_status_update_group(plan['all_group'], user_id, scene or scene_id)
 
     scene_net_id = kwargs.get('scene_net_id')
     if scene_net_id:
         scene_net = kwargs.get('scene_net')
 
-        for user_id in user_ids:
-            scene_consumers.SceneWebsocket.scene_net_status_update(user_id, scene_net or scene_net_id)
-
+        net_group = plan['member_group']
         if other_user_ids and public_data_ids:
             if scene_net:
                 scene_net_sub_id = scene_net.sub_id
@@ -944,8 +944,8 @@ def _cr_event_scene_instance_status_updated(user_id, cr_event_scene_id, *args, *
                 except Exception:
                     scene_net_sub_id = None
             if scene_net_sub_id and scene_net_sub_id in public_data_ids:
-                for user_id in other_user_ids:
-                    scene_consumers.SceneWebsocket.scene_net_status_update(user_id, scene_net or scene_net_id)
+                net_group = plan['all_group']
+        scene_consumers.SceneWebsocket.scene_net_status_update_group(net_group, user_id, scene_net or scene_net_id)
 
     scene_terminal_id = kwargs.get('scene_terminal_id')
     if scene_terminal_id:
@@ -955,8 +955,7 @@ def _cr_event_scene_instance_status_updated(user_id, cr_event_scene_id, *args, *
             if event == SceneStatusUpdateEvent.SCENE_CREATE:
                 # 机器创建完成
                 # report_sys_info(cr_event_scene_id, scene_terminal_id)
-                from base.utils.thread import async_exe
-                async_exe(report_sys_info, (cr_event_scene['cr_event_id'], scene_terminal_id), delay=10)
+                async_exe(report_sys_info, (plan['cr_event_id'], scene_terminal_id), delay=10)
 
         if scene_terminal:
             scene_terminal_sub_id = scene_terminal.sub_id
@@ -966,36 +965,40 @@ def _cr_event_scene_instance_status_updated(user_id, cr_event_scene_id, *args, *
             except Exception as e:
                 logger.error('get scene_terminal error: %s', e)
                 return
-        try:
-            role_servers_list = json.loads(cr_event_scene['cr_scene__roles'])
-            role_users_mapping = {role_users['role']: role_users['users'] for role_users in role_users_list}
-        except Exception as e:
-            logger.error('get event role servers config error: %s', e)
+        if plan['server_access_users'] is None:
             return
 
-        access_users = set()
-        for role_servers in role_servers_list:
-            role = role_servers.get('value')
-            servers = role_servers.get('servers')
-            users = role_users_mapping.get(role)
-            if role and servers and users and scene_terminal_sub_id in servers:
-                access_users.update(users)
-
-        forbid_users = user_ids - access_users
-        for user_id in access_users:
-            scene_consumers.SceneWebsocket.scene_terminal_status_update(user_id, scene_terminal or scene_terminal_id)
-        for user_id in forbid_users:
-            scene_consumers.SceneWebsocket.scene_terminal_status_update(user_id, scene_terminal or scene_terminal_id,
-                                                                        fields=common.role_terminal_fields.FORBID)
+        # 有权限用户的数据含各自的远程连接, 单独推送
+        access_users = plan['server_access_users'].get(scene_terminal_sub_id, set())
+        # 机器可用后先为有权限用户批量创建远程连接, 推送的数据里才有连接地址
+        if status == SceneTerminal.Status.RUNNING and access_users:
+            provision_terminal_remote_connections(scene_terminal or scene_terminal_id, access_users)
+        scene_consumers.SceneWebsocket.scene_terminal_status_update_users(access_users,
+                                                                          scene_terminal or scene_terminal_id)
+        forbid_group = plan['server_forbid_groups'].get(scene_terminal_sub_id)
+        if forbid_group:
+            scene_consumers.SceneWebsocket.scene_terminal_status_update_group(
+                forbid_group,
+                user_id,
+                scene_terminal or scene_terminal_id,
+                fields=common.role_terminal_fields.FORBID,
+            )
+        else:
+            scene_consumers.SceneWebsocket.scene_terminal_status_update_users(
+                user_ids - access_users,
+                scene_terminal or scene_terminal_id,
+                fields=common.role_terminal_fields.FORBID,
+            )
 
         if other_user_ids and public_data_ids and scene_terminal_sub_id in public_data_ids:
-            for user_id in other_user_ids:
-                scene_consumers.SceneWebsocket.scene_terminal_status_update(
-                    user_id,
-                    scene_terminal or scene_terminal_id,
-                    fields=common.role_terminal_fields.PUBLIC,
-                    data_handler=common.handle_public_terminal_data,
-                )
+            # 公共数据去掉了远程连接, 各用户一致
+            scene_consumers.SceneWebsocket.scene_terminal_status_update_group(
+                plan['other_group'],
+                user_id,
+                scene_terminal or scene_terminal_id,
+                fields=common.role_terminal_fields.PUBLIC,
+                data_handler=common.handle_public_terminal_data,
+            )
 
 
 def delete_cr_event_scene_instance(user, cr_event_scene, raise_exception=False):
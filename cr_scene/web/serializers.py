@@ -15,6 +15,7 @@ from cr_scene import models as scene_models
 from cr_scene.cms import serializers as cms_serializers
 from cr_scene.error import error
 from cr_scene.utils import common
+from cr_scene.utils.scene import provision_viewer_remote_connections
 from cr_scene.utils import validators as utils_validators
 
 logger = logging.getLogger(__name__)
@@ -224,6 +225,9 @@ class CrEventDetailSerializers(ModelSerializer):
         data = []
         for event_scene in event_scenes:
             if app_settings.CHECKER_ONE_AS_ADMIN:
+                # 裁判按管理员查看, 不在角色配置里的没有远程连接, 需要补建
+                if event_scene.cr_scene_instance and not common.can_role_get_scene(request.user.id, event_scene):
+                    provision_viewer_remote_connections(request.user, event_scene.cr_scene_instance)
                 data.append(CrEventSceneSeriallizer(event_scene, context={'request': request}).data)
                 continue
             if common.can_role_get_scene(request.user.id, event_scene):